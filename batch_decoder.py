@@ -0,0 +1,188 @@
+"""Import required libraries"""
+from datetime import datetime
+import struct
+import numpy as np
+from beast_deframer import PAYLOAD_START, WANTED_DF
+
+
+"""Batch decoding constants"""
+MAX_FRAME_LEN = 22                      # "3" + 6 byte timestamp + 1 byte signal + 14 byte Mode-S long
+POW10 = 10 ** np.arange(11, dtype=np.int64)     # for the "%d.%d" timestamp semantics
+
+ROW_RECORD = struct.Struct('<ddB4s')    # ts, localtime, downlink, squawk - followed by the message
+
+# Payload length (in bytes) for each message type byte, zero for other message types:
+PAYLOAD_LEN = np.zeros(256, dtype=np.int64)
+PAYLOAD_LEN[0x31] = 2                   # Mode-AC
+PAYLOAD_LEN[0x32] = 7                   # Mode-S short
+PAYLOAD_LEN[0x33] = 14                  # Mode-S long
+
+# Payload bit positions (0 = most significant bit of the first payload byte) of idcode():
+SQUAWK_BITS = {
+    'A': (24, 22, 20),  # A4, A2, A1
+    'B': (30, 28, 26),  # B4, B2, B1
+    'C': (23, 21, 19),  # C4, C2, C1
+    'D': (31, 29, 27),  # D4, D2, D1
+}
+
+
+"""Function to pack a list of variable length messages into one uint8 array"""
+def pack_frames(frames):
+    '''
+    args:
+        frames: list of complete messages (bytes or memoryview), as produced by deframe()
+    returns:
+        packed: (n, MAX_FRAME_LEN) uint8 array, zero padded
+        lengths: (n,) int64 array of original message lengths
+    '''
+    n = len(frames)
+    lengths = np.fromiter(map(len, frames), dtype=np.int64, count=n)
+    joined = np.frombuffer(b''.join(frames), dtype=np.uint8)
+    packed = np.zeros((n, MAX_FRAME_LEN), dtype=np.uint8)
+    if len(joined) == 0:
+        return packed, lengths
+
+    # Gather MAX_FRAME_LEN bytes from the start of each message, masking bytes past its end:
+    offsets = np.cumsum(lengths) - lengths
+    columns = np.arange(MAX_FRAME_LEN)
+    index = np.minimum(offsets[:, None] + columns, len(joined) - 1)
+    valid = columns < lengths[:, None]
+    packed[valid] = joined[index[valid]]
+    return packed, lengths
+
+
+"""Function to decode the fields of a batch of packed messages with array bit operations"""
+def decode_fields(packed, lengths):
+    '''
+    args:
+        packed, lengths: as returned by pack_frames()
+    returns:
+        dictionary of (n,) arrays:
+            complete: message has a full Mode-AC/ Mode-S payload (counted as decoded)
+            mode_ac: message has a 2 byte payload
+            keep: complete, and either Mode-AC or DF5/ 17/ 21
+            seconds, nanoseconds: the 18-bit and 30-bit parts of the MLAT timestamp
+            ts: float timestamp identical to num_timestamp()
+            downlink: identical to df() of the payload
+            squawk: squawk code as a decimal number, identical to int(idcode())
+    '''
+    packed = packed.astype(np.int64)
+    msgtype = packed[:, 0]
+    # Like message[8:15] in the per-message decoder, a payload is cut short by the end of
+    # the message, and only 2, 7 or 14 byte payloads are complete. A 2 byte payload is
+    # written as Mode-AC whatever its message type:
+    payload_len = np.clip(lengths - PAYLOAD_START, 0, PAYLOAD_LEN[msgtype])
+    complete = np.isin(payload_len, (2, 7, 14))
+    mode_ac = payload_len == 2
+
+    # 48-bit MLAT timestamp: 18-bit seconds and 30-bit nanoseconds:
+    timestamp = np.zeros(len(packed), dtype=np.int64)
+    for byte in range(1, 7):
+        timestamp = (timestamp << 8) | packed[:, byte]
+    seconds = timestamp >> 30
+    nanoseconds = timestamp & ((1 << 30) - 1)
+
+    # num_timestamp() formats "%d.%d" and parses it back as a float, i.e. the nanoseconds
+    # are read as a decimal fraction of as many digits as they have. Both operands are
+    # exact in float64, so the division is correctly rounded just like float(str):
+    digits = np.searchsorted(POW10, nanoseconds, side='right')
+    ts = (seconds * POW10[digits] + nanoseconds).astype(np.float64) / POW10[digits].astype(np.float64)
+
+    # Downlink format, bits 1 to 5 of the payload:
+    downlink = np.minimum(packed[:, PAYLOAD_START] >> 3, 24)
+
+    # First 32 bits of the payload, for the identity bits:
+    word = np.zeros(len(packed), dtype=np.int64)
+    for byte in range(PAYLOAD_START, PAYLOAD_START + 4):
+        word = (word << 8) | packed[:, byte]
+    squawk = np.zeros(len(packed), dtype=np.int64)
+    for scale, letter in ((1000, 'A'), (100, 'B'), (10, 'C'), (1, 'D')):
+        digit = np.zeros(len(packed), dtype=np.int64)
+        for bit in SQUAWK_BITS[letter]:
+            digit = (digit << 1) | ((word >> (31 - bit)) & 1)
+        squawk += scale * digit
+
+    keep = complete & (mode_ac | np.isin(downlink, WANTED_DF))
+
+    return {
+        'complete': complete,
+        'keep': keep,
+        'mode_ac': mode_ac,
+        'seconds': seconds,
+        'nanoseconds': nanoseconds,
+        'ts': ts,
+        'downlink': downlink,
+        'squawk': squawk,
+    }
+
+
+"""Function that decodes a batch of messages into the same lists as the per-message decoder"""
+def decode_batch(frames, output='text'):
+    '''
+    args:
+        frames: list of complete messages (bytes or memoryview)
+        output: what the decoded messages are wanted as, like storage_format - 'text' for
+            the list form, 'binary' for records of capture_format.RECORD_DTYPE built from
+            the decoded fields, 'both' for a (list form, records) tuple
+    returns:
+        messages_to_write: list of [full_message, time_hex, ts, localtime, downlink, squawk]
+            for Mode-AC and DF5/ 17/ 21 messages, identical to the per-message decoder,
+            or their records, or both (see 'output')
+        decoded_count: number of complete Mode-AC/ Mode-S messages in the batch
+    '''
+    if len(frames) == 0:
+        packed, lengths = pack_frames([])
+        fields = None
+    else:
+        packed, lengths = pack_frames(frames)
+        fields = decode_fields(packed, lengths)
+
+    # Get Internet timestamp, once per batch:
+    utc_now = datetime.utcnow()
+    localtime = (utc_now - utc_now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+    keep = np.flatnonzero(fields['keep']) if fields is not None else np.zeros(0, dtype=np.int64)
+    decoded_count = int(np.count_nonzero(fields['complete'])) if fields is not None else 0
+
+    records = None
+    if output in ('binary', 'both'):
+        # The capture format imports this module, so it is imported when first needed:
+        from capture_format import fields_to_records
+        records = fields_to_records(packed, lengths, fields, keep, localtime)
+        if output == 'binary':
+            return records, decoded_count
+
+    # Hex strings are only produced for the messages that are written:
+    messages_to_write = []
+    if fields is not None:
+        ts_list = fields['ts'][keep].tolist()
+        downlink_list = fields['downlink'][keep].tolist()
+        squawk_list = fields['squawk'][keep].tolist()
+        mode_ac_list = fields['mode_ac'][keep].tolist()
+        for i, ts, downlink, squawk, mode_ac in zip(keep.tolist(), ts_list, downlink_list, squawk_list, mode_ac_list):
+            full_message = frames[i].hex().upper()
+            time_hex = full_message[2:14]
+            if mode_ac:
+                # squawk for mode AC taken to be just 'payload', a 2 byte message
+                squawk = full_message[16:20]
+            else:
+                squawk = '%04d' % squawk
+            messages_to_write.append([full_message, time_hex, ts, localtime, downlink, squawk])
+
+    if output == 'both':
+        return (messages_to_write, records), decoded_count
+    return messages_to_write, decoded_count
+
+
+"""Functions to convert a decoded message (in list form) to and from a fixed binary record"""
+def pack_row(row):
+    '''
+    args: row in list form, [full_message, time_hex, ts, localtime, downlink, squawk]
+    returns: bytes record, used by the shared memory transport instead of pickling
+    '''
+    full_message, time_hex, ts, localtime, downlink, squawk = row
+    return ROW_RECORD.pack(ts, localtime, downlink, squawk.encode('ascii')) + bytes.fromhex(full_message)
+def unpack_row(record):
+    """Inverse of pack_row()"""
+    ts, localtime, downlink, squawk = ROW_RECORD.unpack_from(record)
+    full_message = record[ROW_RECORD.size:].hex().upper()
+    return [full_message, full_message[2:14], ts, localtime, downlink, squawk.decode('ascii')]
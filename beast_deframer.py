@@ -0,0 +1,90 @@
+"""Import required libraries"""
+# (none - the deframer only relies on bytes/ memoryview builtins)
+
+
+"""Beast framing constants"""
+ESC = 0x1a                  # <esc> flag byte
+ESC_BYTE = b'\x1a'          # <esc> as a bytes object, for bytes.find
+STUFFED_ESC = b'\x1a\x1a'   # <esc><esc>: a 'stuffed', true 0x1a
+PAYLOAD_START = 8           # payload follows type, timestamp and signal level bytes
+WANTED_DF = (5, 17, 21)     # downlink formats carrying a squawk code, the ones the client keeps
+
+
+"""Function that splits a Beast byte stream into complete, unstuffed messages"""
+def deframe(data):
+    '''
+    args:
+        data: bytes, bytearray or memoryview holding the remainder of the previous
+            call followed by newly received bytes
+    returns:
+        frames: list of complete messages, each starting at its message type byte
+            ("1", "2", "3" or "4"). Messages without stuffed bytes are zero-copy
+            memoryview slices of 'data'; messages that contained <esc><esc> are
+            unstuffed bytes objects
+        remainder: memoryview slice of 'data' holding the trailing partial message
+            (including its leading <esc>), to be prepended to the next received chunk
+
+    A message is only complete once the <esc> of the following message has been
+    seen, so the last message of every chunk is always carried over as remainder.
+    Bytes before the first message boundary (i.e. while synchronising) are dropped.
+    '''
+
+    # bytes.find is only available on bytes/ bytearray, so a memoryview is copied once:
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+
+    view = memoryview(data)
+    length = len(data)
+    find = data.find
+
+    frames = []
+    start = -1          # index of the first byte (message type) of the current message
+    stuffed = False     # whether the current message contains <esc><esc>
+
+    i = find(ESC_BYTE)
+    while i != -1:
+
+        # <esc> is the last byte - undetermined until more data arrives:
+        if i == length - 1:
+            break
+
+        # <esc><esc> is a stuffed 0x1a within a message, skip both bytes:
+        if data[i + 1] == ESC:
+            stuffed = True
+            i = find(ESC_BYTE, i + 2)
+            continue
+
+        # <esc> followed by a message type - the current message is complete:
+        if start != -1 and i > start:
+            if stuffed:
+                frames.append(data[start:i].replace(STUFFED_ESC, ESC_BYTE))
+            else:
+                frames.append(view[start:i])
+        start = i + 1
+        stuffed = False
+        i = find(ESC_BYTE, start)
+
+    # Save the remainder (with its leading <esc>) for the next reading cycle:
+    if start != -1:
+        remainder = view[start - 1:]
+    elif i == length - 1:
+        # Only a trailing <esc> seen so far - it may start the next message:
+        remainder = view[i:]
+    else:
+        remainder = view[0:0]
+
+    return frames, remainder
+
+
+"""Function to join the remainder of the previous cycle with newly received bytes"""
+def join_remainder(remainder, received):
+    '''
+    args:
+        remainder: memoryview returned by deframe()
+        received: bytes newly received from the socket
+    returns:
+        bytes object to be passed to deframe()
+    '''
+    if len(remainder) == 0:
+        return received
+    return b''.join((remainder, received))
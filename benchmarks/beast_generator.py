@@ -0,0 +1,127 @@
+"""
+Synthetic Beast streams for the benchmarks and the replay server.
+
+Unlike synthetic_stream() of bench_deframer.py (random bytes), messages are built like
+real traffic: a fixed set of aircraft, each with an ICAO address and squawk, sending a
+mix of DF0/4/5/11/17/20/21 and Mode-AC replies with correct parity, GPS MLAT timestamps
+(18 bit seconds, 30 bit nanoseconds) increasing at 'rate' messages per second, and a
+signal level byte. 0x1a bytes therefore appear (and are stuffed) only as often as they
+would in addresses, parity and timestamps of a recorded stream.
+
+usage:
+    python benchmarks/beast_generator.py output.bin [num_messages]
+"""
+# necessary imports:
+import random
+import sys
+
+CRC24_GENERATOR = 0xFFF409
+
+# share of each message kind, roughly as seen by a receiver near an airport:
+MESSAGE_MIX = [
+    ('DF0', 0.08), ('DF4', 0.10), ('DF5', 0.05), ('DF11', 0.20),
+    ('DF17', 0.35), ('DF20', 0.10), ('DF21', 0.05), ('MODE_AC', 0.07),
+]
+
+
+"""Mode-S CRC-24 of a message without its 3 parity bytes"""
+def crc24(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte << 16
+        for _ in range(8):
+            crc = (crc << 1) ^ CRC24_GENERATOR if crc & 0x800000 else crc << 1
+    return crc & 0xFFFFFF
+
+
+"""13 bit identity field of a 4-digit squawk, the layout idcode() of version4_dev.py reads"""
+def identity_field(squawk):
+    a, b, c, d = [int(digit) for digit in '%04d' % squawk]
+    bits = [c & 1, a & 1, c >> 1 & 1, a >> 1 & 1, c >> 2 & 1, a >> 2 & 1, 0,
+            b & 1, d & 1, b >> 1 & 1, d >> 1 & 1, b >> 2 & 1, d >> 2 & 1]
+    field = 0
+    for bit in bits:
+        field = field << 1 | bit
+    return field
+
+
+"""13 bit altitude field in 25 ft steps (Q bit set)"""
+def altitude_field(altitude_ft):
+    n = max(0, min(2047, (altitude_ft + 1000) // 25))
+    # n split around the M (always 0) and Q (always 1) bits:
+    return (n >> 5) << 7 | (n >> 4 & 1) << 5 | 1 << 4 | (n & 0xF)
+
+
+"""Function that builds the Mode-S/ Mode-AC payload of one message"""
+def make_payload(kind, address, squawk, altitude_ft, rng):
+    '''
+    args:
+        kind: one of the names in MESSAGE_MIX
+        address: 24 bit ICAO address
+        squawk: 4-digit squawk (octal digits, e.g. 7700)
+        altitude_ft: barometric altitude
+        rng: random.Random
+    returns: payload bytes - 2 for Mode-AC, 7 or 14 for Mode-S, parity included
+    '''
+    if kind == 'MODE_AC':
+        return identity_field(squawk).to_bytes(2, 'big')
+    if kind == 'DF11':
+        body = bytes([11 << 3 | 5]) + address.to_bytes(3, 'big')
+        return body + crc24(body).to_bytes(3, 'big')
+    if kind == 'DF17':
+        # airborne position (type code 11) with random CPR bits:
+        me = bytes([11 << 3, rng.getrandbits(8), rng.getrandbits(8)]) + bytes(rng.getrandbits(8) for _ in range(4))
+        body = bytes([17 << 3 | 5]) + address.to_bytes(3, 'big') + me
+        return body + crc24(body).to_bytes(3, 'big')
+
+    # replies with the address overlaid on the parity (AP):
+    df = int(kind[2:])
+    field = identity_field(squawk) if df in (5, 21) else altitude_field(altitude_ft)
+    body = bytes([df << 3 | rng.getrandbits(3), rng.getrandbits(8), rng.getrandbits(8) & 0xE0 | field >> 8, field & 0xFF])
+    if df in (20, 21):
+        body += bytes(rng.getrandbits(8) for _ in range(7))   # Comm-B
+    return body + (crc24(body) ^ address).to_bytes(3, 'big')
+
+
+"""Function that generates a list of unstuffed messages, as returned by deframe()"""
+def generate_frames(num_messages, seed=0, num_aircraft=200, rate=2000, start_second=36000):
+    '''
+    args:
+        num_messages: number of messages
+        seed: seed of the random generator
+        num_aircraft: number of distinct aircraft
+        rate: messages per second, sets how fast the timestamps advance
+        start_second: MLAT timestamp (seconds since UTC midnight) of the first message
+    returns: list of bytes, each message type byte, timestamp, signal level and payload
+    '''
+    rng = random.Random(seed)
+    aircraft = [(rng.getrandbits(24), int('%o' % rng.randrange(4096)), rng.randrange(2000, 40000, 100))
+                for _ in range(num_aircraft)]
+    kinds = [kind for kind, _ in MESSAGE_MIX]
+    weights = [weight for _, weight in MESSAGE_MIX]
+    type_byte = {2: 0x31, 7: 0x32, 14: 0x33}
+
+    frames = []
+    t_ns = start_second * 1000000000
+    for kind in rng.choices(kinds, weights, k=num_messages):
+        t_ns += int(rng.expovariate(rate) * 1e9)
+        seconds, nanoseconds = divmod(t_ns, 1000000000)
+        address, squawk, altitude_ft = rng.choice(aircraft)
+        payload = make_payload(kind, address, squawk, altitude_ft, rng)
+        timestamp = ((seconds % 86400) << 30 | nanoseconds).to_bytes(6, 'big')
+        signal = bytes([rng.randrange(0x10, 0x100)])
+        frames.append(bytes([type_byte[len(payload)]]) + timestamp + signal + payload)
+    return frames
+
+
+"""Function that encodes messages as a raw Beast byte stream, <esc> stuffing included"""
+def encode_stream(frames):
+    return b''.join(b'\x1a' + frame.replace(b'\x1a', b'\x1a\x1a') for frame in frames)
+
+
+if __name__ == '__main__':
+    num_messages = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    stream = encode_stream(generate_frames(num_messages))
+    with open(sys.argv[1], 'wb') as f:
+        f.write(stream)
+    print("%s: %d messages, %d bytes" % (sys.argv[1], num_messages, len(stream)))
@@ -0,0 +1,97 @@
+"""
+Benchmark of batch_decoder.decode_batch() against the original per-message loop
+of decoder(), checking that both produce identical output.
+
+usage:
+    python benchmarks/bench_decoder.py [recorded_stream.bin ...]
+"""
+# necessary imports:
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from batch_decoder import decode_batch
+from beast_deframer import deframe, join_remainder
+from bench_deframer import chunks, synthetic_stream
+from version4_dev import df, idcode, num_timestamp
+
+
+"""Original per-message loop body of decoder() in version4_dev.py, localtime omitted"""
+def legacy_decode(completed_msg_list):
+    messages_to_write = []
+    decoder_message_count = 0
+    for message in completed_msg_list:
+        msgtype = message[0]
+        if msgtype == 0x32:
+            payload = ''.join('%02X' % i for i in message[8:15])
+        elif msgtype == 0x33:
+            payload = ''.join('%02X' % i for i in message[8:22])
+        elif msgtype == 0x31:
+            payload = ''.join('%02X' % i for i in message[8:10])
+        else:
+            continue
+        if len(payload) not in [4, 14, 28]:
+            continue
+        time_hex = ''.join('%02X' % i for i in message[1:7])
+        ts = num_timestamp(time_hex)
+        full_message = ''.join('%02X' % i for i in message[:])
+        downlink = df(payload)
+        if (len(payload)==4):
+            messages_to_write.append([full_message, time_hex, ts, None, downlink, payload])
+        elif (downlink in [5, 17, 21]):
+            squawk = idcode(payload)
+            messages_to_write.append([full_message, time_hex, ts, None, downlink, squawk])
+        decoder_message_count = decoder_message_count + 1
+    return messages_to_write, decoder_message_count
+
+
+"""Splits a stream into the batches the main process pipes to the decoder"""
+def batches(stream):
+    remainder = b''
+    out = []
+    for received in chunks(stream):
+        completed_msg_list, remainder = deframe(join_remainder(remainder, received))
+        out.append([bytes(completed_msg) for completed_msg in completed_msg_list])
+    return out
+
+
+def bench(name, func, frame_batches):
+    start = time.perf_counter()
+    results = [func(frame_batch) for frame_batch in frame_batches]
+    elapsed = time.perf_counter() - start
+    count = sum(len(frame_batch) for frame_batch in frame_batches)
+    print("%-8s | %8d frames | %8.3f s | %10.0f frames/s" % (name, count, elapsed, count / elapsed))
+    return elapsed, results
+
+
+"""Compares outputs, ignoring the localtime column"""
+def identical(legacy_results, batch_results):
+    for (legacy_rows, legacy_count), (batch_rows, batch_count) in zip(legacy_results, batch_results):
+        if legacy_count != batch_count or len(legacy_rows) != len(batch_rows):
+            return False
+        for legacy_row, batch_row in zip(legacy_rows, batch_rows):
+            if legacy_row[:3] + legacy_row[4:] != batch_row[:3] + batch_row[4:]:
+                return False
+            if type(legacy_row[2]) is not type(batch_row[2]) or type(legacy_row[4]) is not type(batch_row[4]):
+                return False
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        streams = []
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                streams.append((path, f.read()))
+    else:
+        streams = [('synthetic', synthetic_stream(200000))]
+
+    for name, stream in streams:
+        frame_batches = batches(stream)
+        print("***************")
+        print("%s: %d batches" % (name, len(frame_batches)))
+        legacy_time, legacy_results = bench('legacy', legacy_decode, frame_batches)
+        batch_time, batch_results = bench('batch', decode_batch, frame_batches)
+        print("identical output: %s" % identical(legacy_results, batch_results))
+        print("speedup: %.1fx" % (legacy_time / batch_time))
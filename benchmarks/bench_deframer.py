@@ -0,0 +1,114 @@
+"""
+Benchmark of beast_deframer.deframe() against the original per-byte 0x1a loop
+of the main process.
+
+usage:
+    python benchmarks/bench_deframer.py [recorded_stream.bin ...]
+
+Recorded streams are raw Beast bytes as received from the socket. Without arguments,
+a synthetic stream is generated instead.
+"""
+# necessary imports:
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from beast_deframer import deframe, join_remainder
+
+CHUNK_SIZE = 16384  # same as sock.recv(16384) in version4_dev.py
+
+
+"""Original per-byte loop from the __main__ receive loop of version4_dev.py"""
+def legacy_deframe(buffer, received):
+    buffer.extend(received)
+    completed_msg_list = []
+    completed_msg = []
+    i = 0
+    while i < len(buffer):
+        if (buffer[i] != 0x1a):
+            completed_msg.append(buffer[i])
+        else:
+            if (i == len(buffer) - 1):
+                completed_msg.append(0x1a)
+            elif (buffer[i+1] == 0x1a):
+                completed_msg.append(0x1a)
+                i += 1
+            elif len(completed_msg) > 0:
+                completed_msg_list.append(completed_msg)
+                completed_msg = []
+        i += 1
+    if len(completed_msg) > 0:
+        remainder = []
+        for i, m in enumerate(completed_msg):
+            if (m == 0x1a) and (i < len(completed_msg)-1):
+                remainder.extend([m, m])
+            else:
+                remainder.append(m)
+        buffer = [0x1a] + remainder
+    else:
+        buffer = []
+    return completed_msg_list, buffer
+
+
+"""Generates a synthetic Beast stream of Mode-AC, Mode-S short and long messages"""
+def synthetic_stream(num_messages, seed=0):
+    rng = random.Random(seed)
+    lengths = {0x31: 2, 0x32: 7, 0x33: 14}
+    out = bytearray()
+    for _ in range(num_messages):
+        msgtype = rng.choice((0x31, 0x32, 0x32, 0x33))
+        body = bytes(rng.getrandbits(8) for _ in range(7 + lengths[msgtype]))
+        out += b'\x1a' + bytes([msgtype]) + body.replace(b'\x1a', b'\x1a\x1a')
+    return bytes(out)
+
+
+"""Splits a stream into socket-sized chunks"""
+def chunks(stream, size=CHUNK_SIZE):
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def run_legacy(received_chunks):
+    buffer = []
+    count = 0
+    for received in received_chunks:
+        completed_msg_list, buffer = legacy_deframe(buffer, received)
+        count += len(completed_msg_list)
+    return count
+
+
+def run_deframe(received_chunks):
+    remainder = b''
+    count = 0
+    for received in received_chunks:
+        completed_msg_list, remainder = deframe(join_remainder(remainder, received))
+        count += len(completed_msg_list)
+    return count
+
+
+def bench(name, func, received_chunks, total_bytes):
+    start = time.perf_counter()
+    count = func(received_chunks)
+    elapsed = time.perf_counter() - start
+    print("%-8s | %8d frames | %8.3f s | %10.0f frames/s | %7.1f MB/s"
+          % (name, count, elapsed, count / elapsed, total_bytes / elapsed / 1e6))
+    return elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        streams = []
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                streams.append((path, f.read()))
+    else:
+        streams = [('synthetic', synthetic_stream(200000))]
+
+    for name, stream in streams:
+        received_chunks = chunks(stream)
+        print("***************")
+        print("%s: %d bytes in %d chunks of %d" % (name, len(stream), len(received_chunks), CHUNK_SIZE))
+        legacy_time = bench('legacy', run_legacy, received_chunks, len(stream))
+        deframe_time = bench('deframe', run_deframe, received_chunks, len(stream))
+        print("speedup: %.1fx" % (legacy_time / deframe_time))
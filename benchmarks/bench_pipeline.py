@@ -0,0 +1,166 @@
+"""
+Throughput, latency and memory of each stage of the client, and of the whole client
+from socket to disk, as a baseline to catch regressions.
+
+usage:
+    python benchmarks/bench_pipeline.py [--speed max|N] [--messages N] [recorded_stream.bin ...]
+
+Stages (each run in its own process, so its peak RSS is its own):
+    deframe: socket-sized chunks -> messages, deframe()
+    decode: batches of messages -> rows, decode_batch()
+    write-text/ write-binary: rows/ records -> per-second files, through SecondFileWriter
+    socket-to-disk: replay_server.py -> recv_into -> deframe -> decode -> '.txt' files,
+        latency from the socket read to the write() of the batch's last second
+Latencies are per batch (per chunk for deframe). Without recorded streams, a stream
+from beast_generator.py is used.
+"""
+# necessary imports:
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from batch_decoder import decode_batch
+from beast_deframer import deframe, join_remainder
+from beast_generator import encode_stream, generate_frames
+from bench_deframer import chunks
+from file_writer import SecondFileWriter
+from capture_format import file_header
+from measure import report, run_stage
+from replay_server import serve, time_slices
+from version4_dev import group_binary, group_text
+
+CHUNK_SIZE = 16384
+
+
+"""Stages, each returning (number of messages, list of latencies in s)"""
+def stage_deframe(received_chunks):
+    remainder = b''
+    count = 0
+    latencies = []
+    for received in received_chunks:
+        start = time.perf_counter()
+        completed_msg_list, remainder = deframe(join_remainder(remainder, received))
+        latencies.append(time.perf_counter() - start)
+        count += len(completed_msg_list)
+    return count, latencies
+
+
+def stage_decode(frame_batches):
+    latencies = []
+    for frame_batch in frame_batches:
+        start = time.perf_counter()
+        decode_batch(frame_batch)
+        latencies.append(time.perf_counter() - start)
+    return sum(map(len, frame_batches)), latencies
+
+
+def stage_write(row_batches, binary):
+    writer = SecondFileWriter('.bin', header=file_header) if binary else SecondFileWriter('.txt')
+    latencies = []
+    for rows in row_batches:
+        start = time.perf_counter()
+        if binary:
+            writer.write_batch(group_binary(rows))
+        else:
+            writer.write_batch(group_text(rows)[0])
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    writer.close()
+    latencies[-1] += time.perf_counter() - start
+    return sum(map(len, row_batches)), latencies
+
+
+def stage_socket_to_disk(stream, speed):
+    slices = time_slices(stream)
+    expected = sum(data.count(b'\x1a') - 2 * data.count(b'\x1a\x1a') for _, data in slices)
+    ports = []
+    listening = threading.Event()
+    server = threading.Thread(target=serve, args=(slices,), daemon=True,
+                              kwargs={'port': 0, 'speed': speed, 'max_clients': 1,
+                                      'ready': lambda port: (ports.append(port), listening.set())})
+    server.start()
+    listening.wait()
+    sock = socket.create_connection(('127.0.0.1', ports[0]))
+
+    writer = SecondFileWriter('.txt')
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    remainder = b''
+    count = 0
+    pending = []        # (time read from the socket, seconds of the batch) not yet on disk
+    latencies = []
+    # the last message stays in the remainder, as nothing follows it:
+    while count < expected - 1:
+        received = sock.recv_into(buffer)
+        if received == 0:
+            break
+        arrival = time.perf_counter()
+        completed_msg_list, remainder = deframe(join_remainder(remainder, view[:received]))
+        count += len(completed_msg_list)
+        rows, _ = decode_batch(completed_msg_list)
+        lines_by_second, _ = group_text(rows)
+        writer.write_batch(lines_by_second)
+        if lines_by_second:
+            pending.append((arrival, set(lines_by_second)))
+        # batches whose seconds have all been written out:
+        buffered = writer.buffered_seconds()
+        now = time.perf_counter()
+        latencies.extend(now - t for t, seconds in pending if not seconds & buffered)
+        pending = [(t, seconds) for t, seconds in pending if seconds & buffered]
+
+    # what is left is written by the time thresholds of the writer:
+    while pending:
+        time.sleep(0.01)
+        writer.flush_expired()
+        buffered = writer.buffered_seconds()
+        now = time.perf_counter()
+        latencies.extend(now - t for t, seconds in pending if not seconds & buffered)
+        pending = [(t, seconds) for t, seconds in pending if seconds & buffered]
+    writer.close()
+    sock.close()
+    return count, latencies
+
+
+if __name__ == '__main__':
+    # the stages are closures, run in forked children:
+    multiprocessing.set_start_method('fork')
+
+    parser = argparse.ArgumentParser(description="Benchmark of the client stages")
+    parser.add_argument('streams', nargs='*', help="raw Beast recordings")
+    parser.add_argument('--messages', type=int, default=200000, help="messages of the synthetic stream")
+    parser.add_argument('--speed', default='max', help="replay speed of the socket-to-disk run, N or 'max'")
+    args = parser.parse_args()
+
+    if args.streams:
+        streams = []
+        for path in args.streams:
+            with open(path, 'rb') as f:
+                streams.append((path, f.read()))
+    else:
+        streams = [('synthetic', encode_stream(generate_frames(args.messages)))]
+    speed = None if args.speed == 'max' else float(args.speed)
+
+    for name, stream in streams:
+        # inputs of each stage, from the previous one:
+        received_chunks = chunks(stream, CHUNK_SIZE)
+        frame_batches = []
+        remainder = b''
+        for received in received_chunks:
+            completed_msg_list, remainder = deframe(join_remainder(remainder, received))
+            frame_batches.append([bytes(completed_msg) for completed_msg in completed_msg_list])
+        row_batches = [decode_batch(frame_batch)[0] for frame_batch in frame_batches]
+        record_batches = [decode_batch(frame_batch, 'binary')[0] for frame_batch in frame_batches]
+
+        print("***************")
+        print("%s: %d bytes, %d chunks of %d" % (name, len(stream), len(received_chunks), CHUNK_SIZE))
+        # the stages write their files to a temporary working directory:
+        report('deframe', run_stage(stage_deframe, (received_chunks,)))
+        report('decode', run_stage(stage_decode, (frame_batches,)))
+        report('write-text', run_stage(stage_write, (row_batches, False), temporary_directory=True))
+        report('write-binary', run_stage(stage_write, (record_batches, True), temporary_directory=True))
+        report('socket-to-disk', run_stage(stage_socket_to_disk, (stream, speed), temporary_directory=True))
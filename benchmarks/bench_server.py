@@ -0,0 +1,260 @@
+"""
+Throughput, latency and memory of the server-side stages, as a baseline to catch
+regressions.
+
+usage:
+    python benchmarks/bench_server.py [--aircraft N] [--seconds N] [--stations 3..5]
+
+Synthetic stations (binary capture files of aircraft flying straight lines around the
+sample stations, see beast_generator.py for the messages) are written to a temporary
+master folder. Stages (each run in its own process, so its peak RSS is its own):
+    ingest: IngestService reading all seconds of the folder
+    correlate: Correlator over the ingested seconds
+    solve: solve() of the correlated groups
+    track: TrackTable updates with the fixes
+    file-to-fix: the stations' files are written second by second while ingest ->
+        correlate -> solve -> track runs, latency from the moment a second can be
+        emitted (every station has written the next one) to its fixes
+Latencies are per second.
+"""
+# necessary imports:
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'server-side'))
+sys.path.insert(0, here)
+from beast_generator import make_payload, MESSAGE_MIX
+from measure import report, run_stage
+from capture_format import HEADER, MAGIC, VERSION, RECORD_DTYPE
+from correlator import Correlator
+from ingest import IngestService
+from solver import SPEED_OF_LIGHT, StationPositions, geodetic_to_ecef, solve
+from tracker import TrackTable, group_times, track_keys
+
+# the sample stations, and two more around them:
+STATIONS = [
+    ('CAT 5', 1.3462716387423292, 104.0020775915965),
+    ('station_1', 1.34828568, 103.683036),
+    ('station_2', 1.24632352, 103.842488),
+    ('station_3', 1.44, 103.80),
+    ('station_4', 1.30, 103.95),
+]
+START_SECOND = 36000
+TIMESTAMP_NOISE_NS = 30
+
+
+"""Function that generates the records of every station, by second"""
+def generate_receptions(num_stations, num_aircraft, num_seconds, rate_per_aircraft=5, seed=0):
+    '''
+    returns: list (one per station) of dictionaries of second -> structured array of RECORD_DTYPE
+    '''
+    rng = random.Random(seed)
+    nprng = np.random.default_rng(seed)
+    stations = geodetic_to_ecef(np.array([s[1] for s in STATIONS[:num_stations]]),
+                                np.array([s[2] for s in STATIONS[:num_stations]]), np.zeros(num_stations))
+    start = geodetic_to_ecef(nprng.uniform(1.1, 1.6, num_aircraft), nprng.uniform(103.5, 104.2, num_aircraft),
+                             nprng.uniform(1000, 12000, num_aircraft))
+    velocity = nprng.normal(0, 150, (num_aircraft, 3))
+    identities = [(rng.getrandbits(24), int('%o' % rng.randrange(4096)), rng.randrange(2000, 40000, 100))
+                  for _ in range(num_aircraft)]
+    kinds = [kind for kind, _ in MESSAGE_MIX]
+    weights = [weight for _, weight in MESSAGE_MIX]
+    type_byte = {2: 0x31, 7: 0x32, 14: 0x33}
+
+    receptions = [{} for _ in range(num_stations)]
+    for second in range(START_SECOND, START_SECOND + num_seconds):
+        count = num_aircraft * rate_per_aircraft
+        aircraft = nprng.integers(0, num_aircraft, count)
+        t = second + nprng.uniform(0, 1, count)
+        position = start[aircraft] + velocity[aircraft] * (t - START_SECOND)[:, None]
+        toa = (t * 1e9)[:, None] + np.linalg.norm(position[:, None] - stations, axis=-1) / SPEED_OF_LIGHT * 1e9
+        toa = np.round(toa + nprng.normal(0, TIMESTAMP_NOISE_NS, toa.shape)).astype(np.int64)
+        # each transmission is missed by a random station now and then:
+        heard = nprng.random(toa.shape) > 0.1
+
+        records = [[] for _ in range(num_stations)]
+        for i, kind in enumerate(rng.choices(kinds, weights, k=count)):
+            payload = make_payload(kind, *identities[aircraft[i]], rng)
+            for station in np.flatnonzero(heard[i]):
+                s, ns = divmod(int(toa[i, station]), 1000000000)
+                frame = bytes([type_byte[len(payload)]]) + ((s << 30) | ns).to_bytes(6, 'big') + b'\x80' + payload
+                records[station].append((toa[i, station], frame))
+        for station in range(num_stations):
+            array = np.zeros(len(records[station]), dtype=RECORD_DTYPE)
+            for record, (ts_ns, frame) in zip(array, sorted(records[station])):
+                record['ts_ns'] = ts_ns
+                record['df'] = frame[8] >> 3
+                record['frame_len'] = len(frame)
+                record['frame'][:len(frame)] = np.frombuffer(frame, dtype=np.uint8)
+            # by the second of the receiving station's timestamp, as the clients file them:
+            seconds = array['ts_ns'] // 1000000000
+            for file_second in np.unique(seconds).tolist():
+                part = array[seconds == file_second]
+                existing = receptions[station].get(file_second)
+                receptions[station][file_second] = part if existing is None else np.concatenate((existing, part))
+    return receptions
+
+
+"""Function that creates the station folders and their config files"""
+def make_master_folder(num_stations):
+    master_folder = tempfile.mkdtemp(prefix='bench_server_')
+    for station in range(num_stations):
+        directory = os.path.join(master_folder, 'station_%d' % station)
+        os.makedirs(directory)
+        name, latitude, longitude = STATIONS[station]
+        with open(os.path.join(directory, '0_station_config.yml'), 'w') as f:
+            f.write("Location name: '%s'\nLatitude: %r\nLongitude: %r\nFeed_to_base: true\n" % (name, latitude, longitude))
+    return master_folder
+
+
+def write_second(master_folder, receptions, second):
+    for station, by_second in enumerate(receptions):
+        records = by_second.get(second)
+        if records is None:
+            continue
+        with open(os.path.join(master_folder, 'station_%d' % station, '%d.bin' % second), 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, second) + records.tobytes())
+
+
+"""Stages, each returning (number of items, list of latencies in s)"""
+def stage_ingest(master_folder, num_stations, num_seconds):
+    ingest = IngestService(master_folder, num_stations, history=num_seconds + 1, poll_interval=0.01)
+    batches = []
+    latencies = []
+    start = time.perf_counter()
+    # the last second is only emitted after max_delay, as no station moves on from it:
+    for second, receptions, stations in ingest.batches():
+        latencies.append(time.perf_counter() - start)
+        batches.append((second, receptions, stations))
+        if second >= START_SECOND + num_seconds - 2:
+            break
+        start = time.perf_counter()
+    return sum(len(r) for _, receptions, _ in batches for r in receptions.values()), latencies
+
+
+def stage_correlate(batches, minimum_num_stations):
+    correlator = Correlator(minimum_num_stations)
+    latencies = []
+    count = 0
+    for second, receptions, stations in batches:
+        start = time.perf_counter()
+        correlator.process(second, receptions, stations)
+        latencies.append(time.perf_counter() - start)
+        count += sum(map(len, receptions.values()))
+    return count, latencies
+
+
+def stage_solve(groups_by_second):
+    station_positions = StationPositions()
+    latencies = []
+    for groups in groups_by_second:
+        start = time.perf_counter()
+        solve(groups, station_positions, altitude=altitude_for(groups))
+        latencies.append(time.perf_counter() - start)
+    return sum(map(len, groups_by_second)), latencies
+
+
+def stage_track(groups_by_second, fixes_by_second):
+    tracks = TrackTable()
+    latencies = []
+    for groups, fixes in zip(groups_by_second, fixes_by_second):
+        start = time.perf_counter()
+        keys = track_keys(groups)
+        times = group_times(groups)
+        valid = np.flatnonzero(fixes['valid'])
+        tracks.update(keys[valid], times[valid], fixes['ecef'][valid], fixes['gdop'][valid])
+        tracks.evict()
+        latencies.append(time.perf_counter() - start)
+    return sum(np.count_nonzero(fixes['valid']) for fixes in fixes_by_second), latencies
+
+
+def stage_file_to_fix(receptions, num_stations, minimum_num_stations, num_seconds, interval):
+    master_folder = make_master_folder(num_stations)
+    ready_at = {}   # second -> time it could be emitted
+
+    def write_seconds():
+        for second in range(START_SECOND, START_SECOND + num_seconds):
+            write_second(master_folder, receptions, second)
+            ready_at[second - 1] = time.perf_counter()
+            time.sleep(interval)
+
+    ingest = IngestService(master_folder, minimum_num_stations, poll_interval=0.01)
+    # the folders are watched from the start, then the first second is written:
+    ingest.refresh_stations()
+    ingest.next_second = START_SECOND
+    writer = threading.Thread(target=write_seconds, daemon=True)
+    writer.start()
+
+    correlator = Correlator(minimum_num_stations)
+    station_positions = StationPositions()
+    tracks = TrackTable()
+    latencies = []
+    count = 0
+    for second, second_receptions, stations in ingest.batches():
+        groups = correlator.process(second, second_receptions, stations)
+        fixes = solve(groups, station_positions, altitude=altitude_for(groups))
+        valid = np.flatnonzero(fixes['valid'])
+        tracks.update(track_keys(groups)[valid], group_times(groups)[valid], fixes['ecef'][valid], fixes['gdop'][valid])
+        latencies.append(time.perf_counter() - ready_at[second])
+        count += len(groups)
+        if second >= START_SECOND + num_seconds - 2:
+            break
+    shutil.rmtree(master_folder, ignore_errors=True)
+    return count, latencies
+
+
+def altitude_for(groups):
+    num_stations = np.array([len(group['ts_ns']) for group in groups])
+    return np.where(num_stations == 3, 10000.0, np.nan)
+
+
+if __name__ == '__main__':
+    # the stages are closures, run in forked children:
+    multiprocessing.set_start_method('fork')
+
+    parser = argparse.ArgumentParser(description="Benchmark of the server-side stages")
+    parser.add_argument('--aircraft', type=int, default=200)
+    parser.add_argument('--seconds', type=int, default=20)
+    parser.add_argument('--stations', type=int, default=4, choices=range(3, len(STATIONS) + 1))
+    parser.add_argument('--interval', type=float, default=0.2, help="time between seconds written in file-to-fix (s)")
+    args = parser.parse_args()
+    minimum_num_stations = 3
+
+    receptions = generate_receptions(args.stations, args.aircraft, args.seconds)
+    master_folder = make_master_folder(args.stations)
+    for second in range(START_SECOND, START_SECOND + args.seconds):
+        write_second(master_folder, receptions, second)
+
+    # inputs of each stage, from the previous one:
+    ingest = IngestService(master_folder, args.stations, history=args.seconds + 1, poll_interval=0.01)
+    batches = []
+    for batch in ingest.batches():
+        batches.append(batch)
+        if batch[0] >= START_SECOND + args.seconds - 2:
+            break
+    correlator = Correlator(minimum_num_stations)
+    groups_by_second = [correlator.process(*batch) for batch in batches]
+    station_positions = StationPositions()
+    fixes_by_second = [solve(groups, station_positions, altitude=altitude_for(groups)) for groups in groups_by_second]
+
+    print("***************")
+    print("%d stations, %d aircraft, %d seconds: %d records, %d groups, %d valid fixes"
+          % (args.stations, args.aircraft, args.seconds,
+             sum(len(r) for _, receptions_, _ in batches for r in receptions_.values()),
+             sum(map(len, groups_by_second)), sum(np.count_nonzero(f['valid']) for f in fixes_by_second)))
+    report('ingest', run_stage(stage_ingest, (master_folder, args.stations, args.seconds)), 'records')
+    report('correlate', run_stage(stage_correlate, (batches, minimum_num_stations)), 'records')
+    report('solve', run_stage(stage_solve, (groups_by_second,)), 'groups')
+    report('track', run_stage(stage_track, (groups_by_second, fixes_by_second)), 'fixes')
+    report('file-to-fix', run_stage(stage_file_to_fix, (receptions, args.stations, minimum_num_stations,
+                                                        args.seconds, args.interval)), 'groups')
+    shutil.rmtree(master_folder, ignore_errors=True)
@@ -0,0 +1,113 @@
+"""
+Cold start of the client: time from starting version4_dev.py to the first per-second
+file with data on disk, for each way of starting the child processes. Clients are
+restarted often on small boxes, and every frame received before the first write is
+a frame at risk.
+
+usage:
+    python benchmarks/bench_startup.py [--runs N] [--target MS] [--storage-format text|binary] [--config-file]
+
+replay_server.py serves a synthetic stream in real time. Each run starts the client in
+a fresh directory, with its own process group, and interrupts it once a file appears.
+'import' is the time to import version4_dev in a new interpreter, the part of the start
+that happens before anything connects.
+"""
+# necessary imports:
+import argparse
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..'))
+from beast_generator import encode_stream, generate_frames
+from measure import percentile
+from replay_server import serve, time_slices
+
+CLIENT = os.path.join(here, '..', 'version4_dev.py')
+CAPTURE_FILE = re.compile(r'^\d+\.(txt|bin)$')
+BINARY_HEADER_SIZE = 16
+
+
+"""Function that starts the client once and returns the seconds until its first file has data"""
+def cold_start(port, start_method, storage_format, config_file, timeout=10.0):
+    directory = tempfile.mkdtemp(prefix='bench_startup_')
+    arguments = [sys.executable, CLIENT]
+    if config_file:
+        path = os.path.join(directory, 'client_config.yml')
+        with open(path, 'w') as f:
+            f.write("feed_addresses: [[127.0.0.1, %d]]\nstorage_format: %s\nstart_method: %s\nmetrics_port: null\n"
+                    % (port, storage_format, start_method))
+        arguments += ['--config', path]
+    else:
+        arguments += ['--feed', '127.0.0.1:%d' % port, '--storage-format', storage_format,
+                      '--start-method', start_method, '--metrics-port', '0']
+    minimum_size = BINARY_HEADER_SIZE if storage_format == 'binary' else 0
+
+    start = time.perf_counter()
+    client = subprocess.Popen(arguments, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              start_new_session=True)
+    elapsed = None
+    try:
+        while elapsed is None and time.perf_counter() - start < timeout:
+            for entry in os.scandir(directory):
+                if CAPTURE_FILE.match(entry.name) and entry.stat().st_size > minimum_size:
+                    elapsed = time.perf_counter() - start
+                    break
+            else:
+                time.sleep(0.001)
+    finally:
+        # Ctrl-C to the client and its children, as from a terminal:
+        os.killpg(client.pid, signal.SIGINT)
+        try:
+            client.wait(timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(client.pid, signal.SIGKILL)
+            client.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    return elapsed
+
+
+"""Function that returns the seconds to import the client in a new interpreter"""
+def import_time():
+    code = "import time; start = time.perf_counter(); import version4_dev; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(here, '..'), capture_output=True, text=True)
+    return float(output.stdout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the client")
+    parser.add_argument('--runs', type=int, default=10, help="starts per start method")
+    parser.add_argument('--target', type=float, default=200.0, help="target time to the first file (ms)")
+    parser.add_argument('--storage-format', default='text', choices=('text', 'binary'))
+    parser.add_argument('--config-file', action='store_true', help="pass the settings in a YAML file")
+    args = parser.parse_args()
+
+    slices = time_slices(encode_stream(generate_frames(200000)))
+    listening = threading.Event()
+    ports = []
+    def ready(port):
+        ports.append(port)
+        listening.set()
+    threading.Thread(target=serve, args=(slices, '127.0.0.1', 0, 1.0, True, None, ready, True), daemon=True).start()
+    listening.wait()
+
+    imports = [import_time() for _ in range(args.runs)]
+    print("%-10s | p50 %7.1f ms | max %7.1f ms" % ('import', percentile(imports, 50) * 1e3, max(imports) * 1e3))
+    for start_method in ('fork', 'forkserver', 'spawn'):
+        times = [cold_start(ports[0], start_method, args.storage_format, args.config_file) for _ in range(args.runs)]
+        failed = times.count(None)
+        times = [t for t in times if t is not None]
+        if not times:
+            print("%-10s | no file written" % start_method)
+            continue
+        p50 = percentile(times, 50) * 1e3
+        print("%-10s | p50 %7.1f ms | max %7.1f ms | %s the %.0f ms target%s"
+              % (start_method, p50, max(times) * 1e3, 'within' if p50 <= args.target else 'OVER', args.target,
+                 " | %d runs without a file" % failed if failed else ""))
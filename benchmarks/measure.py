@@ -0,0 +1,79 @@
+"""
+Measurements shared by the benchmarks: throughput, latency percentiles and peak RSS of
+a stage run in its own process.
+"""
+# necessary imports:
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:     # not on Windows
+    resource = None
+
+
+"""Current resident set size (MB), None where /proc is not available"""
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+"""Peak resident set size of this process (MB)"""
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+"""Runs a stage in a child process, so its peak RSS is its own"""
+def run_stage(stage, args, temporary_directory=False):
+    '''
+    args:
+        stage: function returning (number of items, list of latencies in s)
+        args: arguments of the stage
+        temporary_directory: run the stage in a new temporary working directory
+    returns: (number of items, elapsed s, latencies, RSS at the start (MB), peak RSS (MB))
+    Stages may be closures, so children are forked (see set_start_method()).
+    '''
+    def child(conn):
+        if temporary_directory:
+            os.chdir(tempfile.mkdtemp(prefix='bench_'))
+        rss_before = current_rss()
+        start = time.perf_counter()
+        count, latencies = stage(*args)
+        elapsed = time.perf_counter() - start
+        conn.send((count, elapsed, latencies, rss_before, peak_rss()))
+        conn.close()
+
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=child, args=(sender,))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+"""Prints one line of results of run_stage()"""
+def report(name, result, unit='frames'):
+    count, elapsed, latencies, rss_before, rss_peak = result
+    # a forked child starts out with the RSS of the parent:
+    rss = "%7.1f MB" % rss_peak if rss_peak is not None else "      n/a"
+    if rss_before is not None:
+        rss += " (start %.1f MB)" % rss_before
+    print("%-14s | %8d %-7s | %8.3f s | %10.0f %s/s | p50 %8.3f ms | p99 %8.3f ms | peak RSS %s"
+          % (name, count, unit, elapsed, count / elapsed, unit, percentile(latencies, 50) * 1e3,
+             percentile(latencies, 99) * 1e3, rss))
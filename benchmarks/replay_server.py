@@ -0,0 +1,148 @@
+"""
+Replays recorded Beast streams from a local TCP socket, standing in for the receiver
+the client connects to (see feed_addresses in version4_dev.py).
+
+usage:
+    python benchmarks/replay_server.py [--port 30005] [--speed 1|N|max] [--loop] [recorded_stream.bin ...]
+
+Recorded streams are raw Beast bytes as received from the receiver, e.g. captured with
+'nc <receiver> 30005 > recorded_stream.bin'. Without files, a stream from
+beast_generator.py is served. At a speed of 1 (or N), messages are sent when (N times
+faster than) their MLAT timestamps say they were received; 'max' sends as fast as the
+client reads. Every client that connects gets the whole stream from the start.
+"""
+# necessary imports:
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from beast_deframer import deframe
+from beast_generator import encode_stream, generate_frames
+
+SLICE_NS = 10000000     # messages within 10 ms of MLAT time are sent together
+
+
+"""Function to read the MLAT timestamp of a message (ns since UTC midnight)"""
+def frame_time_ns(frame):
+    timestamp = int.from_bytes(frame[1:7], 'big')
+    return (timestamp >> 30) * 1000000000 + (timestamp & 0x3FFFFFFF)
+
+
+"""Function that splits a stream into (MLAT time, bytes) slices to be sent together"""
+def time_slices(stream):
+    '''
+    args: raw Beast stream
+    returns: list of (time of the slice relative to the first message (ns), stuffed bytes)
+    Bytes before the first message boundary are dropped, as the client would drop them.
+    A timestamp going backwards (midnight, receiver restart) does not add a delay.
+    '''
+    # the start of another message completes the last one:
+    frames, _ = deframe(stream + b'\x1a\x31')
+    slices = []
+    current = []
+    elapsed = 0         # MLAT time since the first message, only ever increasing
+    slice_start = 0
+    previous = None
+    for frame in frames:
+        frame = bytes(frame)
+        t_ns = frame_time_ns(frame)
+        if previous is not None and t_ns > previous:
+            elapsed += t_ns - previous
+        previous = t_ns
+        if current and elapsed - slice_start >= SLICE_NS:
+            slices.append((slice_start, encode_stream(current)))
+            current = []
+            slice_start = elapsed
+        current.append(frame)
+    if current:
+        slices.append((slice_start, encode_stream(current)))
+    return slices
+
+
+"""Function that replays the stream to one client"""
+def serve_client(conn, slices, speed, loop):
+    '''
+    args:
+        conn: socket of the connected client
+        slices: see time_slices()
+        speed: replay speed, or None for as fast as possible
+        loop: start over at the end of the stream instead of closing the connection
+    '''
+    try:
+        while True:
+            start = time.monotonic()
+            for t_ns, data in slices:
+                if speed is not None:
+                    delay = start + t_ns * 1e-9 / speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                conn.sendall(data)
+            if not loop:
+                break
+    except OSError:
+        pass    # client disconnected
+    finally:
+        conn.close()
+
+
+"""Function that accepts clients until interrupted, or until 'max_clients' have been served"""
+def serve(slices, host='127.0.0.1', port=30005, speed=None, loop=False, max_clients=None, ready=None, quiet=False):
+    '''
+    args:
+        slices: see time_slices()
+        host, port: address to listen on, port 0 picks a free port
+        speed, loop: see serve_client()
+        max_clients: stop accepting after this many clients
+        ready: optional callable, called with the port once listening
+        quiet: do not print the clients served
+    '''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(4)
+    if ready is not None:
+        ready(server.getsockname()[1])
+    clients = []
+    try:
+        while max_clients is None or len(clients) < max_clients:
+            conn, address = server.accept()
+            if not quiet:
+                print("Replaying to %s:%d" % address)
+            client = threading.Thread(target=serve_client, args=(conn, slices, speed, loop), daemon=True)
+            client.start()
+            clients.append(client)
+        for client in clients:
+            client.join()
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded Beast streams over TCP")
+    parser.add_argument('streams', nargs='*', help="raw Beast recordings, served one after the other")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=30005)
+    parser.add_argument('--speed', default='1', help="1 for real time, N for N times faster, 'max' for no delays")
+    parser.add_argument('--loop', action='store_true', help="repeat the stream until the client disconnects")
+    parser.add_argument('--messages', type=int, default=100000, help="messages of the synthetic stream")
+    args = parser.parse_args()
+
+    if args.streams:
+        stream = b''
+        for path in args.streams:
+            with open(path, 'rb') as f:
+                stream += f.read()
+    else:
+        stream = encode_stream(generate_frames(args.messages))
+    slices = time_slices(stream)
+    speed = None if args.speed == 'max' else float(args.speed)
+    print("Serving %d bytes (%.1f s of MLAT time) on %s:%d at %s speed"
+          % (len(stream), slices[-1][0] * 1e-9 if slices else 0, args.host, args.port, args.speed))
+    try:
+        serve(slices, args.host, args.port, speed, args.loop)
+    except KeyboardInterrupt:
+        pass
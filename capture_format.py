@@ -0,0 +1,123 @@
+"""Import required libraries"""
+import os
+import struct
+import numpy as np
+from batch_decoder import MAX_FRAME_LEN, pack_row, unpack_row
+
+
+"""
+Binary per-second capture file, '<second>.bin', written next to (or instead of) '<second>.txt':
+    header: 16 bytes, see HEADER
+    records: fixed width, see RECORD_DTYPE, in the order they were received
+The same layout is read back on the server side by server-side/capture_format.py.
+"""
+MAGIC = b'MLAT'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQ')    # magic, version, record size, second of the file
+
+RECORD_DTYPE = np.dtype({
+    'names': ['ts_ns', 'rx_time', 'squawk', 'df', 'frame_len', 'frame', 'reserved'],
+    'formats': ['<i8', '<f8', '<u2', 'u1', 'u1', ('u1', MAX_FRAME_LEN), ('u1', 6)],
+    'offsets': [0, 8, 16, 18, 19, 20, 42],
+    'itemsize': 48,
+})
+'''
+    ts_ns: MLAT timestamp in integer nanoseconds, seconds * 10**9 + nanoseconds (exact)
+    rx_time: receive time, seconds since UTC midnight ('localtime' of the text files)
+    squawk: Mode-S identity as the 4-digit decimal number (e.g. 7700),
+        or the raw 2 byte payload for Mode-AC
+    df: downlink format (as in the text files, garbage for Mode-AC)
+    frame_len: number of valid bytes in 'frame'
+    frame: the message as received: type, 6 byte timestamp, signal level, payload
+    reserved: zero, pads the record to 48 bytes
+'''
+
+
+"""Function that builds the binary records of a decoded batch from the decoder's own fields"""
+def fields_to_records(packed, lengths, fields, keep, localtime):
+    '''
+    args:
+        packed, lengths: as returned by batch_decoder.pack_frames()
+        fields: as returned by batch_decoder.decode_fields(), None for an empty batch
+        keep: indexes of the messages to write, in order
+        localtime: receive time of the batch, seconds since UTC midnight
+    returns:
+        structured array of RECORD_DTYPE, zeroed first so 'reserved' and the bytes of
+        'frame' past frame_len are written to disk as zeros
+    '''
+    records = np.zeros(len(keep), dtype=RECORD_DTYPE)
+    if len(keep) == 0:
+        return records
+    packed = packed[keep]
+    records['ts_ns'] = fields['seconds'][keep] * 1000000000 + fields['nanoseconds'][keep]
+    records['rx_time'] = localtime
+    records['squawk'] = np.where(fields['mode_ac'][keep],
+                                 (packed[:, 8].astype(np.uint16) << 8) | packed[:, 9],
+                                 fields['squawk'][keep])
+    records['df'] = fields['downlink'][keep]
+    records['frame_len'] = np.minimum(lengths[keep], MAX_FRAME_LEN)
+    records['frame'] = packed
+    return records
+
+
+"""Function that returns the (second, records) groups of a batch of records, for the per-second files"""
+def records_by_second(records):
+    '''
+    args: structured array of RECORD_DTYPE
+    returns: dictionary of second -> records of that second, in order. The second is the
+        MLAT second, the same as int(ts) of the text files
+    '''
+    seconds = records['ts_ns'] // 1000000000
+    return {second: records[seconds == second] for second in dict.fromkeys(seconds.tolist())}
+
+
+"""Functions to carry records through the shared memory ring, one slot per message"""
+def record_bytes(record):
+    return record.tobytes()
+def pack_row_record(item):
+    '''
+    args: (message in list form, its record), for storage_format 'both'
+    returns: bytes of batch_decoder.pack_row(), followed by the record
+    '''
+    message, record = item
+    return pack_row(message) + record.tobytes()
+def unpack_row_record(data):
+    """Inverse of pack_row_record(), with the record as bytes"""
+    return unpack_row(data[:-RECORD_DTYPE.itemsize]), data[-RECORD_DTYPE.itemsize:]
+
+
+"""Function that returns the header of a new binary file"""
+def file_header(second):
+    return HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, second)
+
+
+"""Function that appends records to the binary file of one second"""
+def write_records(file, second, records):
+    '''
+    args:
+        file: file object opened in binary append mode
+        second: integer second the file is named after (written in a new file's header)
+        records: structured array of RECORD_DTYPE
+    '''
+    if file.tell() == 0:
+        file.write(file_header(second))
+    file.write(records.tobytes())
+
+
+"""Function that memory-maps a binary capture file"""
+def read_capture(path):
+    '''
+    args: path of a '<second>.bin' file
+    returns: (second, records) - records is a read-only structured array of RECORD_DTYPE
+        backed by the file, so nothing is parsed or copied until it is used
+    '''
+    with open(path, 'rb') as f:
+        magic, version, record_size, second = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError("%s is not a version %d capture file" % (path, VERSION))
+
+    # Ignore a partially written last record:
+    count = (os.path.getsize(path) - HEADER.size) // record_size
+    if count == 0:
+        return second, np.zeros(0, dtype=RECORD_DTYPE)
+    return second, np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
@@ -0,0 +1,125 @@
+"""Import required libraries"""
+import argparse
+from beast_deframer import WANTED_DF
+
+
+"""Default settings of the client, each can be set in the config file or on the command line"""
+DEFAULTS = {
+    # Beast/ Radarcape TCP feeds as [host, port], e.g. one per receiver or output port.
+    # All feeds go through the same decoders into the same per-second files:
+    'feed_addresses': [],
+    # Transport between processes - 'pipe': multiprocessing.Pipe, 'shm': shared memory rings
+    'transport': 'pipe',
+    # Number of decoder worker processes, batches are sharded by sequence number:
+    'num_decoders': 1,
+    # Interval for printing per-decoder queue depth and throughput (s):
+    'stats_interval': 60,
+    # Per-second files - 'text': <second>.txt, 'binary': <second>.bin, or 'both':
+    'storage_format': 'text',
+    # Size of the receive buffer of each feed (bytes) at first, it doubles up to max_recv_size
+    # while reads come back full (see feed_receiver.py):
+    'recv_size': 16384,
+    'max_recv_size': 262144,
+    # Kernel receive buffer (SO_RCVBUF) of each connection (bytes), None to leave it to the
+    # kernel's autotuning. A size set here doubles while the client falls behind:
+    'rcvbuf_size': None,
+    # Wait this long (s) after a small read to collect what else arrives, 0 to hand on every read:
+    'coalesce_delay': 0.0,
+    # Receiver filter, messages are dropped before they are sent to the decoders (see frame_filter.py).
+    # Mode-S downlink formats to keep (None for all), Mode-AC, ICAO addresses to keep (None for all,
+    # quoted hexadecimal strings, e.g. ['76CD01', '400123']) and minimum signal level byte (0-255):
+    'filter_downlink_formats': list(WANTED_DF),
+    'filter_mode_ac': True,
+    'filter_icao': None,
+    'filter_min_signal': 0,
+    # Local port of the Prometheus metrics endpoint (http://127.0.0.1:<port>/metrics), None to disable:
+    'metrics_port': 9108,
+    # Folder of the archive of the raw Beast streams, None to not archive them (see raw_archive.py).
+    # Codec 'zstd', 'lz4' or 'zlib' (None for the best installed), and the size (bytes) beyond
+    # which the oldest hours are deleted (None to keep everything). It is checked as the archive
+    # grows, but the hours being written are kept, so it can be exceeded by up to an hour per feed:
+    'raw_archive_path': None,
+    'raw_archive_codec': None,
+    'raw_archive_retention_bytes': None,
+    # How the child processes are started - 'fork', 'forkserver' (a server process that has
+    # imported the decoding modules forks them, see version4_dev.py) or 'spawn', None for
+    # the platform default:
+    'start_method': None,
+}
+
+
+"""Function to read a YAML config file, e.g. 'client_config.yml'"""
+def load_config(path):
+    '''
+    args: path of a file with any of the DEFAULTS settings, e.g.
+        feed_addresses: [[192.168.1.20, 30005]]
+        storage_format: binary
+    returns: dictionary of the settings in the file
+    '''
+    # Imported here, so the client only pays for it when a config file is used:
+    import yaml
+    with open(path, 'r') as data:
+        settings = yaml.safe_load(data) or {}
+    unknown = sorted(set(settings) - set(DEFAULTS))
+    if unknown:
+        raise ValueError("Unknown settings in %s: %s" %(path, ', '.join(unknown)))
+    return settings
+
+
+"""Function to parse 'host:port' of the --feed option"""
+def feed_address(value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected host:port, got %r" % value)
+    return [host, int(port)]
+
+
+"""Function that returns the settings of the client: defaults, then the config file, then the command line"""
+def parse_args(argv=None):
+    '''
+    args: command line arguments, sys.argv[1:] by default
+    returns: dictionary with every setting of DEFAULTS, see normalise()
+    '''
+    parser = argparse.ArgumentParser(description="Capture Beast feeds into per-second files for multilateration")
+    parser.add_argument('--config', help="YAML file with the settings, see client_config.py")
+    parser.add_argument('--feed', action='append', type=feed_address, help="host:port of a feed, can be repeated")
+    parser.add_argument('--transport', choices=('pipe', 'shm'))
+    parser.add_argument('--decoders', type=int, dest='num_decoders')
+    parser.add_argument('--storage-format', choices=('text', 'binary', 'both'))
+    parser.add_argument('--start-method', choices=('fork', 'forkserver', 'spawn'))
+    parser.add_argument('--metrics-port', type=int, help="0 to disable the metrics endpoint")
+    args = parser.parse_args(argv)
+
+    config = dict(DEFAULTS)
+    if args.config is not None:
+        config.update(load_config(args.config))
+    if args.feed:
+        config['feed_addresses'] = args.feed
+    for setting in ('transport', 'num_decoders', 'storage_format', 'start_method', 'metrics_port'):
+        if getattr(args, setting) is not None:
+            config[setting] = getattr(args, setting)
+    return normalise(config)
+
+
+"""Function that converts the settings to the types the client uses"""
+def normalise(config):
+    '''
+    args: dictionary of settings, as read from YAML
+    returns: the same settings with feed_addresses as (host, port) tuples, the filter
+        settings as tuples/ sets of ints and metrics_port 0 as None
+    '''
+    config = dict(config)
+    config['feed_addresses'] = [(str(host), int(port)) for host, port in config['feed_addresses']]
+    if config['filter_downlink_formats'] is not None:
+        config['filter_downlink_formats'] = tuple(int(df) for df in config['filter_downlink_formats'])
+    if config['filter_icao'] is not None:
+        # ICAO addresses as hexadecimal strings only - YAML reads an unquoted 400123 as a
+        # decimal int, 040123 as octal and 0x400123 as hexadecimal:
+        numbers = [address for address in config['filter_icao'] if not isinstance(address, str)]
+        if numbers:
+            raise ValueError("filter_icao addresses must be quoted hexadecimal strings, e.g. '400123', got %s"
+                             % ', '.join(repr(address) for address in numbers))
+        config['filter_icao'] = {int(address, 16) for address in config['filter_icao']}
+    if not config['metrics_port']:
+        config['metrics_port'] = None
+    return config
@@ -0,0 +1,214 @@
+"""Import required libraries"""
+import queue
+import threading
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+"""Per-worker counters shared between the parent, the decoder workers and the endpoint"""
+class PoolStats:
+    '''
+    One shared int64 array without a lock: every counter has exactly one writer.
+        batches_sent: batches sharded to the worker (written by the parent)
+        batches_done: batches decoded by the worker (written by the worker)
+        frames_done: messages decoded by the worker (written by the worker)
+    '''
+    FIELDS = ('batches_sent', 'batches_done', 'frames_done')
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.counters = multiprocessing.Array('q', num_workers * len(self.FIELDS), lock=False)
+        self.last_time = time.monotonic()
+        self.last_frames = [0] * num_workers
+
+    def add(self, worker, field, value=1):
+        self.counters[worker * len(self.FIELDS) + self.FIELDS.index(field)] += value
+
+    def get(self, worker, field):
+        return self.counters[worker * len(self.FIELDS) + self.FIELDS.index(field)]
+
+    def snapshot(self):
+        '''
+        returns: list with one dictionary per worker: queue depth (batches sent but not
+            yet decoded), total batches/ messages decoded and messages/s since the
+            previous snapshot
+        '''
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        workers = []
+        for worker in range(self.num_workers):
+            frames_done = self.get(worker, 'frames_done')
+            workers.append({
+                'worker': worker,
+                'queue_depth': self.get(worker, 'batches_sent') - self.get(worker, 'batches_done'),
+                'batches_done': self.get(worker, 'batches_done'),
+                'frames_done': frames_done,
+                'frames_per_s': (frames_done - self.last_frames[worker]) / elapsed,
+            })
+            self.last_frames[worker] = frames_done
+        self.last_time = now
+        return workers
+
+    def report(self):
+        """Formats snapshot() for printing, one line per worker"""
+        lines = []
+        for w in self.snapshot():
+            lines.append("Decoder %d | queue depth: %d | batches: %d | messages: %d | %.0f messages/s"
+                         % (w['worker'], w['queue_depth'], w['batches_done'], w['frames_done'], w['frames_per_s']))
+        return lines
+
+
+"""Reorder stage that puts batches from several decoder workers back in sequence order"""
+class ReorderBuffer:
+    '''
+    args:
+        max_pending: maximum number of out-of-order batches held back
+        gap_timeout: time to wait for a missing batch before skipping it (s)
+
+    A batch can go missing when a transport drops it, so the buffer never waits for a
+    sequence number forever: after 'gap_timeout', or once 'max_pending' later batches
+    are held back, it skips ahead. A skipped batch arriving later is released straight
+    away rather than lost.
+    '''
+
+    def __init__(self, max_pending=256, gap_timeout=1.0):
+        self.max_pending = max_pending
+        self.gap_timeout = gap_timeout
+        self.next_seq = 0
+        self.pending = {}
+        self.gap_since = None
+        self.skipped = 0
+
+    def push(self, seq, items):
+        '''
+        returns: list of batches (item lists) that can be written now, in order
+        '''
+        if seq < self.next_seq:
+            return [items]
+        self.pending[seq] = items
+        return self.release()
+
+    def release(self):
+        """Releases in-order batches, skipping a gap that has been open too long"""
+        ready = []
+        while self.pending:
+            if self.next_seq in self.pending:
+                ready.append(self.pending.pop(self.next_seq))
+                self.next_seq += 1
+                self.gap_since = None
+                continue
+            now = time.monotonic()
+            if self.gap_since is None:
+                self.gap_since = now
+            if len(self.pending) > self.max_pending or now - self.gap_since > self.gap_timeout:
+                oldest = min(self.pending)
+                self.skipped += oldest - self.next_seq
+                self.next_seq = oldest
+                continue
+            break
+        return ready
+
+
+"""Function that waits until at least one of the inputs has a batch ready"""
+def wait_inputs(inputs, timeout):
+    '''
+    args:
+        inputs: list of pipe Connections or ShmRings
+        timeout: maximum time to wait (s)
+    returns: list of inputs ready to recv()
+    '''
+    if hasattr(inputs[0], 'fileno'):
+        return wait(inputs, timeout)
+    deadline = time.monotonic() + timeout
+    while True:
+        ready = [ring for ring in inputs if ring.poll()]
+        if ready or time.monotonic() > deadline:
+            return ready
+        time.sleep(0.0002)
+
+
+"""Sender that shards batches to the decoder workers on a thread of its own"""
+class Dispatcher:
+    '''
+    dispatch() is called by the receiver's event loop with the messages of every read; it
+    only queues them, so a full pipe or ring stalls this thread rather than every feed.
+    The thread numbers the batches in the order they were queued and sends them to the
+    workers in turn. If it falls 'max_pending' batches behind, batches are dropped and
+    counted (batches_dropped, frames_dropped) rather than stalling the receiver.
+    Sequence numbers are given out by the thread, so a dropped batch leaves no gap for
+    the endpoint's ReorderBuffer to wait out.
+
+    args:
+        ends: the parent end of each worker's transport, pipe Connections or ShmRings
+        prepare: called with the messages of a batch, returns what is sent, e.g. copies
+            of the memoryview slices for a pipe
+        pool_stats: PoolStats, batches_sent is written by the thread
+        process_metrics: ProcessMetrics of the receiver - frames_dispatched and
+            send_dropped_frames are written by the thread, queue_dropped_frames by
+            dispatch(), so every counter still has one writer
+        max_pending: see above
+    '''
+
+    def __init__(self, ends, prepare, pool_stats, process_metrics, max_pending=256):
+        self.ends = ends
+        self.prepare = prepare
+        self.pool_stats = pool_stats
+        self.process_metrics = process_metrics
+        self.pending = queue.Queue(max_pending)
+        self.seq = 0                    # sequence number of the next batch sent, written by the thread only
+        self.batches_dropped = 0
+        self.frames_dropped = 0
+        self.send_errors = 0            # written by the thread, see new_errors()
+        self.errors_reported = 0
+        self.thread = threading.Thread(target=self._run, name='dispatcher', daemon=True)
+        self.thread.start()
+
+    def dispatch(self, frames, arrival):
+        '''
+        args:
+            frames: non-empty list of complete messages, see deframe()
+            arrival: time.monotonic() of the socket read
+        '''
+        try:
+            self.pending.put_nowait((frames, arrival))
+        except queue.Full:
+            self.batches_dropped = self.batches_dropped + 1
+            self.frames_dropped = self.frames_dropped + len(frames)
+            self.process_metrics.add('queue_dropped_frames', len(frames))
+
+    def new_errors(self):
+        """Number of failed sends since the last call, for errorHandler() in the caller's thread"""
+        errors = self.send_errors - self.errors_reported
+        self.errors_reported = self.errors_reported + errors
+        return errors
+
+    @property
+    def depth(self):
+        """Number of batches queued and not yet sent"""
+        return self.pending.qsize()
+
+    def close(self, timeout=1.0):
+        """Sends what is queued, unless the workers stop taking batches for 'timeout' seconds"""
+        try:
+            self.pending.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            frames, arrival = item
+            worker = self.seq % len(self.ends)
+            try:
+                # The arrival time travels with the batch, for the endpoint's latency:
+                self.ends[worker].send((self.seq, arrival, self.prepare(frames)))
+                self.pool_stats.add(worker, 'batches_sent')
+                self.process_metrics.add('frames_dispatched', len(frames))
+            except Exception:
+                self.send_errors = self.send_errors + 1
+                self.process_metrics.add('send_dropped_frames', len(frames))
+            self.seq = self.seq + 1
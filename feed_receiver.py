@@ -0,0 +1,283 @@
+"""Import required libraries"""
+import asyncio
+import socket
+import time
+from datetime import datetime
+from beast_deframer import deframe, join_remainder
+
+
+"""Receiver settings"""
+RECV_SIZE = 16384       # bytes read from a socket at a time, at first
+MAX_RECV_SIZE = 262144  # the read size doubles up to this while reads come back full
+MAX_RCVBUF_SIZE = 4194304   # an SO_RCVBUF set by the client doubles up to this, see adapt()
+COALESCE_BYTES = 1024   # reads smaller than this wait for more data when coalescing
+CONNECT_TIMEOUT = 10    # seconds to establish a connection before it is retried
+INITIAL_BACKOFF = 0.5   # seconds before the first retry of a failing feed
+MAX_BACKOFF = 30        # the retry delay doubles up to this many seconds
+GAP_INTERVALS = 50      # a timestamp gap of this many mean message intervals is an overrun...
+MIN_GAP_NS = 50000000   # ...if it is also longer than this (ns)
+RATE_WINDOW_NS = 1000000000     # the message rate is measured over this much MLAT time (ns)
+
+
+"""State of one Beast/ Radarcape TCP feed"""
+class Feed:
+    '''
+    args:
+        host: IP address or hostname of the receiver (str)
+        port: port number of its Beast output (int)
+        name: label used in prints, 'host:port' by default
+        recv_size: initial size of the receive buffer, see adapt()
+        max_recv_size: largest receive buffer
+        rcvbuf_size: kernel receive buffer (SO_RCVBUF) set before connecting, None to leave
+            it to the kernel (on Linux, TCP autotuning - usually the better choice)
+        coalesce_delay: after a read of less than COALESCE_BYTES, wait this long (s) and
+            read what else has arrived, so a quiet feed is not handled a message at a time.
+            0 to hand on every read at once
+    '''
+    def __init__(self, host, port, name=None, recv_size=RECV_SIZE, max_recv_size=MAX_RECV_SIZE, rcvbuf_size=None,
+                 coalesce_delay=0.0):
+        self.host = host
+        self.port = port
+        self.name = name if name is not None else "%s:%s" % (host, port)
+        self.max_recv_size = max(max_recv_size, recv_size)
+        self.rcvbuf_size = rcvbuf_size
+        self.coalesce_delay = coalesce_delay
+        self.pool = {}                          # size -> bytearray, every receive buffer used so far
+        self.set_recv_size(recv_size)
+        self.remainder = b''                    # partial message carried over to the next read
+        self.backoff = 0                        # delay before the next connection attempt (s)
+        self.message_count = 0                  # complete messages received
+        self.bytes_received = 0
+        self.min_margin = recv_size             # minimum unused space of the receive buffer
+        self.reconnects = 0
+        self.reads = 0
+        self.full_reads = 0                     # reads that filled the receive buffer
+        self.rcvbuf = None                      # SO_RCVBUF in effect, as reported by the kernel
+        # Overrun detection, see check_gaps():
+        self.last_timestamp = None              # MLAT timestamp of the last message, raw 48 bits
+        self.rate = 0.0                         # messages per second of MLAT time
+        self.rate_start = None                  # (timestamp, message count) the rate is measured from
+        self.overruns = 0                       # timestamp gaps taken for lost messages
+        self.lost_messages = 0                  # messages estimated lost in them
+
+    def set_recv_size(self, size):
+        '''Switches to the receive buffer of 'size' bytes, reused by every read (see receive_feed())'''
+        if size not in self.pool:
+            self.pool[size] = bytearray(size)
+        self.buffer = self.pool[size]
+        self.view = memoryview(self.buffer)
+
+
+"""Function that returns the next retry delay of a failing feed"""
+def next_backoff(backoff):
+    return min(max(backoff * 2, INITIAL_BACKOFF), MAX_BACKOFF)
+
+
+"""Coroutine that connects to a feed, retrying with exponential backoff"""
+async def connect_feed(feed, error_handler):
+    '''
+    args:
+        feed: Feed to connect
+        error_handler: errorHandler() of the client, called with the error code
+    returns: connected non-blocking socket
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        if feed.backoff > 0:
+            await asyncio.sleep(feed.backoff)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            # Before connecting, so the TCP window scale is negotiated for it:
+            if feed.rcvbuf_size is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, feed.rcvbuf_size)
+            await asyncio.wait_for(loop.sock_connect(sock, (feed.host, feed.port)), CONNECT_TIMEOUT)
+            feed.rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            time_now = str(datetime.utcnow())
+            print("%s | Server connected - %s" %(time_now, feed.name))
+            print("%s | Collecting messages..." %(time_now))
+            return sock
+        except (OSError, asyncio.TimeoutError) as err:
+            sock.close()
+            feed.backoff = next_backoff(feed.backoff)
+            time_now = str(datetime.utcnow())
+            print("%s | Socket connection error (%s): %r. Reconnecting in %.1f s..." %(time_now, feed.name, err, feed.backoff))
+            error_handler('1a')
+
+
+"""Function that adapts the read size, and the kernel buffer, to how full the reads come back"""
+def adapt(feed, sock, received):
+    '''
+    A read that fills the buffer means more data was already waiting in the kernel: the
+    read size is doubled, so a burst is read in fewer, larger reads. A large buffer costs
+    nothing when reads come back partly filled, so it is never shrunk. Full reads at the
+    largest size mean the client is falling behind: if the client set SO_RCVBUF, it is
+    doubled for more room (and kept for the next connection). Kernel autotuning already
+    grows the buffer on its own.
+    '''
+    feed.reads = feed.reads + 1
+    if received < len(feed.buffer):
+        return
+    feed.full_reads = feed.full_reads + 1
+    if len(feed.buffer) < feed.max_recv_size:
+        feed.set_recv_size(min(len(feed.buffer) * 2, feed.max_recv_size))
+    elif feed.rcvbuf_size is not None and feed.rcvbuf_size < MAX_RCVBUF_SIZE:
+        feed.rcvbuf_size = min(feed.rcvbuf_size * 2, MAX_RCVBUF_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, feed.rcvbuf_size)
+        feed.rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+
+"""Function to convert a raw 48 bit GPS MLAT timestamp (seconds << 30 | nanoseconds) to ns"""
+def timestamp_ns(timestamp):
+    return (timestamp >> 30) * 1000000000 + (timestamp & 0x3FFFFFFF)
+
+
+"""Function that detects messages lost before they were received, from gaps in the MLAT timestamps"""
+def check_gaps(feed, frames):
+    '''
+    A full read is not a loss - TCP holds the data until it is read. Messages are lost
+    where they cannot be queued, at the receiver's end of the connection when the client
+    falls too far behind, and that shows as a gap in the timestamps of consecutive
+    messages far longer than the feed's message rate explains.
+    args:
+        feed: Feed the messages were received from
+        frames: complete messages of one read, see deframe()
+    returns: number of gaps found
+    '''
+    stamps = [int.from_bytes(frame[1:7], 'big') for frame in frames]
+    if feed.last_timestamp is None:
+        feed.last_timestamp = stamps[0]
+        feed.rate_start = (stamps[0], feed.message_count)
+
+    # Gaps of at least the threshold in raw units, which never undercount a gap in ns.
+    # Timestamps going back (midnight, a receiver restart) are not gaps:
+    gaps = 0
+    if feed.rate > 0:
+        threshold = max(MIN_GAP_NS, int(GAP_INTERVALS * 1e9 / feed.rate))
+        for previous, stamp in [(previous, stamp) for previous, stamp in zip([feed.last_timestamp] + stamps, stamps)
+                                if stamp - previous > threshold]:
+            gap_ns = timestamp_ns(stamp) - timestamp_ns(previous)
+            if gap_ns > threshold:
+                gaps = gaps + 1
+                feed.lost_messages = feed.lost_messages + int(gap_ns * 1e-9 * feed.rate)
+        feed.overruns = feed.overruns + gaps
+    feed.last_timestamp = stamps[-1]
+
+    # Message rate over the last RATE_WINDOW_NS of MLAT time:
+    elapsed = timestamp_ns(stamps[-1]) - timestamp_ns(feed.rate_start[0])
+    if elapsed >= RATE_WINDOW_NS:
+        feed.rate = (feed.message_count - feed.rate_start[1]) * 1e9 / elapsed
+        feed.rate_start = (stamps[-1], feed.message_count)
+    elif elapsed < 0:
+        feed.rate_start = (stamps[-1], feed.message_count)
+    return gaps
+
+
+"""Function that returns a line of the receive statistics of a feed, for the periodic prints"""
+def feed_report(feed):
+    return ("%s | reads: %d (%d full) | read size: %d | SO_RCVBUF: %s | rate: %.0f msg/s | overruns: %d (~%d messages lost)"
+            %(feed.name, feed.reads, feed.full_reads, len(feed.buffer), feed.rcvbuf, feed.rate, feed.overruns,
+              feed.lost_messages))
+
+
+"""Coroutine that receives and deframes one feed for as long as the client runs"""
+async def receive_feed(feed, on_frames, error_handler, observe=None, raw=None):
+    '''
+    args:
+        feed: Feed to receive from
+        on_frames: called as on_frames(feed, frames) with every non-empty list of complete
+            messages, see deframe(). It runs in the event loop of all feeds, so it must not
+            block, see decoder_pool.Dispatcher
+        error_handler: errorHandler() of the client, called with the error code
+        observe: optional, called as observe(feed, seconds) after every read with the time
+            spent deframing it and in on_frames()
+        raw: optional, called as raw(feed, data, frames) before on_frames(), with the bytes
+            of the stream up to the end of the last complete message, e.g. RawArchive.write
+    A lost connection only affects its own feed: the feed waits out its backoff and
+    reconnects while the other feeds carry on.
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        sock = await connect_feed(feed, error_handler)
+        # A new connection is a new stream, the old partial message cannot be completed,
+        # and the time it was down is neither a gap nor part of the message rate:
+        feed.remainder = b''
+        feed.last_timestamp = None
+        feed.rate_start = None
+        received_data = False
+        try:
+            while True:
+                # Read straight into the preallocated buffer:
+                received = await loop.sock_recv_into(sock, feed.buffer)
+
+                # The receiver closed the connection:
+                if received == 0:
+                    error_handler('1b')
+                    break
+
+                if not received_data:
+                    received_data = True
+                    feed.backoff = 0
+
+                # A quiet feed: collect what else arrives within coalesce_delay in the same buffer:
+                if feed.coalesce_delay > 0 and received < COALESCE_BYTES:
+                    await asyncio.sleep(feed.coalesce_delay)
+                    try:
+                        received = received + sock.recv_into(feed.view[received:])
+                    except BlockingIOError:
+                        pass
+                start = time.perf_counter()
+                feed.bytes_received = feed.bytes_received + received
+
+                # Check margin, and grow the buffer when it was filled:
+                buffer_size = len(feed.buffer)
+                feed.min_margin = min(feed.min_margin, buffer_size - received)
+
+                # deframe() copies the buffer, so it can be reused by the next read:
+                buffer = join_remainder(feed.remainder, feed.view[:received])
+                adapt(feed, sock, received)
+                completed_msg_list, feed.remainder = deframe(buffer)
+                if len(completed_msg_list) > 0:
+                    feed.message_count = feed.message_count + len(completed_msg_list)
+                    if check_gaps(feed, completed_msg_list) > 0:
+                        error_handler('1c')
+                    if raw is not None:
+                        raw(feed, buffer[:len(buffer) - len(feed.remainder)], completed_msg_list)
+                    on_frames(feed, completed_msg_list)
+                if observe is not None:
+                    observe(feed, time.perf_counter() - start)
+
+        except OSError:
+            error_handler('1a')
+        except Exception:
+            error_handler('1e')
+        finally:
+            sock.close()
+
+        # A connection that closes without sending anything is retried with backoff too:
+        if not received_data:
+            feed.backoff = next_backoff(feed.backoff)
+        feed.reconnects = feed.reconnects + 1
+        print("%s | Connection lost - %s. Reconnecting..." %(str(datetime.utcnow()), feed.name))
+
+
+"""Function that receives from all feeds in one event loop, until interrupted"""
+def run_feeds(feeds, on_frames, error_handler, observe=None, raw=None):
+    '''
+    args:
+        feeds: list of Feed
+        on_frames, error_handler, observe, raw: see receive_feed()
+    A plain event loop rather than asyncio.run(), which replaces the SIGINT handler: the
+    KeyboardInterrupt has to be raised even while on_frames() is running.
+    '''
+    loop = asyncio.new_event_loop()
+    tasks = [loop.create_task(receive_feed(feed, on_frames, error_handler, observe, raw)) for feed in feeds]
+    receiving = asyncio.gather(*tasks, return_exceptions=True)
+    try:
+        loop.run_until_complete(receiving)
+    finally:
+        # Close the sockets of all feeds:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(receiving)
+        loop.close()
@@ -0,0 +1,102 @@
+"""Import required libraries"""
+import os
+import time
+from collections import OrderedDict
+
+
+"""Writer for the per-second files, with a small LRU cache of open files"""
+class SecondFileWriter:
+    '''
+    Keeps at most 'max_open' per-second files open, so messages arriving slightly out
+    of order across a second boundary do not reopen files. Data is buffered per file
+    and written with one write() per file when:
+        - the file's buffer exceeds 'max_buffer' bytes
+        - 'flush_interval' has passed since data was last written, so the first batch
+          after a start or an idle period is written at once
+        - the file is evicted from the cache or closed
+    Files not written to for 'idle_close' seconds are flushed, fsync'ed and closed,
+    so memory use and the number of open files stay constant however long it runs.
+
+    args:
+        suffix: filename suffix, '.txt' or '.bin'
+        header: optional function of the second, returning bytes written at the start
+            of a new (empty) file
+        max_open, max_buffer, flush_interval, idle_close: see above
+    '''
+
+    def __init__(self, suffix='.txt', header=None, max_open=4, max_buffer=262144, flush_interval=1.0, idle_close=5.0):
+        self.suffix = suffix
+        self.header = header
+        self.max_open = max_open
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_interval
+        self.idle_close = idle_close
+        self.files = OrderedDict()  # second -> [file, list of buffered bytes, buffered size, last write time]
+        self.last_flush = time.monotonic() - flush_interval
+
+    def _open(self, second):
+        # Evict the least recently written file first:
+        while len(self.files) >= self.max_open:
+            self._close(next(iter(self.files)))
+        file = open("%d%s" %(second, self.suffix), "ab", buffering=0)
+        buffered = []
+        if self.header is not None and file.tell() == 0:
+            buffered.append(self.header(second))
+        entry = [file, buffered, sum(map(len, buffered)), time.monotonic()]
+        self.files[second] = entry
+        return entry
+
+    def _flush(self, entry):
+        if entry[1]:
+            entry[0].write(b''.join(entry[1]))
+            entry[1] = []
+            entry[2] = 0
+
+    def _close(self, second):
+        entry = self.files.pop(second)
+        try:
+            self._flush(entry)
+            os.fsync(entry[0].fileno())
+        finally:
+            entry[0].close()
+
+    def write_batch(self, chunks_by_second):
+        '''
+        args:
+            chunks_by_second: dictionary of second -> list of bytes to append to that
+                second's file, e.g. all lines of one batch grouped by second
+        '''
+        now = time.monotonic()
+        for second, chunks in chunks_by_second.items():
+            entry = self.files.get(second)
+            if entry is None:
+                entry = self._open(second)
+            else:
+                self.files.move_to_end(second)
+            entry[1].extend(chunks)
+            entry[2] += sum(map(len, chunks))
+            entry[3] = now
+            if entry[2] >= self.max_buffer:
+                self._flush(entry)
+        self.flush_expired(now)
+
+    def flush_expired(self, now=None):
+        """Applies the time thresholds, to be called regularly even when idle"""
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            for entry in self.files.values():
+                if entry[1]:
+                    self._flush(entry)
+                    self.last_flush = now
+        for second in [second for second, entry in self.files.items() if now - entry[3] >= self.idle_close]:
+            self._close(second)
+
+    def buffered_seconds(self):
+        """Seconds with data not yet written to their file"""
+        return {second for second, entry in self.files.items() if entry[1]}
+
+    def close(self):
+        """Flushes, fsyncs and closes all open files"""
+        for second in list(self.files):
+            self._close(second)
@@ -0,0 +1,96 @@
+"""Import required libraries"""
+from beast_deframer import PAYLOAD_START, WANTED_DF
+
+
+"""Filter settings"""
+MAX_TABLE_LEN = 32      # longer messages are looked up as this length, see FrameFilter
+CRC24_GENERATOR = 0xFFF409
+ADDRESS_DF = (11, 17, 18)   # downlink formats carrying the ICAO address in bytes 2-4
+
+
+"""CRC-24 of Mode-S, one table entry per byte value"""
+def crc24_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc = ((crc << 1) ^ CRC24_GENERATOR) if crc & 0x800000 else (crc << 1)
+        table.append(crc & 0xFFFFFF)
+    return table
+CRC24_TABLE = crc24_table()
+
+
+"""Function that returns the ICAO address of a Mode-S message"""
+def icao_address(frame):
+    '''
+    args: complete Mode-S message (bytes or memoryview), starting at its message type byte
+    returns: address as an int - from the address field for DF11/ 17/ 18, otherwise the
+        address/ parity field XOR the CRC of the rest of the payload
+    '''
+    payload = frame[PAYLOAD_START:]
+    if min(payload[0] >> 3, 24) in ADDRESS_DF:
+        return (payload[1] << 16) | (payload[2] << 8) | payload[3]
+    crc = 0
+    for byte in payload[:-3]:
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC24_TABLE[(crc >> 16) ^ byte]
+    return ((payload[-3] << 16) | (payload[-2] << 8) | payload[-1]) ^ crc
+
+
+"""Receiver filter that drops unwanted messages before they are sent to the decoders"""
+class FrameFilter:
+    '''
+    Looks at the message type byte, the length, the signal level byte and the first
+    payload byte (the downlink format) only, so it is much cheaper than sending and
+    decoding the message. Like decode_fields(), a message is Mode-AC when its payload is
+    2 bytes and Mode-S when it is 7 or 14 bytes - anything else (status messages,
+    messages cut short) is dropped, as the decoder would not write it either.
+
+    args:
+        downlink_formats: Mode-S downlink formats to keep, None for all. The decoder only
+            writes DF5/ 17/ 21 (see batch_decoder.py), so other formats would only be
+            sent to be dropped
+        mode_ac: keep Mode-AC messages
+        icao: ICAO addresses (ints) of the Mode-S messages to keep, None for all. Mode-AC
+            messages have no address and are kept or dropped by 'mode_ac' alone
+        min_signal: minimum signal level byte (0-255), 0 for all
+    '''
+
+    def __init__(self, downlink_formats=WANTED_DF, mode_ac=True, icao=None, min_signal=0):
+        self.downlink_formats = downlink_formats
+        self.mode_ac = mode_ac
+        self.icao = None if icao is None else frozenset(icao)
+        self.min_signal = min_signal
+
+        # Acceptance by first payload byte, for Mode-AC, Mode-S and other messages:
+        self.accept_ac = accept_ac = bytes([1 if mode_ac else 0]) * 256
+        accept_s = bytes(1 if downlink_formats is None or min(byte >> 3, 24) in downlink_formats else 0
+                         for byte in range(256))
+        accept_none = bytes(256)
+        # tables[message type][length], where the payload is cut to the length of the type:
+        payload_len = {0x31: 2, 0x32: 7, 0x33: 14}
+        self.tables = []
+        for msgtype in range(256):
+            by_length = []
+            for length in range(MAX_TABLE_LEN):
+                payload = min(max(length - PAYLOAD_START, 0), payload_len.get(msgtype, 0))
+                by_length.append(accept_ac if payload == 2 else accept_s if payload in (7, 14) else accept_none)
+            self.tables.append(by_length)
+
+    def select(self, frames):
+        '''
+        args: list of complete messages (bytes or memoryview), as produced by deframe()
+        returns: list of the messages to keep, in the same order
+        '''
+        tables = self.tables
+        min_signal = self.min_signal
+        last = MAX_TABLE_LEN - 1
+        # The shortest complete message (Mode-AC) is 10 bytes, the first payload byte is [8]:
+        kept = [frame for frame in frames
+                if (length := len(frame)) > 9 and tables[frame[0]][length if length < last else last][frame[PAYLOAD_START]]
+                and frame[7] >= min_signal]
+        if self.icao is not None:
+            icao = self.icao
+            accept_ac = self.accept_ac
+            kept = [frame for frame in kept
+                    if tables[frame[0]][min(len(frame), last)] is accept_ac or icao_address(frame) in icao]
+        return kept
@@ -0,0 +1,325 @@
+"""Import required libraries"""
+import multiprocessing
+import threading
+import time
+from datetime import datetime
+
+
+"""Metrics of the client processes, in shared memory"""
+COUNTERS = [
+    # name, process that writes it, help text
+    ('frames_filtered', 'receiver', 'Messages dropped by the receiver filter'),
+    ('frames_dispatched', 'receiver', 'Messages sent to the decoders'),
+    ('send_dropped_frames', 'receiver', 'Messages lost because sending to a decoder failed'),
+    ('queue_dropped_frames', 'receiver', 'Messages dropped because the decoders fell behind the receiver'),
+    ('frames_decoded', 'decoder', 'Messages decoded'),
+    ('rows_decoded', 'decoder', 'Decoded messages kept for the per-second files'),
+    ('batches_received', 'endpoint', 'Batches received from the decoders'),
+    ('rows_written', 'endpoint', 'Decoded messages written to the per-second files'),
+    ('bytes_written', 'endpoint', 'Bytes written to the per-second files'),
+]
+HISTOGRAMS = [
+    ('receive', 'receiver', 'Time to deframe and dispatch one socket read'),
+    ('decode', 'decoder', 'Time to decode one batch'),
+    ('write', 'endpoint', 'Time to group and write one batch'),
+    ('socket_to_endpoint', 'endpoint', 'Time from the socket read to the batch reaching the endpoint'),
+]
+
+# HDR-style histogram of microseconds: exact below 16 us, then 8 buckets per power of 2,
+# i.e. at most 12.5% error, up to 2**32 us (71 minutes):
+EXACT_BUCKETS = 16
+SUB_BUCKETS = 8
+NUM_BUCKETS = EXACT_BUCKETS + SUB_BUCKETS * 28
+
+
+"""Function that returns the histogram bucket of a latency in microseconds"""
+def bucket_index(us):
+    if us < EXACT_BUCKETS:
+        return us
+    shift = us.bit_length() - 4
+    return min(EXACT_BUCKETS + (shift - 1) * SUB_BUCKETS + (us >> shift) - SUB_BUCKETS, NUM_BUCKETS - 1)
+
+
+"""Function that returns the upper bound (exclusive, in microseconds) of a histogram bucket"""
+def bucket_upper(index):
+    if index < EXACT_BUCKETS:
+        return index + 1
+    shift = (index - EXACT_BUCKETS) // SUB_BUCKETS + 1
+    mantissa = (index - EXACT_BUCKETS) % SUB_BUCKETS + SUB_BUCKETS
+    return (mantissa + 1) << shift
+
+
+"""Counters and latency histograms of all client processes"""
+class Metrics:
+    '''
+    One shared int64 array without a lock, as PoolStats: every process has its own block
+    of counters, error counts and histograms, and only that process writes to it.
+    The parent creates Metrics before starting the child processes, every process then
+    writes through its own ProcessMetrics, see process().
+
+    args:
+        num_decoders: number of decoder worker processes
+        error_codes: codes errorHandler() can be called with
+    '''
+
+    def __init__(self, num_decoders, error_codes):
+        self.processes = ['receiver'] + ['decoder_%d' % worker for worker in range(num_decoders)] + ['endpoint']
+        self.error_codes = list(error_codes)
+        self.block_size = len(COUNTERS) + len(self.error_codes) + len(HISTOGRAMS) * (NUM_BUCKETS + 2)
+        # offsets within a block:
+        self.counter_offsets = {name: index for index, (name, _, _) in enumerate(COUNTERS)}
+        self.error_offsets = {code: len(COUNTERS) + index for index, code in enumerate(self.error_codes)}
+        self.histogram_offsets = {name: len(COUNTERS) + len(self.error_codes) + index * (NUM_BUCKETS + 2)
+                                  for index, (name, _, _) in enumerate(HISTOGRAMS)}
+        self.values = multiprocessing.Array('q', len(self.processes) * self.block_size, lock=False)
+
+    def process(self, role, worker=0):
+        '''
+        args:
+            role: 'receiver', 'decoder' or 'endpoint'
+            worker: decoder worker number
+        returns: ProcessMetrics of that process
+        '''
+        name = 'decoder_%d' % worker if role == 'decoder' else role
+        return ProcessMetrics(self, self.processes.index(name) * self.block_size)
+
+    def histogram(self, process, name):
+        '''
+        returns: (bucket counts, count, sum in microseconds)
+        '''
+        start = self.processes.index(process) * self.block_size + self.histogram_offsets[name]
+        return self.values[start:start + NUM_BUCKETS], self.values[start + NUM_BUCKETS], self.values[start + NUM_BUCKETS + 1]
+
+    def quantile(self, buckets, count, q):
+        """Upper bound of the bucket holding quantile 'q' (s), from histogram() counts"""
+        if count == 0:
+            return float('nan')
+        rank = q * count
+        seen = 0
+        for index, bucket_count in enumerate(buckets):
+            seen += bucket_count
+            if seen >= rank:
+                return bucket_upper(index) * 1e-6
+        return bucket_upper(NUM_BUCKETS - 1) * 1e-6
+
+    def report(self):
+        """Latency quantiles of every process, one line per histogram, for printing"""
+        lines = []
+        for name, role, _ in HISTOGRAMS:
+            for process in self.processes:
+                if not process.startswith(role):
+                    continue
+                buckets, count, _ = self.histogram(process, name)
+                if count > 0:
+                    lines.append("%s %s latency | count: %d | p50: %.3f ms | p99: %.3f ms | max: %.3f ms"
+                                 % (process, name, count, self.quantile(buckets, count, 0.5) * 1e3,
+                                    self.quantile(buckets, count, 0.99) * 1e3, self.quantile(buckets, count, 1.0) * 1e3))
+        return lines
+
+    def prometheus(self, gauges=()):
+        '''
+        args:
+            gauges: list of (name, 'gauge' or 'counter', help, list of (labels dictionary,
+                value)), read at the time of the request, e.g. queue depths
+        returns: all metrics in the Prometheus text exposition format (str)
+        '''
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append("# HELP mlat_%s %s" % (name, help_text))
+            lines.append("# TYPE mlat_%s %s" % (name, kind))
+
+        def number(value):
+            return '%d' % value if isinstance(value, int) else '%.9g' % value
+
+        def labels(**pairs):
+            return ','.join('%s="%s"' % (key, value) for key, value in pairs.items())
+
+        for index, (name, role, help_text) in enumerate(COUNTERS):
+            family(name + '_total', 'counter', help_text)
+            for p, process in enumerate(self.processes):
+                if process.startswith(role):
+                    lines.append("mlat_%s_total{%s} %d" % (name, labels(process=process), self.values[p * self.block_size + index]))
+
+        family('errors_total', 'counter', 'Calls of errorHandler(), by error code')
+        for p, process in enumerate(self.processes):
+            for code in self.error_codes:
+                value = self.values[p * self.block_size + self.error_offsets[code]]
+                if value > 0:
+                    lines.append("mlat_errors_total{%s} %d" % (labels(process=process, code=code), value))
+
+        # cumulative buckets at every power of 2 microseconds, which are bucket boundaries:
+        for name, role, help_text in HISTOGRAMS:
+            family(name + '_latency_seconds', 'histogram', help_text)
+            for process in self.processes:
+                if not process.startswith(role):
+                    continue
+                buckets, count, total_us = self.histogram(process, name)
+                cumulative = 0
+                bound = 1
+                for index, bucket_count in enumerate(buckets):
+                    cumulative += bucket_count
+                    upper = bucket_upper(index)
+                    if upper == bound:
+                        lines.append('mlat_%s_latency_seconds_bucket{%s,le="%.9g"} %d'
+                                     % (name, labels(process=process), upper * 1e-6, cumulative))
+                        bound *= 2
+                lines.append('mlat_%s_latency_seconds_bucket{%s,le="+Inf"} %d' % (name, labels(process=process), count))
+                lines.append('mlat_%s_latency_seconds_sum{%s} %.9g' % (name, labels(process=process), total_us * 1e-6))
+                lines.append('mlat_%s_latency_seconds_count{%s} %d' % (name, labels(process=process), count))
+
+        for name, kind, help_text, samples in gauges:
+            family(name, kind, help_text)
+            for sample_labels, value in samples:
+                lines.append("mlat_%s{%s} %s" % (name, labels(**sample_labels), number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+"""The block of Metrics written by one process"""
+class ProcessMetrics:
+
+    def __init__(self, metrics, start):
+        self.metrics = metrics
+        self.values = metrics.values
+        self.start = start
+
+    def add(self, name, value=1):
+        self.values[self.start + self.metrics.counter_offsets[name]] += value
+
+    def error(self, code):
+        if code in self.metrics.error_offsets:
+            self.values[self.start + self.metrics.error_offsets[code]] += 1
+
+    def observe(self, name, seconds):
+        """Records one latency in the histogram 'name'"""
+        start = self.start + self.metrics.histogram_offsets[name]
+        us = max(int(seconds * 1e6), 0)
+        self.values[start + bucket_index(us)] += 1
+        self.values[start + NUM_BUCKETS] += 1
+        self.values[start + NUM_BUCKETS + 1] += us
+
+
+"""Local HTTP endpoint serving the metrics to Prometheus, in a thread of the parent process"""
+class MetricsServer:
+    '''
+    args:
+        metrics: Metrics
+        gauges: function returning the gauges argument of Metrics.prometheus()
+        host, port: address to listen on - keep it local, there is no authentication
+    '''
+
+    def __init__(self, metrics, gauges=lambda: (), host='127.0.0.1', port=9108):
+        # Imported here, so a client without the endpoint does not pay for it at startup:
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = server.metrics.prometheus(server.gauges()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # no line per scrape
+
+        self.metrics = metrics
+        self.gauges = gauges
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+"""Error log that is rate-limited per error code and written in batches"""
+class ErrorLog:
+    '''
+    Every process has its own ErrorLog (and buffer), the file is opened once in append
+    mode. Per error code and 'window' seconds, only the first 'max_lines' errors are
+    logged; how many more there were is logged when the window ends. Lines are written
+    when 'max_buffer' lines are waiting or 'flush_interval' has passed, so an error storm
+    costs one write() per interval rather than an open() and write() per error.
+    flush_expired() has to be called regularly, and close() before the process exits.
+
+    args:
+        filename: log file, e.g. '0_Log_Errors.txt'
+        max_lines, window, flush_interval, max_buffer: see above
+    '''
+
+    def __init__(self, filename, max_lines=10, window=60.0, flush_interval=1.0, max_buffer=100):
+        self.filename = filename
+        self.max_lines = max_lines
+        self.window = window
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.file = None
+        self.buffer = []
+        self.windows = {}   # code -> [window start, errors in the window, error message]
+        self.last_flush = time.monotonic()
+
+    def log(self, code, error_msg):
+        now = time.monotonic()
+        window = self.windows.get(code)
+        if window is None or now - window[0] >= self.window:
+            if window is not None:
+                self._summarise(window)
+            window = [now, 0, error_msg]
+            self.windows[code] = window
+        window[1] += 1
+        if window[1] <= self.max_lines:
+            self.buffer.append("%s : %s\n" %(str(datetime.utcnow()), error_msg))
+        self.flush_expired(now)
+
+    def _summarise(self, window):
+        if window[1] > self.max_lines:
+            self.buffer.append("%s : %s (%d more in %.0f s, not logged)\n"
+                               %(str(datetime.utcnow()), window[2], window[1] - self.max_lines, time.monotonic() - window[0]))
+
+    def flush_expired(self, now=None):
+        """Applies the thresholds, to be called regularly even without errors"""
+        if now is None:
+            now = time.monotonic()
+        if len(self.buffer) >= self.max_buffer or now - self.last_flush >= self.flush_interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        """Writes the buffered lines, and the counts of the windows that have ended"""
+        if now is None:
+            now = time.monotonic()
+        for code, window in list(self.windows.items()):
+            if now - window[0] >= self.window:
+                self._summarise(window)
+                del self.windows[code]
+        self.last_flush = now
+        if not self.buffer:
+            return
+        try:
+            if self.file is None:
+                self.file = open(self.filename, "a")
+            self.file.write(''.join(self.buffer))
+            self.file.flush()
+        except OSError:
+            pass    # nowhere left to report it
+        self.buffer = []
+
+    def close(self):
+        """Logs how many errors of the current windows were not logged, flushes and closes"""
+        for window in self.windows.values():
+            self._summarise(window)
+        self.windows = {}
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
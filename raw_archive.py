@@ -0,0 +1,420 @@
+"""Import required libraries"""
+import argparse
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from beast_deframer import ESC_BYTE, deframe
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None    # blocks are compressed with lz4, or zlib, instead
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+"""
+Archive of the raw Beast stream of each feed, so any past interval can be decoded again
+(e.g. after a decoder fix, or for downlink formats the client does not keep):
+
+    <directory>/<feed>/<YYYYMMDD_HH>.raw    file header, then compressed blocks of about
+                                            'block_seconds' of the stream each
+    <directory>/<feed>/<YYYYMMDD_HH>.idx    one INDEX_ENTRY per block
+
+Blocks hold the socket bytes exactly as received, cut at message boundaries, so every
+block can be decompressed and deframed on its own - the blocks of a file joined are the
+stream. Files are named after the UTC hour their blocks were written in; the oldest hours
+are deleted when the archive grows beyond 'retention_bytes' (checked as it grows, but the
+hours being written are kept, so it can exceed it by up to an hour of every feed). A '.raw'
+file can be read without its '.idx', the index is rebuilt from the block headers when needed.
+"""
+MAGIC = b'BRAW'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHH')        # magic, version, codec
+BLOCK_HEADER = struct.Struct('<qqII')       # first and last MLAT timestamp (ns since UTC midnight), raw size, compressed size
+INDEX_ENTRY = struct.Struct('<qqQII')       # first and last MLAT timestamp, offset of the block header, raw size, compressed size
+CODECS = {'zlib': 1, 'zstd': 2, 'lz4': 3}
+HOUR_FORMAT = '%Y%m%d_%H'
+RETENTION_CHECKS = 64                       # retention is checked every retention_bytes / RETENTION_CHECKS written
+NS_PER_HOUR = 3600000000000
+
+
+"""Functions to compress and decompress blocks, by codec"""
+def compress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if codec == 'lz4':
+        return lz4.frame.compress(data)
+    return zlib.compress(data, 1)
+def decompress(codec, data, raw_size):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=raw_size)
+    if codec == 'lz4':
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+"""Function that returns the codec used when none is given: zstd, else lz4, else zlib"""
+def default_codec():
+    if zstandard is not None:
+        return 'zstd'
+    if lz4 is not None:
+        return 'lz4'
+    return 'zlib'
+
+
+"""Function to read the MLAT timestamp of a message, in ns since UTC midnight"""
+def frame_time_ns(frame):
+    timestamp = int.from_bytes(frame[1:7], 'big')
+    return (timestamp >> 30) * 1000000000 + (timestamp & 0x3FFFFFFF)
+
+
+"""Function that turns a feed name ('host:port') into a directory name"""
+def feed_directory(name):
+    return re.sub(r'[^A-Za-z0-9.-]', '_', name)
+
+
+"""Function that reads the blocks of a '.raw' file from their headers"""
+def scan_blocks(path):
+    '''
+    args: path of a '.raw' file
+    returns: codec of the file, list of INDEX_ENTRY tuples of its complete blocks, and the
+        offset where the last complete block ends (a block being written when the client
+        stopped is cut off there)
+    '''
+    entries = []
+    with open(path, 'rb') as f:
+        magic, version, codec_id = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a raw archive file" % path)
+        size = os.fstat(f.fileno()).st_size
+        offset = FILE_HEADER.size
+        while offset + BLOCK_HEADER.size <= size:
+            first, last, raw_size, compressed_size = BLOCK_HEADER.unpack(f.read(BLOCK_HEADER.size))
+            if offset + BLOCK_HEADER.size + compressed_size > size:
+                break
+            entries.append((first, last, offset, raw_size, compressed_size))
+            offset = offset + BLOCK_HEADER.size + compressed_size
+            f.seek(offset)
+    codec = {value: name for name, value in CODECS.items()}[codec_id]
+    return codec, entries, offset
+
+
+"""Function to read the index of a '.raw' file, rebuilding it from the blocks if it is missing or behind"""
+def read_index(path):
+    '''
+    args: path of a '.raw' file
+    returns: codec of the file, list of INDEX_ENTRY tuples
+    '''
+    index_path = path[:-len('.raw')] + '.idx'
+    with open(path, 'rb') as f:
+        magic, version, codec_id = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        size = os.fstat(f.fileno()).st_size
+    try:
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        entries = list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+    except OSError:
+        entries = []
+    end = entries[-1][2] + BLOCK_HEADER.size + entries[-1][4] if entries else FILE_HEADER.size
+    if magic != MAGIC or end != size:
+        codec, entries, _ = scan_blocks(path)
+        return codec, entries
+    return {value: name for name, value in CODECS.items()}[codec_id], entries
+
+
+"""Writer of the raw archive, compressing and writing on a background thread"""
+class RawArchive:
+    '''
+    write() is called by the receiver with the bytes of every read; it only appends them
+    to the feed's current block. A block is handed to the writer thread when it spans
+    'block_seconds' of MLAT time (or 'max_block' bytes, or the timestamps go back, e.g. at
+    midnight). If the thread falls 'max_pending' blocks behind, blocks are dropped and
+    counted rather than stalling the receiver.
+
+    args:
+        directory: folder of the archive, one sub-folder per feed
+        codec: 'zstd', 'lz4' or 'zlib', the best one installed by default
+        retention_bytes: size of the archive beyond which the oldest hours are deleted,
+            None to keep everything
+        block_seconds, max_block, max_pending: see above
+    '''
+
+    def __init__(self, directory, codec=None, retention_bytes=None, block_seconds=1.0, max_block=4194304,
+                 max_pending=64):
+        self.directory = directory
+        self.codec = codec if codec is not None else default_codec()
+        if self.codec == 'zstd' and zstandard is None or self.codec == 'lz4' and lz4 is None:
+            raise ValueError("Codec %s of the raw archive is not installed" % self.codec)
+        if self.codec not in CODECS:
+            raise ValueError("Unknown codec of the raw archive: %s" % self.codec)
+        self.retention_bytes = retention_bytes
+        self.block_ns = int(block_seconds * 1e9)
+        self.max_block = max_block
+        self.blocks = {}                # feed name -> [list of bytes, size, first timestamp, last timestamp]
+        self.pending = queue.Queue(max_pending)
+        self.files = {}                 # feed name -> [hour, '.raw' file, '.idx' file], written by the thread only
+        # each counter is incremented by one thread only:
+        self.blocks_written = 0         # by the thread
+        self.blocks_dropped = 0         # by the receiver, the thread fell behind
+        self.write_errors = 0           # by the thread, blocks that could not be written
+        self.bytes_in = 0               # raw bytes of the blocks written
+        self.bytes_out = 0              # compressed bytes of the blocks written
+        self.files_deleted = 0
+        self.unchecked_bytes = 0        # compressed bytes written since retention was last checked
+        self.thread = threading.Thread(target=self._run, name='raw_archive', daemon=True)
+        self.thread.start()
+
+    def write(self, feed, data, frames):
+        '''
+        args:
+            feed: Feed the bytes were received from
+            data: bytes consumed by one read, i.e. ending at a message boundary (see receive_feed())
+            frames: the complete messages deframed from them, at least one
+        '''
+        first = frame_time_ns(frames[0])
+        last = frame_time_ns(frames[-1])
+        block = self.blocks.get(feed.name)
+        if block is not None and (last - block[2] >= self.block_ns or first < block[3] or block[1] >= self.max_block):
+            self._hand_off(feed.name)
+            block = None
+        if block is None:
+            block = self.blocks[feed.name] = [[], 0, first, last]
+        # The read buffer is reused by the next read:
+        block[0].append(bytes(data))
+        block[1] = block[1] + len(data)
+        block[3] = max(block[3], last)
+
+    def _hand_off(self, name):
+        chunks, size, first, last = self.blocks.pop(name)
+        try:
+            self.pending.put_nowait((name, first, last, b''.join(chunks)))
+        except queue.Full:
+            self.blocks_dropped = self.blocks_dropped + 1
+
+    def close(self):
+        """Writes the blocks being collected, waits for the thread and closes the files"""
+        for name in list(self.blocks):
+            self._hand_off(name)
+        self.pending.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            name, first, last, data = item
+            try:
+                self._write_block(name, first, last, data)
+            except (OSError, ValueError) as e:
+                self.write_errors = self.write_errors + 1
+                print("%s | Raw archive write error (%s): %r" %(str(datetime.utcnow()), name, e))
+        for name in list(self.files):
+            self._close(name)
+
+    def _write_block(self, name, first, last, data):
+        hour = datetime.utcnow().strftime(HOUR_FORMAT)
+        entry = self.files.get(name)
+        if entry is None or entry[0] != hour:
+            if entry is not None:
+                self._close(name)
+            entry = self.files[name] = self._open(name, hour)
+            self.unchecked_bytes = 0
+            self.enforce_retention()
+        compressed = compress(self.codec, data)
+        offset = entry[1].tell()
+        entry[1].write(BLOCK_HEADER.pack(first, last, len(data), len(compressed)) + compressed)
+        entry[1].flush()
+        # The index is written after its block, so an entry never points past the data:
+        entry[2].write(INDEX_ENTRY.pack(first, last, offset, len(data), len(compressed)))
+        entry[2].flush()
+        self.blocks_written = self.blocks_written + 1
+        self.bytes_in = self.bytes_in + len(data)
+        self.bytes_out = self.bytes_out + len(compressed)
+        # Retention is checked when an hour is opened and as the archive grows, not after every block:
+        self.unchecked_bytes = self.unchecked_bytes + BLOCK_HEADER.size + len(compressed) + INDEX_ENTRY.size
+        if self.retention_bytes is not None and self.unchecked_bytes * RETENTION_CHECKS >= self.retention_bytes:
+            self.unchecked_bytes = 0
+            self.enforce_retention()
+
+    def _open(self, name, hour):
+        folder = os.path.join(self.directory, feed_directory(name))
+        os.makedirs(folder, exist_ok=True)
+        # An hour begun in another codec is continued in '<hour>.<codec>.raw' next to it:
+        for path in (os.path.join(folder, hour + '.raw'), os.path.join(folder, '%s.%s.raw' %(hour, self.codec))):
+            index_path = path[:-len('.raw')] + '.idx'
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                return self._open_new(hour, path, index_path)
+            # Restarted within the hour: continue after the last complete block, in the file's codec:
+            codec, entries, end = scan_blocks(path)
+            if codec == self.codec:
+                raw = open(path, 'r+b')
+                raw.truncate(end)
+                raw.seek(end)
+                index = open(index_path, 'wb')
+                index.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+                return [hour, raw, index]
+        raise ValueError("%s is not in codec %s" %(path, self.codec))
+
+    def _open_new(self, hour, path, index_path):
+        raw = open(path, 'wb')
+        raw.write(FILE_HEADER.pack(MAGIC, VERSION, CODECS[self.codec]))
+        return [hour, raw, open(index_path, 'wb')]
+
+    def _close(self, name):
+        hour, raw, index = self.files.pop(name)
+        for f in (raw, index):
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+    def enforce_retention(self):
+        """Deletes the oldest hours, of all feeds, until the archive is within retention_bytes"""
+        if self.retention_bytes is None:
+            return
+        open_paths = {os.path.abspath(entry[1].name) for entry in self.files.values()}
+        files = []
+        total = 0
+        for folder in os.scandir(self.directory):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith('.raw'):
+                    size = entry.stat().st_size
+                    index_path = entry.path[:-len('.raw')] + '.idx'
+                    if os.path.exists(index_path):
+                        size = size + os.path.getsize(index_path)
+                    files.append((entry.name, entry.path, size))
+                    total = total + size
+        for filename, path, size in sorted(files):
+            if total <= self.retention_bytes:
+                break
+            if os.path.abspath(path) in open_paths:
+                continue
+            os.remove(path)
+            if os.path.exists(path[:-len('.raw')] + '.idx'):
+                os.remove(path[:-len('.raw')] + '.idx')
+            total = total - size
+            self.files_deleted = self.files_deleted + 1
+
+    def report(self):
+        """Line of statistics for the periodic prints"""
+        return ("Raw archive | blocks written: %d, dropped: %d, write errors: %d | %d MB in, %d MB out (%s) | hours deleted: %d"
+                %(self.blocks_written, self.blocks_dropped, self.write_errors, self.bytes_in // 1000000,
+                  self.bytes_out // 1000000, self.codec, self.files_deleted))
+
+
+"""Function that returns the '.raw' files of a feed covering an interval, oldest first"""
+def archive_files(directory, feed, start, end):
+    '''
+    args:
+        directory: folder of the archive
+        feed: feed name ('host:port') or its directory name
+        start, end: UTC datetimes
+    returns: list of (path, UTC hour of the file)
+    '''
+    folder = os.path.join(directory, feed_directory(feed))
+    files = []
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith('.raw'):
+            continue
+        hour = datetime.strptime(filename[:len('YYYYMMDD_HH')], HOUR_FORMAT)
+        # Blocks are written shortly after they were received, so an hour can begin with the end of the last:
+        if hour + timedelta(hours=1) > start and hour - timedelta(minutes=1) < end:
+            files.append((os.path.join(folder, filename), hour))
+    return files
+
+
+"""Generator of the raw stream of a feed over an interval, one block at a time"""
+def read_range(directory, feed, start, end):
+    '''
+    args: see archive_files()
+    yields: (UTC midnight the block's timestamps count from, bytes of the block)
+        for every block overlapping start <= time < end, using the index to seek to them
+    '''
+    for path, hour in archive_files(directory, feed, start, end):
+        codec, entries = read_index(path)
+        with open(path, 'rb') as f:
+            for first, last, offset, raw_size, compressed_size in entries:
+                # A block written just after midnight holds the end of the day before:
+                midnight = hour.replace(hour=0)
+                if first > (hour.hour + 1) * NS_PER_HOUR:
+                    midnight = midnight - timedelta(days=1)
+                if last < (start - midnight).total_seconds() * 1e9 or first >= (end - midnight).total_seconds() * 1e9:
+                    continue
+                f.seek(offset + BLOCK_HEADER.size)
+                yield midnight, decompress(codec, f.read(compressed_size), raw_size)
+
+
+"""Generator of the messages of a feed over an interval, e.g. to decode them again"""
+def replay_frames(directory, feed, start, end):
+    '''
+    args: see archive_files()
+    yields: lists of complete messages (see deframe()) received start <= time < end,
+        one list per block
+    '''
+    for midnight, data in read_range(directory, feed, start, end):
+        start_ns = int((start - midnight).total_seconds() * 1e9)
+        end_ns = int((end - midnight).total_seconds() * 1e9)
+        # A block ends with a complete message, which the <esc> of another one completes:
+        frames, _ = deframe(data + ESC_BYTE + b'1')
+        frames = [frame for frame in frames if start_ns <= frame_time_ns(frame) < end_ns]
+        if frames:
+            yield frames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Read an interval back from the raw archive of the client")
+    parser.add_argument('directory', help="folder of the archive, raw_archive_path of the client")
+    parser.add_argument('feed', help="feed name as 'host:port'")
+    parser.add_argument('start', type=datetime.fromisoformat, help="UTC start, e.g. 2026-10-18T10:00:00")
+    parser.add_argument('end', type=datetime.fromisoformat, help="UTC end")
+    parser.add_argument('--output', help="write the raw stream to this file, e.g. to serve with benchmarks/replay_server.py")
+    parser.add_argument('--decode', choices=('text', 'binary', 'both'),
+                        help="decode into per-second files in the current directory, as the client does")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    message_count = 0
+    written_count = 0
+    output = open(args.output, 'wb') if args.output else None
+    if args.decode:
+        from batch_decoder import decode_batch
+        from file_writer import SecondFileWriter
+        from capture_format import file_header
+        from version4_dev import group_binary, group_text, split_batch
+        text_writer = SecondFileWriter('.txt')
+        binary_writer = SecondFileWriter('.bin', header=file_header)
+    try:
+        for frames in replay_frames(args.directory, args.feed, args.start, args.end):
+            message_count = message_count + len(frames)
+            if output is not None:
+                # Stuffed again, so the file is a Beast stream:
+                output.write(b''.join(b'\x1a' + bytes(frame).replace(b'\x1a', b'\x1a\x1a') for frame in frames))
+            if args.decode:
+                decoded, _ = decode_batch(frames, args.decode)
+                messages_to_write, records = split_batch(decoded, args.decode)
+                if records is not None:
+                    binary_writer.write_batch(group_binary(records))
+                if messages_to_write is not None:
+                    text_writer.write_batch(group_text(messages_to_write)[0])
+                written_count = written_count + len(decoded[0] if args.decode == 'both' else decoded)
+    finally:
+        if output is not None:
+            output.close()
+        if args.decode:
+            text_writer.close()
+            binary_writer.close()
+    elapsed = time.perf_counter() - start
+    print("%d messages read, %d decoded messages written, in %.2f s (%.0f messages/s)"
+          %(message_count, written_count, elapsed, message_count / max(elapsed, 1e-9)))
@@ -0,0 +1,312 @@
+# necessary imports:
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+from capture_format import SECONDS_PER_SEGMENT, read_compacted_second, read_second, segment_filename, text_lines_to_records
+from capture_index import DATE_FORMAT, capture_date
+from clock_calibration import ClockCalibration
+from correlator import Correlator
+from ingest import StationConfigCache, capture_filename
+from solver import StationPositions, solve
+from tracker import track_keys, group_times
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # hourly results are written as compressed .npz instead of Parquet
+
+"""
+Backfill of a range of seconds after an outage: the range is split into chunks of
+consecutive seconds, and a pool of processes runs ingest -> correlate -> solve on them,
+each chunk on its own. The fixes are written one file per hour into output_folder,
+Parquet when pyarrow is installed, otherwise NumPy .npz - both hold the same columns.
+Completed hours, and the seconds of them that were solved, are recorded in a checkpoint
+file, so a run that is interrupted (or extended) only solves what has not been written yet.
+
+The per-second files are named by second of day only, so the range is of one date: a
+per-second file is read if it was last written on that date (see capture_index.capture_date()),
+else the segment of that date it was compacted into, never the files of another day.
+
+As the chunks are solved independently, there is no track to start 3-station groups
+from - they are solved at assumed_altitude. Station clocks are corrected with the saved
+calibration of the live server, if one is given, but not re-estimated.
+"""
+checkpoint_filename = 'backfill_checkpoint.json'
+SECONDS_PER_HOUR = 3600
+COLUMNS = ['time_ns', 'key', 'df', 'squawk', 'num_stations', 'latitude', 'longitude', 'altitude',
+           'residual', 'gdop', 'iterations']
+
+
+"""
+Function to tell the date of a per-second file, None if there is no such file
+"""
+def file_date(path, second):
+    try:
+        return capture_date(second, os.path.getmtime(path))
+    except OSError:
+        return None
+
+
+"""
+Function to read the records of one station for one second of a date, from its '.bin'
+file, else its '.txt' file, else the segment file it was compacted into (see capture_index.py)
+args:
+    directory: station folder
+    second: second of day
+    date: YYYYMMDD (UTC) of the second
+returns:
+    structured array of RECORD_DTYPE, or None if the station has nothing of that second and date
+"""
+def read_station_second(directory, second, date):
+    path = directory + '/' + str(second)
+    if file_date(path + '.bin', second) == date:
+        return read_second(directory, second)
+    if file_date(path + '.txt', second) == date:
+        try:
+            with open(path + '.txt', 'rb') as f:
+                return text_lines_to_records(f.read().splitlines())
+        except OSError:
+            pass
+    return read_compacted_second(directory, second, date)
+
+
+"""
+Function that tells whether a station folder has any capture of a date in a range of
+seconds, in per-second files or in the segments they were compacted into
+"""
+def has_date(directory, date, start_second, end_second):
+    for hour in range(start_second // SECONDS_PER_SEGMENT, (end_second - 1) // SECONDS_PER_SEGMENT + 1):
+        if os.path.exists(directory + '/' + segment_filename(date, hour)):
+            return True
+    try:
+        for entry in os.scandir(directory):
+            match = capture_filename.match(entry.name)
+            if match is not None and start_second <= int(match.group(1)) < end_second:
+                if capture_date(int(match.group(1)), entry.stat().st_mtime) == date:
+                    return True
+    except OSError:
+        pass
+    return False
+
+
+"""
+Function that solves one chunk of seconds, in a worker process
+args:
+    master_folder: folder with one sub-folder per station
+    first, end: the chunk is the seconds first <= second < end
+    date: YYYYMMDD (UTC) of the seconds
+    minimum_num_stations, window_ns: see Correlator
+    assumed_altitude: altitude for groups of only 3 stations (m)
+    calibration_path: saved ClockCalibration to correct the timestamps with, or None
+returns:
+    (first, end, dictionary of COLUMNS -> arrays of the valid fixes, dictionary of counts)
+
+A transmission belongs to the chunk of its first reception. The second before the chunk
+is correlated too, so the end of a group that started in it is not mistaken for a group
+of its own, and the second after it, so a group at the end of the chunk is complete.
+"""
+def solve_chunk(master_folder, first, end, date, minimum_num_stations, window_ns, assumed_altitude, calibration_path=None):
+    configs = StationConfigCache()
+    stations = {}
+    for directory in sorted(master_folder + '/' + d for d in os.listdir(master_folder)):
+        config_data = configs.get(directory) if os.path.isdir(directory) else None
+        if config_data is not None and config_data.get("Feed_to_base") == True:
+            stations[directory] = config_data
+
+    calibration = None
+    if calibration_path is not None:
+        calibration = ClockCalibration()
+        if not calibration.load(calibration_path):
+            calibration = None
+    correlator = Correlator(minimum_num_stations, window_ns, calibration)
+    groups = []
+    counts = {'records': 0, 'groups': 0, 'fixes': 0}
+    for second in range(max(first - 1, 0), end + 1):
+        receptions = {}
+        for directory in stations:
+            records = read_station_second(directory, second, date)
+            if records is not None and len(records) > 0:
+                receptions[directory] = records
+        if first <= second < end:
+            counts['records'] += sum(map(len, receptions.values()))
+        groups.extend(correlator.process(second, receptions, stations))
+    groups.extend(correlator.flush())
+
+    times = group_times(groups)
+    in_chunk = (times >= first * 1000000000) & (times < end * 1000000000)
+    groups = [group for group, keep in zip(groups, in_chunk.tolist()) if keep]
+    times = times[in_chunk]
+    counts['groups'] = len(groups)
+
+    num_stations = np.array([len(group['ts_ns']) for group in groups], dtype=np.int64)
+    fixes = solve(groups, StationPositions(), altitude=np.where(num_stations == 3, assumed_altitude, np.nan))
+    valid = np.flatnonzero(fixes['valid'])
+    counts['fixes'] = len(valid)
+    columns = {
+        'time_ns': times[valid],
+        'key': track_keys(groups)[valid],
+        'df': np.array([group['df'] for group in groups], dtype=np.uint8)[valid],
+        'squawk': np.array([group['squawk'] for group in groups], dtype=np.uint16)[valid],
+        'num_stations': num_stations[valid],
+    }
+    for column in ('latitude', 'longitude', 'altitude', 'residual', 'gdop', 'iterations'):
+        columns[column] = fixes[column][valid]
+    return first, end, columns, counts
+
+
+"""
+Function that writes the fixes of one hour, sorted by time, replacing the file at once
+returns:
+    the filename written
+"""
+def write_hour(output_folder, date, hour, parts):
+    columns = {column: np.concatenate([part[column] for part in parts]) for column in COLUMNS}
+    order = np.argsort(columns['time_ns'], kind='stable')
+    columns = {column: values[order] for column, values in columns.items()}
+    return write_columns(output_folder + '/hour_%s_%02d' %(date, hour), columns)
+
+
+"""
+Function that writes a dictionary of columns to path + '.parquet', or path + '.npz'
+without pyarrow, replacing the file at once
+returns:
+    the filename written
+"""
+def write_columns(path, columns):
+    path = path + ('.parquet' if pyarrow is not None else '.npz')
+    temporary = path + '.tmp'
+    if pyarrow is not None:
+        pyarrow.parquet.write_table(pyarrow.table(columns), temporary)
+    else:
+        with open(temporary, 'wb') as f:
+            np.savez_compressed(f, **columns)
+    os.replace(temporary, path)
+    return os.path.basename(path)
+
+
+"""
+Function to read the checkpoint of output_folder, if it was written with the same settings
+returns:
+    dictionary of the hours already written -> [first, end] seconds solved in them
+"""
+def read_checkpoint(output_folder, settings):
+    try:
+        with open(output_folder + '/' + checkpoint_filename, 'r') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if checkpoint.get('settings') != settings:
+        print("Checkpoint in %s has different settings - starting over" %(output_folder))
+        return {}
+    return {int(hour): seconds for hour, seconds in checkpoint['hours'].items()}
+
+
+def write_checkpoint(output_folder, settings, hours):
+    path = output_folder + '/' + checkpoint_filename
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'settings': settings, 'hours': {str(hour): hours[hour] for hour in sorted(hours)}}, f)
+    os.replace(path + '.tmp', path)
+
+
+"""
+Function that backfills the seconds start_second <= second < end_second
+args:
+    master_folder: folder with one sub-folder per station
+    start_second, end_second: range of seconds (since UTC midnight, as the file names)
+    date: YYYYMMDD (UTC) of the range, today by default
+    output_folder: where the hourly files and the checkpoint are written
+    minimum_num_stations, window_ns, assumed_altitude, calibration_path: see solve_chunk()
+    workers: number of processes, all cores by default
+    chunk_seconds: seconds per task, a divisor of an hour
+    max_in_flight: chunks submitted but not yet collected, twice the workers by default -
+        bounds the memory of results waiting for the rest of their hour
+returns:
+    dictionary of counts: records, groups and fixes
+"""
+def backfill(master_folder, start_second, end_second, output_folder, minimum_num_stations=3, window_ns=2000000,
+             assumed_altitude=10000.0, workers=None, chunk_seconds=300, max_in_flight=None, calibration_path=None,
+             date=None):
+    if SECONDS_PER_HOUR % chunk_seconds != 0:
+        raise ValueError("chunk_seconds must divide an hour")
+    date = date or time.strftime(DATE_FORMAT, time.gmtime())
+    directories = [master_folder + '/' + d for d in os.listdir(master_folder)]
+    if not any(has_date(directory, date, start_second, end_second) for directory in directories if os.path.isdir(directory)):
+        raise ValueError("No station in %s has captures of %s in seconds %d to %d" %(master_folder, date, start_second, end_second - 1))
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    os.makedirs(output_folder, exist_ok=True)
+    settings = {'master_folder': os.path.abspath(master_folder), 'date': date, 'minimum_num_stations': minimum_num_stations,
+                'window_ns': window_ns, 'assumed_altitude': assumed_altitude,
+                'calibration_path': os.path.abspath(calibration_path) if calibration_path is not None else None}
+    done_hours = read_checkpoint(output_folder, settings)
+
+    # chunks of the hours not written yet, each hour cut to the range:
+    chunks = []
+    remaining = {}      # hour -> number of chunks not yet solved
+    hour_ranges = {}    # hour -> [first, end] seconds of it to be written
+    for hour in range(start_second // SECONDS_PER_HOUR, (end_second - 1) // SECONDS_PER_HOUR + 1):
+        hour_start = max(hour * SECONDS_PER_HOUR, start_second)
+        hour_end = min((hour + 1) * SECONDS_PER_HOUR, end_second)
+        done = done_hours.get(hour)
+        if done is not None and done[0] <= hour_start and done[1] >= hour_end:
+            continue
+        # an hour written in part is solved again, over both ranges:
+        if done is not None:
+            hour_start, hour_end = min(done[0], hour_start), max(done[1], hour_end)
+        hour_ranges[hour] = [hour_start, hour_end]
+        for first in range(hour_start - hour_start % chunk_seconds, hour_end, chunk_seconds):
+            chunks.append((max(first, hour_start), min(first + chunk_seconds, hour_end)))
+            remaining[hour] = remaining.get(hour, 0) + 1
+    print("Backfill of seconds %d to %d of %s: %d hours to write, %d chunks on %d workers"
+          %(start_second, end_second - 1, date, len(hour_ranges), len(chunks), workers))
+
+    totals = {'records': 0, 'groups': 0, 'fixes': 0}
+    parts = {}          # hour -> list of column dictionaries
+    started = time.monotonic()
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        next_chunk = 0
+        while next_chunk < len(chunks) or pending:
+            # keep at most max_in_flight chunks submitted:
+            while next_chunk < len(chunks) and len(pending) < max_in_flight:
+                first, end = chunks[next_chunk]
+                pending.add(pool.submit(solve_chunk, master_folder, first, end, date, minimum_num_stations,
+                                        window_ns, assumed_altitude, calibration_path))
+                next_chunk += 1
+            completed, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in completed:
+                first, end, columns, counts = future.result()
+                for key in totals:
+                    totals[key] += counts[key]
+                hour = first // SECONDS_PER_HOUR
+                parts.setdefault(hour, []).append(columns)
+                remaining[hour] -= 1
+                if remaining[hour] == 0:
+                    filename = write_hour(output_folder, date, hour, parts.pop(hour))
+                    done_hours[hour] = hour_ranges[hour]
+                    write_checkpoint(output_folder, settings, done_hours)
+                    elapsed = time.monotonic() - started
+                    print("%s written | %d records, %d groups, %d fixes so far | %.0f records/s"
+                          %(filename, totals['records'], totals['groups'], totals['fixes'], totals['records'] / elapsed))
+    return totals
+
+
+"""
+Function to read the fixes of one hourly file back, as a dictionary of COLUMNS -> arrays.
+Without pyarrow, a '.parquet' path is read from the '.npz' of the same hour if there is one
+"""
+def read_hour(path):
+    if path.endswith('.parquet') and pyarrow is None:
+        npz_path = path[:-len('.parquet')] + '.npz'
+        if not os.path.exists(npz_path):
+            raise ValueError("%s is a Parquet file and pyarrow is not installed" % path)
+        path = npz_path
+    if path.endswith('.parquet'):
+        table = pyarrow.parquet.read_table(path)
+        return {column: table.column(column).to_numpy() for column in table.column_names}
+    with np.load(path) as data:
+        return {column: data[column] for column in data.files}
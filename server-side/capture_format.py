@@ -0,0 +1,203 @@
+# necessary imports:
+import os
+import struct
+import numpy as np
+
+"""
+Reader for the binary per-second capture files, '<second>.bin', written by the clients
+(see capture_format.py of the client). This layout has to be kept in step with it:
+    header: magic, version, record size, second of the file
+    records: fixed width, see RECORD_DTYPE
+"""
+MAGIC = b'MLAT'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQ')
+MAX_FRAME_LEN = 22
+PAYLOAD_START = 8      # type byte, 6 byte timestamp, signal level
+
+RECORD_DTYPE = np.dtype({
+    'names': ['ts_ns', 'rx_time', 'squawk', 'df', 'frame_len', 'frame', 'reserved'],
+    'formats': ['<i8', '<f8', '<u2', 'u1', 'u1', ('u1', MAX_FRAME_LEN), ('u1', 6)],
+    'offsets': [0, 8, 16, 18, 19, 20, 42],
+    'itemsize': 48,
+})
+
+
+"""
+Function to memory-map one binary capture file
+args:
+    path: path of a '<second>.bin' file
+returns:
+    (second, records) - records is a read-only structured array of RECORD_DTYPE
+    backed by the file, i.e. nothing is parsed until a field is used
+"""
+def read_capture(path):
+    with open(path, 'rb') as f:
+        magic, version, record_size, second = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError("%s is not a version %d capture file" % (path, VERSION))
+
+    # a client may still be appending - ignore a partially written last record:
+    count = (os.path.getsize(path) - HEADER.size) // record_size
+    if count == 0:
+        return second, np.zeros(0, dtype=RECORD_DTYPE)
+    return second, np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+
+
+"""
+Function to read the records of one station for one second
+args:
+    directory: station folder, e.g. 'Resilio/station_0'
+    target_time: an integer, the second of the file
+returns:
+    structured array of RECORD_DTYPE, or None if the station has no binary file for that second
+"""
+def read_second(directory, target_time):
+    path = directory + '/' + str(target_time) + '.bin'
+    if not os.path.exists(path):
+        return None
+    return read_capture(path)[1]
+
+
+"""
+Function to convert records to the list-form rows read from the text files
+args:
+    records: structured array of RECORD_DTYPE
+    location_name: 'Location name' of the station, inserted as the first column
+returns:
+    list of [location_name, full_message, time_hex, ts, rx_time, df, squawk] - ts is the
+    MLAT timestamp in float seconds, the same value as the 'ts' column of the text files
+"""
+def records_to_rows(records, location_name):
+    rows = []
+    for record in records:
+        full_message = bytes(record['frame'][:record['frame_len']]).hex().upper()
+        # a 2 byte payload is Mode-AC whatever its type byte, as in the client's decoder:
+        if record['frame_len'] - PAYLOAD_START == 2:
+            squawk = '%04X' % record['squawk']
+        else:
+            squawk = '%04d' % record['squawk']
+        # the clients write ts as float("%d.%d" % (seconds, nanoseconds)):
+        seconds, nanoseconds = divmod(int(record['ts_ns']), 1000000000)
+        rows.append([location_name, full_message, full_message[2:14], float('%d.%d' % (seconds, nanoseconds)),
+                     float(record['rx_time']), int(record['df']), squawk])
+    return rows
+
+
+"""
+Function to convert lines of the text files to records, so text and binary stations
+can be handled alike
+args:
+    lines: list of lines (bytes) "'full_message', 'time_hex', ts, localtime, downlink, 'squawk'"
+returns:
+    structured array of RECORD_DTYPE, lines that cannot be parsed are skipped
+"""
+def text_lines_to_records(lines):
+    records = np.zeros(len(lines), dtype=RECORD_DTYPE)
+    count = 0
+    for line in lines:
+        try:
+            full_message, time_hex, ts, localtime, downlink, squawk = [field.strip(b" '\r\n") for field in line.split(b',')]
+            frame = bytes.fromhex(full_message.decode())[:MAX_FRAME_LEN]
+            timestamp = int(time_hex, 16)
+            record = records[count]
+            # exact integer nanoseconds, from the timestamp bits rather than the lossy float 'ts':
+            record['ts_ns'] = (timestamp >> 30) * 1000000000 + (timestamp & 0x3FFFFFFF)
+            record['rx_time'] = float(localtime)
+            record['df'] = int(downlink)
+            # Mode-AC squawk is the hexadecimal 2 byte payload:
+            record['squawk'] = int(squawk, 16) if len(frame) - PAYLOAD_START == 2 else int(squawk)
+            record['frame_len'] = len(frame)
+            record['frame'][:len(frame)] = np.frombuffer(frame, dtype=np.uint8)
+            count += 1
+        except ValueError:
+            continue
+    return records[:count]
+
+
+"""
+Hourly segment files, 'segment_<date>_<hour>.bin' (date as YYYYMMDD, UTC), into which the
+index compacts the per-second files of one station (see capture_index.py). The per-second
+files are named by second of day only, so the date keeps the hours of different days
+apart. Server-side only:
+    header: as a capture file, with SEGMENT_MAGIC and the first second of the hour
+    counts: number of records of each second of the hour, SEGMENT_COUNTS
+    records: the records of every second, in order of seconds, see RECORD_DTYPE
+"""
+SEGMENT_MAGIC = b'MLSG'
+SECONDS_PER_SEGMENT = 3600
+SEGMENT_COUNTS = np.dtype(('<u4', SECONDS_PER_SEGMENT))
+
+
+def segment_filename(date, hour):
+    return 'segment_%s_%d.bin' % (date, hour)
+
+
+"""
+Function to write a segment file, replacing any previous one at once
+args:
+    path: path of the segment file
+    hour: the hour of day of the segment (second // SECONDS_PER_SEGMENT)
+    records_by_second: dictionary of second -> structured array of RECORD_DTYPE
+returns:
+    dictionary of second -> (offset in the file (bytes), number of records)
+"""
+def write_segment(path, hour, records_by_second):
+    counts = np.zeros(SECONDS_PER_SEGMENT, dtype='<u4')
+    for second, records in records_by_second.items():
+        counts[second - hour * SECONDS_PER_SEGMENT] = len(records)
+    offsets = {}
+    offset = HEADER.size + SEGMENT_COUNTS.itemsize
+    with open(path + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(SEGMENT_MAGIC, VERSION, RECORD_DTYPE.itemsize, hour * SECONDS_PER_SEGMENT))
+        f.write(counts.tobytes())
+        for second in sorted(records_by_second):
+            records = np.ascontiguousarray(records_by_second[second], dtype=RECORD_DTYPE)
+            f.write(records.tobytes())
+            offsets[second] = (offset, len(records))
+            offset += records.nbytes
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    return offsets
+
+
+"""
+Function to read the records of one second from a segment file, without an index
+args:
+    path: path of a 'segment_<hour>.bin' file
+    second: a second of that hour
+returns:
+    structured array of RECORD_DTYPE backed by the file, only that second's records are read
+"""
+def read_segment_second(path, second):
+    with open(path, 'rb') as f:
+        magic, version, record_size, first_second = HEADER.unpack(f.read(HEADER.size))
+        if magic != SEGMENT_MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ValueError("%s is not a version %d segment file" % (path, VERSION))
+        counts = np.frombuffer(f.read(SEGMENT_COUNTS.itemsize), dtype='<u4').astype(np.int64)
+    index = second - first_second
+    count = int(counts[index])
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    offset = HEADER.size + SEGMENT_COUNTS.itemsize + int(counts[:index].sum()) * record_size
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=offset, shape=(count,))
+
+
+"""
+Function to read the records of one station and second from its hourly segment file,
+for readers without the index (see backfill.py)
+args:
+    directory: station folder
+    target_time: second of day
+    date: YYYYMMDD of the segment
+returns:
+    structured array of RECORD_DTYPE, or None if the station has no segment for that
+    date and hour
+"""
+def read_compacted_second(directory, target_time, date):
+    hour = target_time // SECONDS_PER_SEGMENT
+    path = directory + '/' + segment_filename(date, hour)
+    if not os.path.exists(path):
+        return None
+    return read_segment_second(path, target_time)
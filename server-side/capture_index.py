@@ -0,0 +1,356 @@
+# necessary imports:
+import argparse
+import calendar
+import os
+import sqlite3
+import time
+import numpy as np
+from capture_format import (HEADER, RECORD_DTYPE, SECONDS_PER_SEGMENT, read_capture, segment_filename,
+                            text_lines_to_records, write_segment)
+from ingest import capture_filename
+from tracker import crc24
+
+"""
+Index of the capture files of all stations in master_folder, kept in one SQLite file:
+    files: (station, date, second) -> file, byte offset and number of records, so the
+        records of a second are read without scanning anything else
+    keys: (ICAO address or squawk) -> dates, seconds and stations with a reception of it
+The per-second files are named by second of day, so the same name comes back every day:
+each file is dated by its modification time (see capture_date()), and the index and the
+segment files are keyed by date and second.
+update() indexes only what was appended since the last call, so it can run alongside
+the clients' files as they grow. compact() packs the per-second files of hours that are
+complete into one segment file per station, date and hour (see capture_format.py), and
+deletes the per-second files, so a station folder holds a few dozen files per day
+instead of tens of thousands. A file that arrives, or grows, after its hour was
+compacted is merged into the segment by the next compact().
+
+The index file should not be in master_folder, where it would be synced to the stations.
+Mode-AC messages are not indexed by squawk, their code is the raw reply.
+"""
+KIND_ICAO = 0
+KIND_SQUAWK = 1
+SQUAWK_DF = (5, 21)     # downlink formats with an identity (squawk) field
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (station TEXT, date TEXT, second INTEGER, path TEXT, offset INTEGER, count INTEGER,
+                                  size INTEGER, PRIMARY KEY (station, date, second)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS keys (kind INTEGER, value INTEGER, date TEXT, second INTEGER, station TEXT,
+                                 PRIMARY KEY (kind, value, date, second, station)) WITHOUT ROWID;
+"""
+DATE_FORMAT = '%Y%m%d'
+SECONDS_PER_DAY = 86400
+
+
+"""
+Function to date a per-second file: the UTC day whose midnight plus 'second' is nearest
+to the time the file was last written, so a file of 23:59:59 written just after midnight
+is still dated the day before
+args:
+    second: second of day of the file
+    mtime: modification time of the file (UNIX time)
+returns:
+    date as YYYYMMDD (str)
+"""
+def capture_date(second, mtime):
+    day = int(round((mtime - second) / SECONDS_PER_DAY))
+    return time.strftime(DATE_FORMAT, time.gmtime(day * SECONDS_PER_DAY))
+
+
+"""
+Function that returns the UNIX time of a second of day on a date (YYYYMMDD)
+"""
+def date_time(date, second):
+    return calendar.timegm(time.strptime(date, DATE_FORMAT)) + second
+
+
+"""
+Function to get the identities of records, as indexed
+args:
+    records: structured array of RECORD_DTYPE
+returns:
+    icao: (n,) int64 array of ICAO addresses, -1 for Mode-AC
+    squawk: (n,) int64 array of squawks (as decimal digits, e.g. 7700), -1 where the
+        message has no identity field
+"""
+def record_keys(records):
+    icao = np.full(len(records), -1, dtype=np.int64)
+    frame_len = records['frame_len'].astype(np.int64)
+    for length in (7, 14):
+        index = np.flatnonzero(frame_len == 8 + length)
+        if len(index) == 0:
+            continue
+        payload = records['frame'][index, 8:8 + length]
+        df = payload[:, 0] >> 3
+        parity = (payload[:, -3].astype(np.int64) << 16) | (payload[:, -2].astype(np.int64) << 8) | payload[:, -1]
+        announced = (payload[:, 1].astype(np.int64) << 16) | (payload[:, 2].astype(np.int64) << 8) | payload[:, 3]
+        icao[index] = np.where(np.isin(df, (11, 17, 18)), announced, parity ^ crc24(payload[:, :-3]))
+    squawk = np.where((icao >= 0) & np.isin(records['df'], SQUAWK_DF), records['squawk'].astype(np.int64), -1)
+    return icao, squawk
+
+
+"""
+Index of the per-second and segment files of master_folder
+args:
+    master_folder: folder with one sub-folder per station
+    index_path: the SQLite file, created if needed
+"""
+class CaptureIndex:
+
+    def __init__(self, master_folder, index_path):
+        self.master_folder = master_folder
+        self.db = sqlite3.connect(index_path)
+        self.db.executescript(SCHEMA)
+
+    def stations(self):
+        try:
+            return sorted(d for d in os.listdir(self.master_folder) if os.path.isdir(self.master_folder + '/' + d))
+        except OSError:
+            return []
+
+    """
+    returns:
+        dictionary of (date, second) -> os.DirEntry of the per-second files of a station
+        folder, '.bin' when a station writes both, None if the folder cannot be read
+    """
+    def capture_files(self, directory):
+        files = {}
+        try:
+            for entry in os.scandir(directory):
+                match = capture_filename.match(entry.name)
+                if match is None:
+                    continue
+                second = int(match.group(1))
+                key = (capture_date(second, entry.stat().st_mtime), second)
+                if match.group(2) == 'bin' or key not in files:
+                    files[key] = entry
+        except OSError:
+            return None
+        return files
+
+    """
+    Indexes the records appended to the per-second files since the last update
+    returns:
+        number of records indexed
+    """
+    def update(self):
+        total = 0
+        for station in self.stations():
+            directory = self.master_folder + '/' + station
+            indexed = {(date, second): (path, size) for date, second, path, size in
+                       self.db.execute("SELECT date, second, path, size FROM files WHERE station = ?", (station,))}
+            files = self.capture_files(directory)
+            if files is None:
+                continue
+
+            for (date, second), entry in sorted(files.items()):
+                path, size = indexed.get((date, second), (None, 0))
+                if path is not None and path != entry.name:
+                    continue    # already compacted (late data is merged by compact()), or switched from '.txt' to '.bin'
+                try:
+                    records, size, count = self.read_appended(directory + '/' + entry.name, size)
+                except (OSError, ValueError):
+                    continue
+                if records is None:
+                    continue
+                self.add(station, date, second, entry.name, records, size, count)
+                total += len(records)
+        self.db.commit()
+        return total
+
+    """
+    returns:
+        (new records or None, bytes of the file indexed, number of records indexed)
+    """
+    def read_appended(self, path, size):
+        if os.path.getsize(path) <= size:
+            return None, size, None
+        if path.endswith('.bin'):
+            _, records = read_capture(path)
+            start = max(size - HEADER.size, 0) // RECORD_DTYPE.itemsize
+            return np.asarray(records[start:]), HEADER.size + len(records) * RECORD_DTYPE.itemsize, len(records)
+        with open(path, 'rb') as f:
+            f.seek(size)
+            data = f.read()
+        # only whole lines, a partial last line is indexed once it is complete:
+        complete = data.rfind(b'\n') + 1
+        records = text_lines_to_records(data[:complete].splitlines())
+        return records, size + complete, None
+
+    def add_keys(self, station, date, second, records):
+        icao, squawk = record_keys(records)
+        rows = [(KIND_ICAO, value, date, second, station) for value in np.unique(icao[icao >= 0]).tolist()]
+        rows += [(KIND_SQUAWK, value, date, second, station) for value in np.unique(squawk[squawk >= 0]).tolist()]
+        self.db.executemany("INSERT OR IGNORE INTO keys VALUES (?, ?, ?, ?, ?)", rows)
+
+    def add(self, station, date, second, path, records, size, count):
+        self.add_keys(station, date, second, records)
+        if count is None:
+            previous = self.db.execute("SELECT count FROM files WHERE station = ? AND date = ? AND second = ?",
+                                       (station, date, second)).fetchone()
+            count = (previous[0] if previous is not None else 0) + len(records)
+        offset = HEADER.size if path.endswith('.bin') else 0
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (station, date, second, path, offset, count, size))
+
+    """
+    Reads the records of one station, date and second, only the bytes of that second
+    returns:
+        structured array of RECORD_DTYPE, empty if not indexed
+    """
+    def records(self, station, date, second):
+        row = self.db.execute("SELECT path, offset, count FROM files WHERE station = ? AND date = ? AND second = ?",
+                              (station, date, second)).fetchone()
+        if row is None or row[2] == 0:
+            return np.zeros(0, dtype=RECORD_DTYPE)
+        path, offset, count = self.master_folder + '/' + station + '/' + row[0], row[1], row[2]
+        if path.endswith('.txt'):
+            with open(path, 'rb') as f:
+                return text_lines_to_records(f.read().splitlines())
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=offset, shape=(count,))
+
+    """
+    Receptions of one aircraft, by ICAO address and/ or squawk
+    args:
+        icao, squawk: identity to look for (ints, e.g. 0x76CD01 or 7700), either or both
+        start, end: seconds of day start <= second < end
+        date: YYYYMMDD to look in, None for every date
+    returns:
+        list of (station, date, second, records) - only the matching records of that second
+    """
+    def find(self, icao=None, squawk=None, start=0, end=1 << 62, date=None):
+        conditions = [(KIND_ICAO, icao)] if icao is not None else []
+        conditions += [(KIND_SQUAWK, squawk)] if squawk is not None else []
+        if not conditions:
+            raise ValueError("find() needs an icao address or a squawk")
+        # the seconds of every condition, intersected:
+        candidates = None
+        for kind, value in conditions:
+            found = set(self.db.execute("SELECT date, second, station FROM keys WHERE kind = ? AND value = ? "
+                                        "AND second >= ? AND second < ? AND (? IS NULL OR date = ?)",
+                                        (kind, value, start, end, date, date)))
+            candidates = found if candidates is None else candidates & found
+        results = []
+        for found_date, second, station in sorted(candidates):
+            records = self.records(station, found_date, second)
+            record_icao, record_squawk = record_keys(records)
+            match = np.ones(len(records), dtype=bool)
+            if icao is not None:
+                match &= record_icao == icao
+            if squawk is not None:
+                match &= record_squawk == squawk
+            if match.any():
+                results.append((station, found_date, second, np.asarray(records[match])))
+        return results
+
+    """
+    Packs the per-second files of every complete hour before 'before' into one segment
+    file per station, date and hour, then deletes them. Files of an hour compacted
+    earlier (late, or grown since) are merged into its segment.
+    args:
+        before: UNIX time, only hours ending at or before it are compacted, e.g. the
+            current time minus a margin for late files
+    returns:
+        number of segment files written
+    """
+    def compact(self, before):
+        self.update()
+        written = 0
+        for station in self.stations():
+            directory = self.master_folder + '/' + station
+            files = self.capture_files(directory)
+            if files is None:
+                continue
+            hours = sorted({(date, second // SECONDS_PER_SEGMENT) for date, second in files
+                            if date_time(date, (second // SECONDS_PER_SEGMENT + 1) * SECONDS_PER_SEGMENT) <= before})
+            for date, hour in hours:
+                rows = self.db.execute("SELECT second, path, size FROM files WHERE station = ? AND date = ? "
+                                       "AND second >= ? AND second < ?",
+                                       (station, date, hour * SECONDS_PER_SEGMENT, (hour + 1) * SECONDS_PER_SEGMENT)).fetchall()
+                records_by_second = {}
+                merged = {}     # second -> (per-second file, its bytes now in the segment)
+                for second, path, size in rows:
+                    entry = files.get((date, second))
+                    if path.startswith('segment_'):
+                        # a segment written earlier is merged with what arrived for it since:
+                        records = np.array(self.records(station, date, second))
+                        if entry is not None:
+                            try:
+                                # a file smaller than what was merged of it is a new one:
+                                if os.path.getsize(entry.path) < size:
+                                    size = 0
+                                late, size, _ = self.read_appended(entry.path, size)
+                            except (OSError, ValueError):
+                                late = None
+                            if late is not None:
+                                records = np.concatenate((records, late))
+                                self.add_keys(station, date, second, late)
+                            merged[second] = (entry, size)
+                    elif entry is not None and entry.name == path:
+                        # the whole file, and its size at the time it was read:
+                        try:
+                            records, size, _ = self.read_appended(entry.path, 0)
+                        except (OSError, ValueError):
+                            records = None
+                        if records is None:
+                            records, size = np.array(self.records(station, date, second)), 0
+                        else:
+                            self.add_keys(station, date, second, records)
+                        merged[second] = (entry, size)
+                    else:
+                        try:
+                            records = np.array(self.records(station, date, second))
+                        except (OSError, ValueError):
+                            records = np.zeros(0, dtype=RECORD_DTYPE)  # removed since it was indexed
+                    records_by_second[second] = records
+                filename = segment_filename(date, hour)
+                offsets = write_segment(directory + '/' + filename, hour, records_by_second)
+                self.db.executemany("UPDATE files SET path = ?, offset = ?, count = ?, size = ? "
+                                    "WHERE station = ? AND date = ? AND second = ?",
+                                    [(filename, offset, count, merged[second][1] if second in merged else 0, station, date, second)
+                                     for second, (offset, count) in offsets.items()])
+                self.db.commit()
+                # only once the segment is in the index, and only files holding nothing more
+                # (a file that grew meanwhile is merged from 'size' by the next compact()):
+                removed = []
+                for second, (entry, size) in merged.items():
+                    try:
+                        if os.path.getsize(entry.path) != size:
+                            continue
+                        os.remove(entry.path)
+                        removed.append(second)
+                        if entry.name.endswith('.bin'):
+                            os.remove(entry.path[:-len('.bin')] + '.txt')
+                    except OSError:
+                        pass
+                # a file of the same second arriving later starts from its first byte:
+                self.db.executemany("UPDATE files SET size = 0 WHERE station = ? AND date = ? AND second = ?",
+                                    [(station, date, second) for second in removed])
+                self.db.commit()
+                written += 1
+        return written
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index, compact and query the station capture files")
+    parser.add_argument('master_folder')
+    parser.add_argument('--index', default='capture_index.sqlite', help="SQLite file of the index")
+    parser.add_argument('--compact-margin', type=int, help="compact the hours that ended this many seconds ago")
+    parser.add_argument('--icao', type=lambda value: int(value, 16), help="ICAO address to look for (hex)")
+    parser.add_argument('--squawk', type=int, help="squawk to look for, e.g. 7700")
+    parser.add_argument('--start', type=int, default=0, help="first second of day of the query")
+    parser.add_argument('--end', type=int, default=1 << 62, help="end second of day of the query (excluded)")
+    parser.add_argument('--date', help="date of the query, YYYYMMDD (UTC), every date by default")
+    args = parser.parse_args()
+
+    index = CaptureIndex(args.master_folder, args.index)
+    print("Indexed %d new records" % index.update())
+    if args.compact_margin is not None:
+        print("Wrote %d segment files" % index.compact(time.time() - args.compact_margin))
+    if args.icao is not None or args.squawk is not None:
+        for station, date, second, records in index.find(args.icao, args.squawk, args.start, args.end, args.date):
+            print("%s %s %d: %d receptions" % (station, date, second, len(records)))
+    index.close()
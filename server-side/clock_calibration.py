@@ -0,0 +1,273 @@
+# necessary imports:
+import json
+import os
+from collections import deque
+import numpy as np
+from solver import SPEED_OF_LIGHT, geodetic_to_ecef
+from tracker import track_keys
+
+"""
+Station clock calibration. A reception at a known position tells how far apart the clocks
+of the receiving stations are: for stations k and 0 of a group,
+    (t_k - t_0) - (range_k - range_0) / c = offset_k - offset_0
+Known positions come from:
+    - a reference transponder listed in a station's '0_station_config.yml', e.g.
+        Reference transponder: {ICAO: '76CD01', Latitude: 1.35, Longitude: 103.99, Altitude: 20}
+    - ADS-B (DF17/ 18) airborne position messages, decoded against the receiving station
+      (CPR local decode). Barometric altitudes are used as heights, which biases a few
+      observations by tens of ns - the fit over many aircraft averages it out.
+Each station's clock is modelled as offset + drift * (t - epoch) relative to a reference
+station, fitted by least squares over the observations of the last 'window' seconds, with
+outliers clipped. The correlator subtracts the correction from the timestamps of every
+reception (see Correlator), so the solver only ever sees calibrated timestamps.
+"""
+FEET = 0.3048
+CPR_SCALE = float(1 << 17)
+NZ = 15     # latitude zones of CPR
+
+
+"""
+Function for the number of CPR longitude zones at a latitude, element-wise
+"""
+def cpr_nl(latitude):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = 1 - (1 - np.cos(np.pi / (2 * NZ))) / np.cos(np.radians(latitude)) ** 2
+        nl = np.floor(2 * np.pi / np.arccos(a))
+    nl = np.where(np.abs(latitude) > 87, 1, np.where(np.abs(latitude) == 87, 2, nl))
+    return np.where(latitude == 0, 59, nl)
+
+
+"""
+Function to decode ADS-B airborne position messages near a reference position
+args:
+    payload: (n, 14) uint8 array of DF17/ 18 messages
+    reference_latitude, reference_longitude: (n,) positions within 180 NM of the aircraft
+        (degrees), e.g. the receiving station
+returns:
+    latitude, longitude (degrees), altitude (m) - (n,) arrays, altitude NaN where the
+    message is not an airborne position or has no usable altitude
+"""
+def airborne_positions(payload, reference_latitude, reference_longitude):
+    me = np.zeros(len(payload), dtype=np.int64)
+    for column in range(4, 11):
+        me = (me << 8) | payload[:, column]
+    tc = me >> 51
+    alt = (me >> 36) & 0xFFF
+    odd = (me >> 34) & 1
+    lat_cpr = ((me >> 17) & 0x1FFFF) / CPR_SCALE
+    lon_cpr = (me & 0x1FFFF) / CPR_SCALE
+
+    # barometric altitude in 25 ft steps (Q bit set), or GNSS height in m:
+    baro = (tc >= 9) & (tc <= 18) & ((alt & 0x10) != 0)
+    gnss = (tc >= 20) & (tc <= 22) & (alt > 0)
+    feet = (((alt & 0xFE0) >> 1) | (alt & 0xF)) * 25 - 1000
+    altitude = np.where(baro, feet * FEET, np.where(gnss, alt, np.nan))
+
+    # the zone closest to the reference:
+    dlat = 360.0 / (4 * NZ - odd)
+    j = np.floor(reference_latitude / dlat) + np.floor(0.5 + np.mod(reference_latitude, dlat) / dlat - lat_cpr)
+    latitude = dlat * (j + lat_cpr)
+    dlon = 360.0 / np.maximum(cpr_nl(latitude) - odd, 1)
+    m = np.floor(reference_longitude / dlon) + np.floor(0.5 + np.mod(reference_longitude, dlon) / dlon - lon_cpr)
+    longitude = dlon * (m + lon_cpr)
+    return latitude, longitude, altitude
+
+
+"""
+Clock offsets and drifts of the stations, estimated from the correlated groups
+args:
+    window: seconds of observations in the fit
+    min_observations: observations a station needs in the window to be (re-)estimated
+    max_offset_ns: observations implying a larger offset are dropped (bad decodes)
+    clip: residuals beyond this many RMS are dropped and the fit repeated
+    max_range: receptions further than this from a station are not used (m), as a local
+        CPR decode is only unambiguous within 180 NM
+"""
+class ClockCalibration:
+
+    def __init__(self, window=300.0, min_observations=20, max_offset_ns=100000.0, clip=3.0, max_range=300000.0):
+        self.window_ns = int(window * 1e9)
+        self.min_observations = min_observations
+        self.max_offset_ns = max_offset_ns
+        self.clip = clip
+        self.max_range = max_range
+        self.reference = None       # directory of the station the others are calibrated to
+        self.estimates = {}         # directory -> dictionary, see update()
+        self.configs = {}           # directory -> config_data
+        self.station_ids = {}       # directory -> station index of the observations
+        self.directories = []       # station index -> directory
+        self.observations = deque() # arrays of (t_ns, station, other station, offset_ns) rows
+        self.observed = 0
+
+    """
+    args:
+        directory: station folder
+        ts_ns: (n,) int64 timestamps of its receptions
+    returns:
+        (n,) int64 corrections (ns) to subtract from ts_ns, zero for uncalibrated stations
+    """
+    def correction(self, directory, ts_ns):
+        estimate = self.estimates.get(directory)
+        if estimate is None:
+            return np.zeros(len(ts_ns), dtype=np.int64)
+        # the drift is not extrapolated further than a window (e.g. across midnight):
+        elapsed = np.clip(np.asarray(ts_ns) - estimate['epoch_ns'], -self.window_ns, self.window_ns) * 1e-9
+        return np.rint(estimate['offset_ns'] + estimate['drift_ppb'] * elapsed).astype(np.int64)
+
+    """
+    Function that collects the observations of groups with a known position
+    args:
+        groups: list of groups from the correlator, with 'clock_ns'
+        station_positions: StationPositions cache
+    returns:
+        number of observations collected
+    """
+    def observe(self, groups, station_positions):
+        if not groups:
+            return 0
+        for group in groups:
+            self.configs.update(zip(group['directories'], group['configs']))
+        positions = np.full((len(groups), 3), np.nan)
+
+        # ADS-B airborne positions:
+        candidates = [i for i, group in enumerate(groups) if len(group['frame']) == 22 and group['frame'][8] >> 3 in (17, 18)]
+        if candidates:
+            payload = np.frombuffer(b''.join(groups[i]['frame'][8:] for i in candidates), dtype=np.uint8).reshape(-1, 14)
+            reference_latitude = np.array([groups[i]['configs'][0]["Latitude"] for i in candidates], dtype=np.float64)
+            reference_longitude = np.array([groups[i]['configs'][0]["Longitude"] for i in candidates], dtype=np.float64)
+            latitude, longitude, altitude = airborne_positions(payload, reference_latitude, reference_longitude)
+            positions[candidates] = geodetic_to_ecef(latitude, longitude, altitude)
+
+        # reference transponders, surveyed positions take precedence:
+        transponders = self.reference_transponders()
+        if transponders:
+            for i, key in enumerate(track_keys(groups).tolist()):
+                if key in transponders:
+                    positions[i] = transponders[key]
+
+        rows = []
+        for i in np.flatnonzero(np.isfinite(positions).all(axis=1)):
+            group = groups[i]
+            stations = np.array([station_positions.get(d, c) for d, c in zip(group['directories'], group['configs'])])
+            ranges = np.linalg.norm(stations - positions[i], axis=1)
+            if ranges.max() > self.max_range:
+                continue
+            raw = group['ts_ns'] + group['clock_ns']
+            offsets = (raw[1:] - raw[0]) - (ranges[1:] - ranges[0]) * (1e9 / SPEED_OF_LIGHT)
+            first = self.station_index(group['directories'][0])
+            for directory, offset in zip(group['directories'][1:], offsets.tolist()):
+                if abs(offset) <= self.max_offset_ns:
+                    rows.append((raw[0], self.station_index(directory), first, offset))
+        if rows:
+            self.observations.append(np.array(rows, dtype=np.float64))
+            self.observed += len(rows)
+        return len(rows)
+
+    def station_index(self, directory):
+        if directory not in self.station_ids:
+            self.station_ids[directory] = len(self.directories)
+            self.directories.append(directory)
+        return self.station_ids[directory]
+
+    """
+    returns:
+        dictionary of ICAO address -> (3,) ECEF position of the reference transponders
+        listed in the station configurations
+    """
+    def reference_transponders(self):
+        transponders = {}
+        for config_data in self.configs.values():
+            transponder = config_data.get("Reference transponder")
+            if transponder:
+                transponders[int(str(transponder["ICAO"]), 16)] = geodetic_to_ecef(
+                    transponder["Latitude"], transponder["Longitude"], transponder.get("Altitude", 0.0))
+        return transponders
+
+    """
+    Function that fits the clock of every station with enough observations in the window
+    args:
+        now_ns: drop observations further than the window from it, the newest by default
+    returns:
+        list of the directories estimated, empty if the reference station has too few
+        observations (the previous estimates are kept)
+    """
+    def update(self, now_ns=None):
+        if not self.observations:
+            return []
+        if now_ns is None:
+            now_ns = self.observations[-1][:, 0].max()
+        while self.observations and np.abs(self.observations[0][:, 0] - now_ns).max() > self.window_ns:
+            self.observations.popleft()
+        if not self.observations:
+            return []
+        data = np.concatenate(self.observations)
+        directories = self.directories
+        t, station, other, offset = data[:, 0], data[:, 1].astype(np.int64), data[:, 2].astype(np.int64), data[:, 3]
+
+        # the station flagged 'Clock reference' in its configuration, or else the first one:
+        if self.reference is None:
+            flagged = [d for d in sorted(directories) if self.configs.get(d, {}).get("Clock reference") == True]
+            self.reference = flagged[0] if flagged else min(directories)
+        counts = np.bincount(station, minlength=len(directories)) + np.bincount(other, minlength=len(directories))
+        reference = directories.index(self.reference) if self.reference in directories else -1
+        if reference < 0 or counts[reference] < self.min_observations:
+            return []
+        estimated = [s for s in range(len(directories)) if s != reference and counts[s] >= self.min_observations]
+        if not estimated:
+            return []
+
+        # columns offset and drift of each estimated station, the reference is 0:
+        column = np.full(len(directories), -1)
+        column[estimated] = np.arange(len(estimated))
+        use = ((column[station] >= 0) | (station == reference)) & ((column[other] >= 0) | (other == reference))
+        epoch = int(np.mean(t[use])) if use.any() else int(now_ns)
+        for _ in range(3):
+            rows = np.flatnonzero(use)
+            if len(rows) < 2 * len(estimated):
+                return []
+            elapsed = (t[rows] - epoch) * 1e-9
+            design = np.zeros((len(rows), 2 * len(estimated)))
+            for side, sign in ((station, 1.0), (other, -1.0)):
+                known = column[side[rows]] >= 0
+                index = 2 * column[side[rows]][known]
+                design[np.flatnonzero(known), index] = sign
+                design[np.flatnonzero(known), index + 1] = sign * elapsed[known]
+            solution = np.linalg.lstsq(design, offset[rows], rcond=None)[0]
+            residual = np.full(len(offset), np.inf)
+            residual[rows] = offset[rows] - design @ solution
+            rms = np.sqrt(np.mean(residual[rows] ** 2))
+            clipped = use & (np.abs(residual) <= max(self.clip * rms, 1.0))
+            if np.count_nonzero(clipped) == len(rows):
+                break
+            use = clipped
+
+        estimated_directories = []
+        for s in estimated:
+            involved = use & ((station == s) | (other == s))
+            self.estimates[directories[s]] = {
+                'offset_ns': float(solution[2 * column[s]]),
+                'drift_ppb': float(solution[2 * column[s] + 1]),
+                'epoch_ns': epoch,
+                'rms_ns': float(np.sqrt(np.mean(residual[involved] ** 2))) if involved.any() else float('nan'),
+                'observations': int(np.count_nonzero(involved)),
+            }
+            estimated_directories.append(directories[s])
+        return estimated_directories
+
+    """
+    Functions to keep the estimates across restarts, written at once like the backfill checkpoint
+    """
+    def save(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'reference': self.reference, 'stations': self.estimates}, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def load(self, path):
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.reference = saved.get('reference')
+        self.estimates = saved.get('stations', {})
+        return True
@@ -0,0 +1,428 @@
+# necessary imports:
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import time
+import numpy as np
+import yaml
+from capture_format import HEADER, MAGIC, VERSION, RECORD_DTYPE, text_lines_to_records
+
+"""
+Streaming ingest of the per-second files synced into master_folder by the clients.
+Instead of re-reading every '<second>.txt' once per target second, each station folder
+is watched and only the bytes appended since the last read are parsed. A second is
+emitted to the multilateration stage as soon as enough stations have reported it.
+
+The files are named by second of day, so seconds are compared modulo a day: a file up to
+ROLLOVER_SECONDS after the next second to emit is ahead of it (after midnight, 0.txt is
+ahead of 86399), any other has been emitted already. Internally the seconds keep counting
+past 86399, the seconds emitted are seconds of day. A file that was last written more than
+ROLLOVER_SECONDS ago is left from an earlier day, only what is appended to it is read.
+"""
+config_filename = '0_station_config.yml'
+capture_filename = re.compile(r'^(\d+)\.(txt|bin)$')
+DAY_SECONDS = 86400
+ROLLOVER_SECONDS = 43200
+
+
+"""
+Cache of the station configurations, reloaded only when '0_station_config.yml' changes
+"""
+class StationConfigCache:
+
+    def __init__(self):
+        self.cache = {}     # directory -> (mtime_ns, config_data)
+
+    """
+    args:
+        directory: station folder
+    returns:
+        the station's config_data, or None if it cannot be read
+    """
+    def get(self, directory):
+        formatted_config_filename = directory + '/' + config_filename
+        try:
+            mtime = os.stat(formatted_config_filename).st_mtime_ns
+        except OSError:
+            self.cache.pop(directory, None)
+            return None
+
+        cached = self.cache.get(directory)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            with open(formatted_config_filename, 'r') as data:
+                config_data = yaml.safe_load(data)
+        except (OSError, yaml.YAMLError):
+            print("Error - Filename: %s cannot be read in %s" %(formatted_config_filename, directory))
+            return None
+        self.cache[directory] = (mtime, config_data)
+        return config_data
+
+
+"""
+Watches the station folders for new or growing files, with inotify on Linux and
+polling of the folders everywhere else (or when inotify is not available)
+"""
+class DirectoryWatcher:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')   # wd, mask, cookie, name length
+
+    def __init__(self, use_inotify=True):
+        self.fd = None
+        self.watches = {}   # watch descriptor -> directory
+        if use_inotify:
+            try:
+                self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if fd >= 0:
+                    self.fd = fd
+            except (OSError, AttributeError):
+                self.fd = None
+
+    """
+    Adds a folder to be watched, returns False if it can only be polled
+    """
+    def add(self, directory):
+        if self.fd is None:
+            return False
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            return False
+        self.watches[wd] = directory
+        return True
+
+    """
+    args:
+        timeout: maximum time to wait for a change (s)
+    returns:
+        dictionary of directory -> set of changed filenames, or None if every folder
+        has to be rescanned (polling, or the inotify queue overflowed)
+    """
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return None
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        changed = {}
+        if not ready:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                directory = self.watches.get(wd)
+                if directory is not None:
+                    changed.setdefault(directory, set()).add(name)
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+"""
+Reads what has been appended to the per-second files of one station folder
+"""
+class StationTail:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}         # filename -> [offset, partial line or record]
+        self.latest = None      # latest second seen from this station, counting past 86399
+        self.binary = False     # station writes '.bin' files - its '.txt' files are ignored
+        self.scanned = False    # the folder has been scanned once
+
+    """
+    args:
+        filenames: names of the changed files, or None to rescan the folder
+        min_second: files of earlier seconds are not read (already emitted), counting past 86399
+    returns:
+        dictionary of second (counting on from min_second) -> structured array of
+        RECORD_DTYPE, the new records only
+    """
+    def read(self, filenames, min_second):
+        if filenames is None:
+            try:
+                filenames = [entry.name for entry in os.scandir(self.directory)]
+            except OSError:
+                return {}
+            self.scanned = True
+        if not self.binary and any(filename.endswith('.bin') for filename in filenames):
+            self.binary = True
+
+        new_records = {}
+        for filename in filenames:
+            match = capture_filename.match(filename)
+            if match is None:
+                continue
+            second = int(match.group(1))
+            if self.binary and match.group(2) == 'txt':
+                continue
+            offset = (second - min_second) % DAY_SECONDS
+            if offset >= ROLLOVER_SECONDS:
+                continue
+            second = min_second + offset
+
+            records = self.read_file(filename, match.group(2) == 'bin')
+            if records is None:
+                continue
+            self.latest = second if self.latest is None else max(self.latest, second)
+            if len(records) > 0:
+                if second in new_records:
+                    records = np.concatenate((new_records[second], records))
+                new_records[second] = records
+        return new_records
+
+    """
+    Function that tells whether the station has written a file of a later second
+    """
+    def reported(self, second):
+        return self.latest is not None and self.latest > second
+
+    def read_file(self, filename, binary):
+        path = self.directory + '/' + filename
+        state = self.files.get(filename)
+        try:
+            status = os.stat(path)
+            size = status.st_size
+            if state is not None and size <= state[0]:
+                return None
+            if state is None and status.st_mtime < time.time() - ROLLOVER_SECONDS:
+                # a file of an earlier day, appended to again from now on:
+                self.files[filename] = [size, b'']
+                return None
+            with open(path, 'rb') as f:
+                if state is None:
+                    state = [0, b'']
+                    if binary:
+                        header = f.read(HEADER.size)
+                        if len(header) < HEADER.size:
+                            return None
+                        magic, version, record_size, second = HEADER.unpack(header)
+                        if magic != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+                            print("Error - Filename: %s is not a version %d capture file" %(path, VERSION))
+                            return None
+                        state[0] = HEADER.size
+                    self.files[filename] = state
+                f.seek(state[0])
+                appended = f.read()
+        except OSError:
+            return None
+
+        state[0] += len(appended)
+        data = state[1] + appended
+        if binary:
+            # only whole records, the rest is kept for the next read:
+            complete = len(data) - len(data) % RECORD_DTYPE.itemsize
+            state[1] = data[complete:]
+            return np.frombuffer(data[:complete], dtype=RECORD_DTYPE)
+        # only whole lines, the rest is kept for the next read:
+        complete = data.rfind(b'\n') + 1
+        state[1] = data[complete:]
+        return text_lines_to_records(data[:complete].splitlines())
+
+    """
+    Forgets the read offsets of files before 'min_second', they will not be read again
+    """
+    def forget(self, min_second):
+        for filename in list(self.files):
+            if (int(capture_filename.match(filename).group(1)) - min_second) % DAY_SECONDS >= ROLLOVER_SECONDS:
+                del self.files[filename]
+
+
+"""
+Long-running ingest of all station folders in master_folder
+args:
+    master_folder: folder with one sub-folder per station
+    minimum_num_stations: stations that must have reported a second before it is emitted
+    grace: extra time to wait for the remaining stations once the minimum is reached (s)
+    max_delay: time after which a second is emitted (or dropped, if too few stations
+        reported it) even if stations have not moved on to a later second (s)
+    history: number of seconds before the newest existing file to ingest at start-up
+    poll_interval: wait between rescans when polling, and between checks otherwise (s)
+    resync_after: time without anything to ingest after which the stations' newest file
+        is looked for, in case their files fell behind (offline for more than
+        ROLLOVER_SECONDS) (s)
+"""
+class IngestService:
+
+    def __init__(self, master_folder, minimum_num_stations, grace=0.0, max_delay=5.0, history=0,
+                 poll_interval=0.2, use_inotify=True, resync_after=60.0):
+        self.master_folder = master_folder
+        self.minimum_num_stations = minimum_num_stations
+        self.grace = grace
+        self.max_delay = max_delay
+        self.history = history
+        self.poll_interval = poll_interval
+        self.resync_after = resync_after
+        self.configs = StationConfigCache()
+        self.watcher = DirectoryWatcher(use_inotify)
+        self.tails = {}             # directory -> StationTail
+        self.pending = {}           # second -> {directory: list of record arrays}
+        self.first_seen = {}        # second -> time its first records arrived
+        self.minimum_reached = {}   # second -> time minimum_num_stations reported it
+        self.next_second = None     # earliest second not yet emitted or dropped, counting past 86399
+        self.last_pending = time.monotonic()    # last time something was waiting to be emitted
+        self.late_records = 0       # records that arrived after their second was emitted
+        self.dropped_seconds = 0    # seconds that never reached minimum_num_stations
+        self.last_refresh = 0
+
+    """
+    Picks up new station folders, at most once per second
+    """
+    def refresh_stations(self):
+        now = time.monotonic()
+        if now - self.last_refresh < 1.0:
+            return
+        self.last_refresh = now
+        try:
+            directories = sorted(self.master_folder + '/' + d for d in os.listdir(self.master_folder))
+        except OSError:
+            return
+        for directory in directories:
+            if directory not in self.tails and os.path.isdir(directory):
+                self.watcher.add(directory)
+                self.tails[directory] = StationTail(directory)
+
+    """
+    Stations currently feeding the base, with their config_data
+    """
+    def feeding_stations(self):
+        stations = {}
+        for directory in self.tails:
+            config_data = self.configs.get(directory)
+            if config_data is not None and config_data.get("Feed_to_base") == True:
+                stations[directory] = config_data
+        return stations
+
+    """
+    returns: (second, mtime) of the file written last in any station folder, the current
+        second of day if there is none
+    """
+    def newest_file(self):
+        newest = (int(time.time()) % DAY_SECONDS, 0)
+        for directory in self.tails:
+            try:
+                for entry in os.scandir(directory):
+                    match = capture_filename.match(entry.name)
+                    if match is not None and entry.stat().st_mtime > newest[1]:
+                        newest = (int(match.group(1)), entry.stat().st_mtime)
+            except OSError:
+                continue
+        return newest
+
+    def start_second(self):
+        return self.newest_file()[0] - self.history
+
+    """
+    Moves next_second on to the newest file if the stations have been writing files that
+    are all behind it, e.g. after they were offline for more than ROLLOVER_SECONDS
+    """
+    def resync(self):
+        now = time.monotonic()
+        if self.pending:
+            self.last_pending = now
+            return
+        if now - self.last_pending < self.resync_after:
+            return
+        self.last_pending = now
+        second, mtime = self.newest_file()
+        behind = (self.next_second - second) % DAY_SECONDS
+        if mtime > time.time() - self.resync_after and self.resync_after + self.max_delay < behind <= ROLLOVER_SECONDS:
+            print("Ingest: stations are at second %d, %d seconds behind second %d - moving on to it"
+                  %(second, behind, self.next_second % DAY_SECONDS))
+            self.next_second = self.next_second + DAY_SECONDS - behind
+            # the files skipped until now are read by a rescan:
+            for tail in self.tails.values():
+                tail.scanned = False
+
+    def collect(self, changed, stations):
+        now = time.monotonic()
+        for directory in stations:
+            tail = self.tails[directory]
+            if changed is None or not tail.scanned:
+                filenames = None
+            elif directory in changed:
+                filenames = changed[directory]
+            else:
+                continue
+            for second, records in tail.read(filenames, self.next_second).items():
+                if second < self.next_second:
+                    self.late_records += len(records)
+                    continue
+                self.pending.setdefault(second, {}).setdefault(directory, []).append(records)
+                self.first_seen.setdefault(second, now)
+
+    """
+    returns: list of (second, {directory: records}) ready to be emitted, in order
+    """
+    def ready_seconds(self, stations):
+        now = time.monotonic()
+        ready = []
+        for second in sorted(self.pending):
+            receptions = self.pending[second]
+            # a station has reported a second once it has written a later one:
+            reported = [d for d in receptions if d in stations and self.tails[d].reported(second)]
+            everyone_done = all(self.tails[d].reported(second) for d in stations)
+            timed_out = now - self.first_seen[second] > self.max_delay
+
+            if len(reported) >= self.minimum_num_stations:
+                self.minimum_reached.setdefault(second, now)
+                if not (everyone_done or timed_out or now - self.minimum_reached[second] >= self.grace):
+                    break
+            elif not (everyone_done or timed_out):
+                break
+
+            # emit this second (or drop it) and every earlier one:
+            del self.pending[second]
+            del self.first_seen[second]
+            self.minimum_reached.pop(second, None)
+            self.next_second = second + 1
+            usable = {d: np.concatenate(receptions[d]) for d in receptions if d in stations}
+            if len(usable) >= self.minimum_num_stations:
+                ready.append((second % DAY_SECONDS, usable))
+            else:
+                self.dropped_seconds += 1
+        return ready
+
+    """
+    Generator of complete seconds
+    yields:
+        (second, receptions, stations) - second of day, receptions a dictionary of
+        directory -> structured array of RECORD_DTYPE, stations of directory -> config_data
+    """
+    def batches(self):
+        self.refresh_stations()
+        if self.next_second is None:
+            self.next_second = self.start_second()
+        while True:
+            self.refresh_stations()
+            stations = self.feeding_stations()
+            changed = self.watcher.wait(self.poll_interval)
+            self.collect(changed, stations)
+            for second, receptions in self.ready_seconds(stations):
+                yield second, receptions, {d: stations[d] for d in receptions}
+            self.resync()
+            for tail in self.tails.values():
+                tail.forget(self.next_second - 1)
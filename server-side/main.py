@@ -1,8 +1,19 @@
 # necessary imports:
 import csv
 import os
+import time
 import yaml
 from datetime import datetime
+from capture_format import read_second, records_to_rows
+from ingest import DAY_SECONDS, ROLLOVER_SECONDS, IngestService
+from correlator import Correlator
+from solver import StationPositions, solve, ecef_to_geodetic
+from tracker import TrackTable, track_keys, group_times, SQUAWK_KEY
+from backfill import backfill
+from capture_index import CaptureIndex
+from clock_calibration import ClockCalibration
+from publisher import ResultPublisher, ResultFileSink, fix_records
+import numpy as np
 
 """
 required configurations:
@@ -10,11 +21,36 @@ required configurations:
 station_number = 3  # number of stations deployed
 master_folder = 'Resilio'  # this should be in the same directory
 minimum_num_stations = 3  # for the message to be considered complete and usable
+follow = False  # True: ingest continuously as files grow, False: process one target second
+correlation_window_ns = 2000000  # maximum time between receptions of one transmission, in ns
+assumed_altitude = 10000.0  # altitude in m assumed for transmissions received by only 3 stations
+track_ttl = 60.0  # seconds without a fix after which an aircraft's track is dropped
+backfill_range = None  # (first second, end second) to reprocess after an outage, e.g. (3600, 7200), see backfill.py
+backfill_date = None  # date of backfill_range (YYYYMMDD, UTC), None for today
+backfill_folder = 'Backfill'  # hourly fixes and the checkpoint of the backfill
+backfill_workers = None  # processes of the backfill, None for all cores
+capture_index_path = None  # e.g. 'capture_index.sqlite' (not in master_folder): index the capture files in follow mode, see capture_index.py
+index_interval = 10  # seconds between index updates
+compact_margin = 7200  # seconds after the end of an hour (UTC) when its per-second files are compacted into a segment
+clock_calibration_path = 'clock_calibration.json'  # station clock offsets, loaded at start and saved on update, None to not calibrate
+calibration_interval = 10  # seconds between clock calibration updates
+calibration_window = 300.0  # seconds of observations in the clock calibration
+publish_address = 'mlat_results.sock'  # Unix socket (a path), or ('127.0.0.1', port) for TCP, subscribers receive the groups and fixes from, None to not publish, see publisher.py
+publish_format = 'jsonl'  # 'jsonl' or 'binary'
+publish_queue = 1000  # messages queued per subscriber, beyond which the oldest are dropped
+results_folder = None  # e.g. 'Results': the fixes are also written to Parquet files (.npz without pyarrow)
+results_batch_seconds = 60.0  # seconds of fixes per results file
+print_fixes = False  # print every fix
 
-# acquire list of directories in master folder:
-directories = []
-for directory in os.listdir(master_folder):
-    directories.append(master_folder + '/' + directory)
+"""
+Function that tells whether a periodic task is due at a second of day, also across
+midnight (the seconds of day of follow mode wrap, see ingest.py)
+args:
+    second: second of day being processed
+    due: second of day the task is next due, None if it is due at once
+"""
+def is_due(second, due):
+    return due is None or (second - due) % DAY_SECONDS < ROLLOVER_SECONDS
 
 """
 Function to acquire lists of messages from all stations matching 'target_second',
@@ -23,7 +59,8 @@ args:
     target_filename: an integer, the 'current server-side second' value
     directories: a list of folder names (strings) in master_folder
 returns:
-    a list of all messages (in list-form) of the target seconds,
+    a list of all messages (in list-form) of the target seconds, with the MLAT timestamp
+        'ts' (index 3) in float seconds for text and binary stations alike,
     a list of locations used
 """
 def get_msg_all(target_time, directories):
@@ -54,11 +91,22 @@ def get_msg_all(target_time, directories):
         else:
             break   # 'Feed_to_base' set to false for current directory/ station, move onto next directory
         
+        # binary capture files are memory-mapped instead of parsed, if the station writes them:
+        records = read_second(directory, target_time)
+        if records is not None:
+            matching_msg_list = records_to_rows(records[records['ts_ns'].argsort(kind='stable')], location_name)
+            msg_all.extend(matching_msg_list)
+            continue
+
         try:
             with open(formatted_target_filename, 'r') as f:
                 reader = csv.reader(f)
                 for row in reader:
                     row.insert(0, location_name)
+                    try:
+                        row[3] = float(row[3])  # 'ts', in float seconds as from binary stations
+                    except (IndexError, ValueError):
+                        pass    # kept as it was read
                     matching_msg_list.append(row)
             
                 # here, we can do some sorting within each directory before adding it into our list,
@@ -74,33 +122,129 @@ def get_msg_all(target_time, directories):
 
 
 """start of main code"""
-"""
-    Numbers to represent the current 'system second' is hardcoded here.
-    In order to avoid 'race condition', we use timestamps at 'system-second' - 1 for multi-lateration
-"""
+if __name__ == '__main__':
+
+    if backfill_range is not None:
+        """
+            A range of seconds is solved by a pool of processes, one chunk of seconds each,
+            into one file per hour in backfill_folder - an interrupted run resumes
+        """
+        totals = backfill(master_folder, backfill_range[0], backfill_range[1], backfill_folder, minimum_num_stations,
+                          correlation_window_ns, assumed_altitude, backfill_workers, calibration_path=clock_calibration_path,
+                          date=backfill_date)
+        print("\nBackfill done: %d records, %d correlated transmissions, %d fixes"
+              %(totals['records'], totals['groups'], totals['fixes']))
+
+    elif follow:
+        """
+            Stations are watched continuously, and each second is handed on as soon as
+            minimum_num_stations stations have reported it, see ingest.py
+        """
+        ingest = IngestService(master_folder, minimum_num_stations)
+        # the clocks of the stations are calibrated continuously, starting from the saved calibration:
+        calibration = None
+        if clock_calibration_path is not None:
+            calibration = ClockCalibration(window=calibration_window)
+            calibration.load(clock_calibration_path)
+        next_calibration = None
+        correlator = Correlator(minimum_num_stations, correlation_window_ns, calibration)
+        station_positions = StationPositions()
+        tracks = TrackTable(ttl=track_ttl)
+        index = CaptureIndex(master_folder, capture_index_path) if capture_index_path is not None else None
+        next_index_update = None
+        # results go to the subscribers and files, not to the console:
+        publisher = ResultPublisher(publish_address, publish_format, publish_queue) if publish_address is not None else None
+        sink = ResultFileSink(results_folder, results_batch_seconds) if results_folder is not None else None
+        try:
+            for target_time, receptions, stations in ingest.batches():
+                # group the receptions of the same transmission across stations:
+                groups = correlator.process(target_time, receptions, stations)
+                if calibration is not None:
+                    calibration.observe(groups, station_positions)
+                    if is_due(target_time, next_calibration):
+                        for directory in calibration.update():
+                            estimate = calibration.estimates[directory]
+                            print("Clock %s: %+.1f ns, %+.2f ppb (rms %.1f ns, %d observations)"
+                                  %(stations[directory]["Location name"] if directory in stations else directory,
+                                    estimate['offset_ns'], estimate['drift_ppb'], estimate['rms_ns'], estimate['observations']))
+                        calibration.save(clock_calibration_path)
+                        next_calibration = (target_time + calibration_interval) % DAY_SECONDS
+                # groups of only 3 stations start from (and assume the altitude of) the aircraft's track,
+                # larger groups have a closed-form start:
+                num_stations = np.array([len(group['ts_ns']) for group in groups])
+                keys = track_keys(groups)
+                times = group_times(groups)
+                predicted = tracks.predict(keys, times)
+                _, _, predicted_altitude = ecef_to_geodetic(predicted)
+                three = num_stations == 3
+                initial = np.where(three[:, None], predicted, np.nan)
+                altitude = np.where(three, np.where(np.isnan(predicted_altitude), assumed_altitude, predicted_altitude), np.nan)
+                # multilaterate all groups of this second at once:
+                fixes = solve(groups, station_positions, altitude=altitude, initial=initial)
+                valid = np.flatnonzero(fixes['valid'])
+                slots = tracks.update(keys[valid], times[valid], fixes['ecef'][valid], fixes['gdop'][valid])
+                # before evict(), which releases the slots of stale tracks:
+                _, velocities = tracks.estimate(slots)
+                tracks.evict()
+                # publish the groups and fixes, and collect the fixes for the results files:
+                records = fix_records(groups, fixes, keys, times, valid, velocities)
+                if publisher is not None:
+                    publisher.publish_groups(groups, keys, times)
+                    publisher.publish_fixes(records)
+                if sink is not None:
+                    sink.add(records)
+                print("Second %d | messages: %s | correlated: %d | fixes: %d | tracks: %d%s"
+                      %(target_time, ', '.join("%s %d" %(stations[d]["Location name"], len(receptions[d])) for d in sorted(receptions)),
+                        len(groups), len(valid), len(tracks), " | " + publisher.report() if publisher is not None else ""))
+                if print_fixes:
+                    for record in records:
+                        identity = "squawk %04X" %(record['key'] - SQUAWK_KEY) if record['key'] >= SQUAWK_KEY else "ICAO %06X" %(record['key'])
+                        print("%s | %.5f, %.5f, %.0f m | %.0f m/s | residual %.1f m | GDOP %.1f"
+                              %(identity, record['latitude'], record['longitude'], record['altitude'],
+                                record['speed'], record['residual'], record['gdop']))
+                # index what the stations appended, and compact the hours that are old enough:
+                if index is not None and is_due(target_time, next_index_update):
+                    index.compact(time.time() - compact_margin)
+                    next_index_update = (target_time + index_interval) % DAY_SECONDS
+        finally:
+            if sink is not None:
+                sink.close()
+            if publisher is not None:
+                publisher.close()
+
+    else:
+        # acquire list of directories in master folder:
+        directories = []
+        for directory in os.listdir(master_folder):
+            directories.append(master_folder + '/' + directory)
+
+        """
+            Numbers to represent the current 'system second' is hardcoded here.
+            In order to avoid 'race condition', we use timestamps at 'system-second' - 1 for multi-lateration
+        """
+
+        # # For actual implemetation:
+        # utc_now = datetime.utcnow()
+        # utc_midnight = utc_now
+        # current_serverTime = (utc_now - utc_midnight.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+        # target_time = int(current_serverTime - 1)
+        # print(target_time)  # check
+        # # acquire lists of messages and lists of locations used:
+        # msg_list_all, locations = get_msg_all(target_time, directories)
+
+
+        # Only for testing purposes:
+        current_serverTime = 31563
+        target_time = int(current_serverTime - 1)
+        # acquire lists of messages and lists of locations used:
+        msg_list_all, locations = get_msg_all(target_time, directories)
+
 
-# # For actual implemetation:
-# utc_now = datetime.utcnow()
-# utc_midnight = utc_now
-# current_serverTime = (utc_now - utc_midnight.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
-# target_time = int(current_serverTime - 1)
-# print(target_time)  # check
-# # acquire lists of messages and lists of locations used:
-# msg_list_all, locations = get_msg_all(target_time, directories)
-
-
-# Only for testing purposes:
-current_serverTime = 31563
-target_time = int(current_serverTime - 1)
-# acquire lists of messages and lists of locations used:
-msg_list_all, locations = get_msg_all(target_time, directories)
-
-
-# do print checks:
-print("\nMultilateration target second: %d\n" %(target_time))
-print("Client stations to be used for multilateration:")
-for location in locations:
-    print(location)
-print("\nMessages retrieved from these stations:")
-for messages in msg_list_all:
-    print(messages)
+        # do print checks:
+        print("\nMultilateration target second: %d\n" %(target_time))
+        print("Client stations to be used for multilateration:")
+        for location in locations:
+            print(location)
+        print("\nMessages retrieved from these stations:")
+        for messages in msg_list_all:
+            print(messages)
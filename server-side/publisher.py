@@ -0,0 +1,366 @@
+# necessary imports:
+import json
+import os
+import queue
+import socket
+import stat
+import struct
+import threading
+import time
+from collections import deque
+import numpy as np
+from backfill import write_columns
+from capture_index import capture_date
+from correlator import DAY_NS
+
+"""
+Output of the server: the correlated groups and the fixes of every second are published
+to any number of local subscribers, and the fixes are written in batches to files.
+
+Subscribers connect to a Unix socket (publish_address a path) or a TCP port and receive,
+in the format of the publisher:
+    'jsonl': one JSON object per line, {"type": "group", ...} or {"type": "fix", ...}
+    'binary': messages of MESSAGE_HEADER followed by its payload:
+        b'FIX1': FIX_DTYPE records
+        b'GRP1': GROUP_DTYPE records, then the RECEPTION_DTYPE records of all of them
+        b'STN1': JSON list of the station names the receptions' 'station' indexes,
+                 sent on connecting and whenever a station is added
+Every subscriber has a queue of 'queue_size' messages and a thread of its own sending
+it. A subscriber that reads too slowly loses messages (the oldest, or the newest with
+policy 'newest') and is counted - the ingest/ solve loop never waits for one.
+"""
+MESSAGE_HEADER = struct.Struct('<4sII')     # kind, number of records, payload bytes
+FIX_DTYPE = np.dtype([
+    ('time_ns', '<i8'), ('key', '<i8'), ('df', 'u1'), ('squawk', '<u2'), ('num_stations', 'u1'),
+    ('latitude', '<f8'), ('longitude', '<f8'), ('altitude', '<f8'), ('speed', '<f4'), ('residual', '<f4'),
+    ('gdop', '<f4'),
+])
+GROUP_DTYPE = np.dtype([
+    ('time_ns', '<i8'), ('key', '<i8'), ('df', 'u1'), ('squawk', '<u2'), ('num_stations', 'u1'),
+    ('frame_len', 'u1'), ('frame', 'u1', 22),
+])
+RECEPTION_DTYPE = np.dtype([('group', '<u4'), ('station', '<u2'), ('ts_ns', '<i8')])
+'''
+    time_ns: time of the first reception (calibrated MLAT time, ns since UTC midnight)
+    key: track key of the aircraft, see tracker.track_keys()
+    speed: of the aircraft's track (m/s), NaN (null in 'jsonl') until the track has had two fixes
+    residual, gdop: see solver.solve()
+    ts_ns: calibrated time of one reception of a group by one station
+All times are published as times of day: the receptions before midnight of a group
+correlated across it (negative times, see correlator.py) are just below 86400 s
+'''
+
+
+"""
+Function that builds the records of the valid fixes of one second
+args:
+    groups: list of groups from the correlator
+    fixes: results of solve() for them
+    keys, times: track_keys() and group_times() of the groups
+    valid: indexes of the valid fixes
+    velocities: (len(valid), 3) velocities of their tracks (m/s)
+returns:
+    array of FIX_DTYPE
+"""
+def fix_records(groups, fixes, keys, times, valid, velocities):
+    records = np.zeros(len(valid), dtype=FIX_DTYPE)
+    records['time_ns'] = times[valid] % DAY_NS
+    records['key'] = keys[valid]
+    records['df'] = [groups[i]['df'] for i in valid]
+    records['squawk'] = [groups[i]['squawk'] for i in valid]
+    records['num_stations'] = [len(groups[i]['ts_ns']) for i in valid]
+    for column in ('latitude', 'longitude', 'altitude', 'residual', 'gdop'):
+        records[column] = fixes[column][valid]
+    if len(valid) > 0:
+        records['speed'] = np.linalg.norm(np.asarray(velocities, dtype=np.float64).reshape(-1, 3), axis=1)
+    return records
+
+
+"""Function to convert a record to a JSON line, with NaN as null"""
+def json_line(kind, names, values):
+    record = {'type': kind}
+    for name, value in zip(names, values):
+        record[name] = None if isinstance(value, float) and value != value else value
+    return (json.dumps(record, separators=(',', ':')) + '\n').encode()
+
+
+"""
+One connected subscriber: a bounded queue of encoded messages and the thread sending them
+"""
+class Subscriber:
+
+    def __init__(self, conn, name, queue_size, policy):
+        self.conn = conn
+        self.name = name
+        self.policy = policy
+        self.messages = deque()
+        self.queue_size = queue_size
+        self.ready = threading.Condition()
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name='subscriber ' + name, daemon=True)
+        self.thread.start()
+
+    """
+    Function that queues a message without ever waiting, dropping one when the queue is full
+    """
+    def put(self, data):
+        with self.ready:
+            if len(self.messages) >= self.queue_size:
+                self.dropped += 1
+                if self.policy == 'newest':
+                    return
+                self.messages.popleft()
+            self.messages.append(data)
+            self.ready.notify()
+
+    def _run(self):
+        try:
+            while True:
+                with self.ready:
+                    while not self.messages and not self.closed:
+                        self.ready.wait()
+                    if self.closed:
+                        return
+                    data = self.messages.popleft()
+                self.conn.sendall(data)
+                self.sent += 1
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.conn.close()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        try:
+            # unblocks a sendall() to a subscriber that stopped reading:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+"""
+Publisher of the groups and fixes to the subscribers of a local socket
+args:
+    address: path of a Unix socket, or (host, port) of a TCP socket
+    format: 'jsonl' or 'binary', see above
+    queue_size: messages queued per subscriber
+    policy: 'oldest' or 'newest', the message dropped from a full queue
+    max_subscribers: further connections are closed at once
+"""
+class ResultPublisher:
+
+    def __init__(self, address, format='jsonl', queue_size=1000, policy='oldest', max_subscribers=16):
+        if format not in ('jsonl', 'binary'):
+            raise ValueError("Unknown publish format: %s" % format)
+        self.address = address
+        self.format = format
+        self.queue_size = queue_size
+        self.policy = policy
+        self.max_subscribers = max_subscribers
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.station_names = []     # index in the receptions -> "Location name", for 'binary'
+        self.station_ids = {}
+        self.published = 0
+
+        if isinstance(address, str):
+            # a socket file left by a previous run, and nothing else, is replaced:
+            if os.path.exists(address):
+                if not stat.S_ISSOCK(os.stat(address).st_mode):
+                    raise ValueError("publish_address %s exists and is not a socket" % address)
+                os.remove(address)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(max_subscribers)
+        self.thread = threading.Thread(target=self._accept, name='publisher', daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, peer = self.server.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.subscribers = [subscriber for subscriber in self.subscribers if not subscriber.closed]
+                if len(self.subscribers) >= self.max_subscribers:
+                    conn.close()
+                    continue
+                subscriber = Subscriber(conn, str(peer) or 'unix', self.queue_size, self.policy)
+                if self.format == 'binary' and self.station_names:
+                    subscriber.put(self._stations_message())
+                self.subscribers.append(subscriber)
+
+    def _active(self):
+        with self.lock:
+            return [subscriber for subscriber in self.subscribers if not subscriber.closed]
+
+    def _send(self, data):
+        for subscriber in self._active():
+            subscriber.put(data)
+        self.published += 1
+
+    def _stations_message(self):
+        payload = json.dumps(self.station_names).encode()
+        return MESSAGE_HEADER.pack(b'STN1', len(self.station_names), len(payload)) + payload
+
+    def _station_index(self, name):
+        index = self.station_ids.get(name)
+        if index is None:
+            with self.lock:
+                index = self.station_ids[name] = len(self.station_names)
+                self.station_names.append(name)
+            self._send(self._stations_message())
+        return index
+
+    """
+    Function that publishes the correlated groups of one second
+    args:
+        groups: list of groups from the correlator
+        keys, times: track_keys() and group_times() of the groups
+    """
+    def publish_groups(self, groups, keys, times):
+        # nothing is encoded while no one is subscribed:
+        if not groups or not self._active():
+            return
+        keys = keys.tolist()
+        times = (times % DAY_NS).tolist()
+        if self.format == 'jsonl':
+            names = ('time_ns', 'key', 'df', 'squawk', 'frame', 'receptions')
+            self._send(b''.join(json_line('group', names, (
+                time_ns, key, group['df'], group['squawk'], group['frame'].hex().upper(),
+                [[config_data["Location name"], ts] for config_data, ts in zip(group['configs'], (group['ts_ns'] % DAY_NS).tolist())]))
+                for group, key, time_ns in zip(groups, keys, times)))
+            return
+
+        records = np.zeros(len(groups), dtype=GROUP_DTYPE)
+        records['time_ns'] = times
+        records['key'] = keys
+        records['df'] = [group['df'] for group in groups]
+        records['squawk'] = [group['squawk'] for group in groups]
+        records['num_stations'] = [len(group['ts_ns']) for group in groups]
+        receptions = np.zeros(int(records['num_stations'].sum()), dtype=RECEPTION_DTYPE)
+        row = 0
+        for i, group in enumerate(groups):
+            frame = group['frame'][:22]
+            records['frame_len'][i] = len(frame)
+            records['frame'][i, :len(frame)] = np.frombuffer(frame, dtype=np.uint8)
+            count = len(group['ts_ns'])
+            receptions['group'][row:row + count] = i
+            receptions['station'][row:row + count] = [self._station_index(config_data["Location name"])
+                                                      for config_data in group['configs']]
+            receptions['ts_ns'][row:row + count] = group['ts_ns'] % DAY_NS
+            row += count
+        payload = records.tobytes() + receptions.tobytes()
+        self._send(MESSAGE_HEADER.pack(b'GRP1', len(records), len(payload)) + payload)
+
+    """
+    Function that publishes the fixes of one second
+    args:
+        records: array of FIX_DTYPE, see fix_records()
+    """
+    def publish_fixes(self, records):
+        if len(records) == 0 or not self._active():
+            return
+        if self.format == 'jsonl':
+            names = records.dtype.names
+            self._send(b''.join(json_line('fix', names, values) for values in records.tolist()))
+        else:
+            payload = records.tobytes()
+            self._send(MESSAGE_HEADER.pack(b'FIX1', len(records), len(payload)) + payload)
+
+    def report(self):
+        """Line of statistics for the prints of the main loop"""
+        subscribers = self._active()
+        return ("Subscribers: %d | messages published: %d | dropped: %d"
+                %(len(subscribers), self.published, sum(subscriber.dropped for subscriber in subscribers)))
+
+    def close(self):
+        self.server.close()
+        for subscriber in self._active():
+            subscriber.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+"""
+Writer of the fixes to files, one file per batch, on a thread of its own
+args:
+    folder: where the files 'fixes_<YYYYMMDD>_<first second>.parquet' (.npz without
+        pyarrow, see backfill.write_columns()) are written, dated by the first fix of
+        the file, see capture_index.capture_date()
+    batch_seconds: seconds of fixes per file
+    max_rows: a file is written early once this many fixes are waiting
+    max_pending: batches waiting for the thread, beyond which batches are dropped
+"""
+class ResultFileSink:
+
+    def __init__(self, folder, batch_seconds=60.0, max_rows=100000, max_pending=8):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.batch_seconds = batch_seconds
+        self.max_rows = max_rows
+        self.parts = []
+        self.rows = 0
+        self.started = None
+        self.pending = queue.Queue(max_pending)
+        self.files_written = 0
+        self.batches_dropped = 0
+        self.thread = threading.Thread(target=self._run, name='result sink', daemon=True)
+        self.thread.start()
+
+    """
+    Function that adds the fixes of one second, see fix_records()
+    """
+    def add(self, records):
+        now = time.monotonic()
+        if len(records) > 0:
+            if self.started is None:
+                self.started = now
+            self.parts.append(records)
+            self.rows += len(records)
+        if self.started is not None and (self.rows >= self.max_rows or now - self.started >= self.batch_seconds):
+            self.flush()
+
+    def flush(self):
+        """Hands the fixes collected so far to the thread"""
+        if not self.parts:
+            return
+        records = np.concatenate(self.parts)
+        self.parts = []
+        self.rows = 0
+        self.started = None
+        try:
+            # the day of the file's first second, even when the batch is flushed after midnight:
+            date = capture_date(int(records['time_ns'][0]) // 1000000000, time.time())
+            self.pending.put_nowait((date, records))
+        except queue.Full:
+            self.batches_dropped += 1
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            date, records = item
+            path = self.folder + '/fixes_%s_%05d' %(date, int(records['time_ns'][0]) // 1000000000)
+            try:
+                write_columns(path, {column: records[column] for column in FIX_DTYPE.names})
+                self.files_written += 1
+            except OSError as e:
+                self.batches_dropped += 1
+                print("Error - fixes could not be written to %s: %r" %(path, e))
+
+    def close(self):
+        """Writes the fixes collected so far and waits for the thread"""
+        self.flush()
+        self.pending.put(None)
+        self.thread.join()
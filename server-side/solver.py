@@ -0,0 +1,251 @@
+# necessary imports:
+import numpy as np
+
+"""
+Vectorized TDOA multilateration. Groups from the correlator are stacked by their number
+of stations, so many groups are solved per NumPy call:
+    1. closed-form Chan/Foy start (or a given initial guess, e.g. from a track)
+    2. batched Gauss-Newton iterations on the range differences
+An altitude pseudo-measurement is added when an altitude is given, which is what makes
+groups of only 3 stations solvable (2 range differences for 3 unknowns).
+"""
+SPEED_OF_LIGHT = 299792458.0    # m/s
+WGS84_A = 6378137.0             # semi-major axis (m)
+WGS84_F = 1 / 298.257223563
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+WGS84_B = WGS84_A * (1 - WGS84_F)
+WGS84_EP2 = (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+MIN_ALTITUDE = -1000.0          # plausible aircraft altitudes (m), to pick between solutions
+MAX_ALTITUDE = 25000.0
+
+
+"""
+Functions to convert between geodetic (degrees, degrees, m) and ECEF (m) coordinates,
+element-wise on arrays
+"""
+def geodetic_to_ecef(latitude, longitude, altitude):
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    n = WGS84_A / np.sqrt(1 - WGS84_E2 * np.sin(lat) ** 2)
+    x = (n + altitude) * np.cos(lat) * np.cos(lon)
+    y = (n + altitude) * np.cos(lat) * np.sin(lon)
+    z = (n * (1 - WGS84_E2) + altitude) * np.sin(lat)
+    return np.stack([x, y, z], axis=-1)
+def ecef_to_geodetic(ecef):
+    # Bowring's method, sub-millimetre for aircraft altitudes:
+    x, y, z = ecef[..., 0], ecef[..., 1], ecef[..., 2]
+    p = np.hypot(x, y)
+    theta = np.arctan2(z * WGS84_A, p * WGS84_B)
+    lat = np.arctan2(z + WGS84_EP2 * WGS84_B * np.sin(theta) ** 3, p - WGS84_E2 * WGS84_A * np.cos(theta) ** 3)
+    lon = np.arctan2(y, x)
+    n = WGS84_A / np.sqrt(1 - WGS84_E2 * np.sin(lat) ** 2)
+    altitude = p / np.cos(lat) - n
+    return np.degrees(lat), np.degrees(lon), altitude
+
+
+"""
+Cache of the station positions in ECEF, converted once per station configuration
+"""
+class StationPositions:
+
+    def __init__(self):
+        self.cache = {}     # directory -> ((latitude, longitude, altitude), ecef)
+
+    """
+    args:
+        directory: station folder
+        config_data: the station's '0_station_config.yml', with 'Latitude', 'Longitude'
+            and optionally 'Altitude' (m above the WGS84 ellipsoid, 0 if not given)
+    returns:
+        (3,) ECEF position (m)
+    """
+    def get(self, directory, config_data):
+        key = (config_data["Latitude"], config_data["Longitude"], config_data.get("Altitude", 0.0))
+        cached = self.cache.get(directory)
+        if cached is None or cached[0] != key:
+            cached = (key, geodetic_to_ecef(*key))
+            self.cache[directory] = cached
+        return cached[1]
+
+
+"""
+Function for the closed-form Chan/Foy start of groups of 4 or more stations
+args:
+    stations: (g, m, 3) station positions, receiving station 0 as reference
+    range_diff: (g, m-1) range differences to station 0 (m)
+returns:
+    (g, 3) positions, NaN where there is no real solution
+"""
+def chan_start(stations, range_diff):
+    # 2 (s_i - s_0).p' + 2 d_i r_0 = |s_i - s_0|^2 - d_i^2, with p' = p - s_0 and r_0 = |p'|:
+    baseline = stations[:, 1:] - stations[:, :1]
+    rhs = np.sum(baseline ** 2, axis=-1) - range_diff ** 2
+    pinv = np.linalg.pinv(2 * baseline)                     # (g, 3, m-1)
+    u = np.einsum('gij,gj->gi', pinv, rhs)                  # p' = u + v r_0
+    v = -np.einsum('gij,gj->gi', pinv, 2 * range_diff)
+
+    # |u + v r_0|^2 = r_0^2:
+    a = np.sum(v * v, axis=-1) - 1
+    b = 2 * np.sum(u * v, axis=-1)
+    c = np.sum(u * u, axis=-1)
+    disc = b * b - 4 * a * c
+    sqrt_disc = np.sqrt(np.where(disc >= 0, disc, np.nan))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roots = np.stack([(-b + sqrt_disc) / (2 * a), (-b - sqrt_disc) / (2 * a)], axis=-1)
+    roots = np.where(roots > 0, roots, np.nan)
+
+    # of the two roots, keep the one that fits the range differences best. With 4 stations
+    # both can fit exactly, so a root at an implausible altitude is ruled out first:
+    candidates = stations[:, None, 0] + u[:, None] + v[:, None] * roots[..., None]     # (g, 2, 3)
+    ranges = np.linalg.norm(candidates[:, :, None] - stations[:, None], axis=-1)        # (g, 2, m)
+    misfit = np.sum((ranges[..., 1:] - ranges[..., :1] - range_diff[:, None]) ** 2, axis=-1)
+    _, _, height = ecef_to_geodetic(candidates)
+    plausible = (height > MIN_ALTITUDE) & (height < MAX_ALTITUDE)
+    misfit = np.where(np.isnan(misfit), np.inf, misfit + np.where(plausible, 0.0, 1e12))
+    best = np.argmin(misfit, axis=-1)
+    return candidates[np.arange(len(candidates)), best]
+
+
+"""
+Function that solves groups with the same number of stations
+args:
+    stations: (g, m, 3) station positions (ECEF, m)
+    ts_ns: (g, m) int64 reception timestamps (ns)
+    initial: (g, 3) initial positions, NaN rows are started with chan_start() or above
+        the stations' centroid
+    altitude: (g,) altitude pseudo-measurement (m), NaN where not used
+    altitude_weight: weight of the altitude residual relative to a range difference residual
+    iterations, tolerance: Gauss-Newton stopping criteria (max iterations, step in m)
+returns:
+    dictionary of arrays, see solve()
+"""
+def solve_stacked(stations, ts_ns, initial, altitude, altitude_weight=1.0, iterations=10, tolerance=0.01):
+    g, m = ts_ns.shape
+    range_diff = (ts_ns[:, 1:] - ts_ns[:, :1]).astype(np.float64) * (SPEED_OF_LIGHT * 1e-9)
+    use_altitude = ~np.isnan(altitude)
+
+    # geocentric radius of the altitude constraint, near the stations:
+    lat_c, lon_c, _ = ecef_to_geodetic(stations.mean(axis=1))
+    target_radius = np.linalg.norm(geodetic_to_ecef(lat_c, lon_c, np.where(use_altitude, altitude, 0.0)), axis=-1)
+
+    # starting positions:
+    position = initial.copy()
+    start = np.isnan(position).any(axis=1)
+    if m >= 4 and start.any():
+        position[start] = chan_start(stations[start], range_diff[start])
+    start = np.isnan(position).any(axis=1)
+    if start.any():
+        fallback = geodetic_to_ecef(lat_c[start], lon_c[start], np.where(use_altitude[start], altitude[start], 10000.0))
+        position[start] = fallback
+
+    rows = m - 1 + 1   # range differences and the altitude pseudo-measurement
+    weights = np.ones((g, rows))
+    weights[:, -1] = np.where(use_altitude, altitude_weight, 0.0)
+    converged = np.zeros(g, dtype=bool)
+    count = np.zeros(g, dtype=np.int64)
+
+    for _ in range(iterations):
+        active = ~converged
+        if not active.any():
+            break
+        p = position[active]
+        s = stations[active]
+        offset = p[:, None] - s                                   # (a, m, 3)
+        ranges = np.linalg.norm(offset, axis=-1)
+        unit = offset / ranges[..., None]
+        radius = np.linalg.norm(p, axis=-1)
+
+        residual = np.empty((len(p), rows))
+        residual[:, :-1] = ranges[:, 1:] - ranges[:, :1] - range_diff[active]
+        residual[:, -1] = radius - target_radius[active]
+        jacobian = np.empty((len(p), rows, 3))
+        jacobian[:, :-1] = unit[:, 1:] - unit[:, :1]
+        jacobian[:, -1] = p / radius[:, None]
+
+        w = weights[active]
+        jtw = np.swapaxes(jacobian, 1, 2) * w[:, None, :]
+        normal = jtw @ jacobian
+        # a little damping keeps poorly conditioned geometries finite:
+        trace = np.trace(normal, axis1=1, axis2=2)
+        normal += np.eye(3) * (1e-9 * trace)[:, None, None]
+        # no information at all (e.g. diverged far away, or NaN) cannot be solved:
+        degenerate = ~(trace > 0)
+        normal[degenerate] = np.eye(3)
+        step = -np.linalg.solve(normal, np.einsum('aij,aj->ai', jtw, residual)[..., None])[..., 0]
+        step[degenerate] = np.nan
+
+        position[active] = p + step
+        count[active] += 1
+        converged[active] = (np.linalg.norm(step, axis=-1) < tolerance) | degenerate
+
+    # quality: residual of the range differences, and GDOP of the final geometry:
+    offset = position[:, None] - stations
+    ranges = np.linalg.norm(offset, axis=-1)
+    unit = offset / ranges[..., None]
+    residual = ranges[:, 1:] - ranges[:, :1] - range_diff
+    jacobian = np.concatenate([unit[:, 1:] - unit[:, :1], (position / np.linalg.norm(position, axis=-1)[:, None])[:, None]], axis=1)
+    jw = jacobian * np.sqrt(weights)[..., None]
+    finite = np.isfinite(jw).all(axis=(1, 2))
+    gdop = np.full(g, np.nan)
+    with np.errstate(invalid='ignore'):
+        covariance = np.linalg.pinv(np.swapaxes(jw[finite], 1, 2) @ jw[finite])
+        gdop[finite] = np.sqrt(np.trace(covariance, axis1=1, axis2=2))
+    latitude, longitude, height = ecef_to_geodetic(position)
+
+    return {
+        'ecef': position,
+        'latitude': latitude,
+        'longitude': longitude,
+        'altitude': height,
+        'residual': np.sqrt(np.mean(residual ** 2, axis=-1)),
+        'gdop': gdop,
+        'iterations': count,
+        'valid': converged & np.isfinite(position).all(axis=1) & (m - 1 + use_altitude >= 3),
+    }
+
+
+"""
+Function that solves correlated groups for aircraft positions
+args:
+    groups: list of groups from the correlator, with 'directories', 'configs' and 'ts_ns'
+    station_positions: StationPositions cache
+    altitude: None, a scalar or a (len(groups),) array of altitudes (m) for the altitude
+        pseudo-measurement (NaN for none). Groups of 3 stations need one.
+    initial: None or (len(groups), 3) initial ECEF positions (NaN rows for none)
+returns:
+    dictionary of arrays, one row per group:
+        ecef: (n, 3) position (m), latitude/ longitude (degrees), altitude (m)
+        residual: root mean square range difference residual (m)
+        gdop: geometric dilution of precision
+        iterations: Gauss-Newton iterations used
+        valid: converged, finite and not under-determined
+"""
+def solve(groups, station_positions, altitude=None, initial=None, altitude_weight=1.0, iterations=10):
+    n = len(groups)
+    results = {
+        'ecef': np.full((n, 3), np.nan),
+        'latitude': np.full(n, np.nan),
+        'longitude': np.full(n, np.nan),
+        'altitude': np.full(n, np.nan),
+        'residual': np.full(n, np.nan),
+        'gdop': np.full(n, np.nan),
+        'iterations': np.zeros(n, dtype=np.int64),
+        'valid': np.zeros(n, dtype=bool),
+    }
+    if n == 0:
+        return results
+    altitudes = np.broadcast_to(np.asarray(np.nan if altitude is None else altitude, dtype=np.float64), (n,))
+    initials = np.full((n, 3), np.nan) if initial is None else np.asarray(initial, dtype=np.float64)
+
+    sizes = np.array([len(group['ts_ns']) for group in groups])
+    for m in np.unique(sizes):
+        if m < 3:
+            continue
+        index = np.flatnonzero(sizes == m)
+        stations = np.array([[station_positions.get(d, c) for d, c in zip(groups[i]['directories'], groups[i]['configs'])]
+                             for i in index])
+        ts_ns = np.array([groups[i]['ts_ns'] for i in index], dtype=np.int64)
+        stacked = solve_stacked(stations, ts_ns, initials[index], altitudes[index], altitude_weight, iterations)
+        for key, value in stacked.items():
+            results[key][index] = value
+    return results
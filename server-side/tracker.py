@@ -0,0 +1,293 @@
+# necessary imports:
+import numpy as np
+
+"""
+Per-aircraft tracks, kept across seconds. Each track is a constant-velocity Kalman filter
+in ECEF (position and velocity, with their covariance). Every valid fix updates its track,
+and the track's prediction is the initial guess of the next solve of that aircraft.
+All tracks live in preallocated arrays of 'capacity' slots, so memory and the cost of an
+update do not grow however long the server runs.
+Fix times are ns since UTC midnight. The table keeps its own running clock, on which each
+time is taken to be of the day nearest to the newest fix, so tracks carry on past midnight.
+"""
+CRC24_GENERATOR = 0xFFF409
+SQUAWK_KEY = 1 << 24    # keys at or above this are squawks (no address), below are ICAO addresses
+NO_KEY = -1
+DAY_NS = 86400 * 1000000000
+
+# CRC-24 lookup table, one entry per byte value:
+CRC24_TABLE = np.zeros(256, dtype=np.int64)
+for byte in range(256):
+    crc = byte << 16
+    for _ in range(8):
+        crc = (crc << 1) ^ CRC24_GENERATOR if crc & 0x800000 else crc << 1
+    CRC24_TABLE[byte] = crc & 0xFFFFFF
+
+
+"""
+Function to compute the Mode-S CRC-24 of several messages of the same length
+args:
+    payload: (n, k) uint8 array, the messages without their 3 parity bytes
+returns:
+    (n,) int64 array of remainders
+"""
+def crc24(payload):
+    crc = np.zeros(len(payload), dtype=np.int64)
+    for column in range(payload.shape[1]):
+        crc = ((crc << 8) & 0xFFFFFF) ^ CRC24_TABLE[((crc >> 16) ^ payload[:, column]) & 0xFF]
+    return crc
+
+
+"""
+Function to get the track key of each correlated group
+    DF11/17/18: the ICAO address in the message
+    other Mode-S: the ICAO address recovered from the address/parity field
+    Mode-AC: the squawk (offset by SQUAWK_KEY so it cannot clash with an address)
+args:
+    groups: list of groups from the correlator, with 'frame' and 'squawk'
+returns:
+    (n,) int64 array of keys, NO_KEY where the message has no usable identity
+"""
+def track_keys(groups):
+    keys = np.full(len(groups), NO_KEY, dtype=np.int64)
+    by_length = {}
+    for i, group in enumerate(groups):
+        payload = group['frame'][8:]
+        if len(payload) == 2:
+            keys[i] = SQUAWK_KEY + group['squawk']
+        elif len(payload) in (7, 14):
+            by_length.setdefault(len(payload), []).append(i)
+
+    for length, index in by_length.items():
+        index = np.array(index)
+        payload = np.frombuffer(b''.join(groups[i]['frame'][8:] for i in index), dtype=np.uint8).reshape(-1, length)
+        df = payload[:, 0] >> 3
+        parity = (payload[:, -3].astype(np.int64) << 16) | (payload[:, -2].astype(np.int64) << 8) | payload[:, -1]
+        announced = (payload[:, 1].astype(np.int64) << 16) | (payload[:, 2].astype(np.int64) << 8) | payload[:, 3]
+        keys[index] = np.where(np.isin(df, (11, 17, 18)), announced, parity ^ crc24(payload[:, :-3]))
+    return keys
+
+
+"""
+Function to get the transmission time of each correlated group, the earliest reception (ns)
+"""
+def group_times(groups):
+    return np.array([group['ts_ns'].min() for group in groups], dtype=np.int64)
+
+
+"""
+Table of tracks with a constant-velocity Kalman filter per track
+args:
+    capacity: maximum number of tracks, the least recently updated one is replaced when full
+    ttl: time without a fix after which a track is evicted (s)
+    acceleration_noise: process noise, spectral density of the acceleration ((m/s^2)^2/ Hz)
+    measurement_sigma: standard deviation of a fix with a GDOP of 1 (m)
+    initial_speed_sigma: standard deviation of the velocity of a new track (m/s)
+    gate: fixes further than this many standard deviations from the prediction are rejected
+    max_rejected: consecutive rejected fixes after which the track is restarted from the
+        latest fix (the old one was wrong, or lost)
+"""
+class TrackTable:
+
+    def __init__(self, capacity=4096, ttl=60.0, acceleration_noise=25.0, measurement_sigma=30.0,
+                 initial_speed_sigma=300.0, gate=5.0, max_rejected=3):
+        self.capacity = capacity
+        self.ttl_ns = int(ttl * 1e9)
+        self.acceleration_noise = acceleration_noise
+        self.measurement_sigma = measurement_sigma
+        self.initial_speed_sigma = initial_speed_sigma
+        self.gate = gate
+        self.max_rejected = max_rejected
+
+        self.key = np.full(capacity, NO_KEY, dtype=np.int64)
+        self.state = np.zeros((capacity, 6))            # x, y, z (m), vx, vy, vz (m/s) in ECEF
+        self.covariance = np.zeros((capacity, 6, 6))
+        self.time_ns = np.zeros(capacity, dtype=np.int64)   # time of the last fix, on the running clock
+        self.updates = np.zeros(capacity, dtype=np.int64)
+        self.rejected = np.zeros(capacity, dtype=np.int64)  # consecutive rejected fixes
+        self.slots = {}                                 # key -> slot
+        self.free = list(range(capacity - 1, -1, -1))
+        self.newest_ns = None                           # newest fix on the running clock, None before the first
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.slots)
+
+    def lookup(self, keys):
+        return np.array([self.slots.get(key, -1) for key in keys.tolist()], dtype=np.int64)
+
+    """
+    Function to put times of day (ns since UTC midnight) on the running clock, in the day
+    nearest to the newest fix, e.g. 00:00:01 just after 23:59:59 is a second after it
+    """
+    def running_time(self, t_ns):
+        t_ns = np.asarray(t_ns, dtype=np.int64)
+        if self.newest_ns is None:
+            return t_ns
+        return t_ns + DAY_NS * ((self.newest_ns - t_ns + DAY_NS // 2) // DAY_NS)
+
+    """
+    Function to predict positions of known tracks, e.g. as initial guesses of solve()
+    args:
+        keys: (n,) int64 array from track_keys()
+        t_ns: (n,) int64 array of times to predict to (ns)
+    returns:
+        (n, 3) ECEF positions, NaN rows for unknown keys
+    """
+    def predict(self, keys, t_ns):
+        positions = np.full((len(keys), 3), np.nan)
+        t_ns = self.running_time(t_ns)
+        slot = self.lookup(keys)
+        known = slot >= 0
+        if known.any():
+            s = slot[known]
+            dt = ((t_ns[known] - self.time_ns[s]) * 1e-9)[:, None]
+            positions[known] = self.state[s, :3] + self.state[s, 3:] * dt
+        return positions
+
+    def allocate(self, key, t_ns):
+        if not self.free:
+            # full - replace the least recently updated track:
+            oldest = int(np.argmin(np.where(self.key != NO_KEY, self.time_ns, np.iinfo(np.int64).max)))
+            self.release(oldest)
+            self.evicted += 1
+        slot = self.free.pop()
+        self.slots[key] = slot
+        self.key[slot] = key
+        self.time_ns[slot] = t_ns
+        self.updates[slot] = 0
+        self.rejected[slot] = 0
+        return slot
+
+    def release(self, slot):
+        del self.slots[int(self.key[slot])]
+        self.key[slot] = NO_KEY
+        self.free.append(slot)
+
+    def start(self, slots, positions, variances):
+        self.state[slots, :3] = positions
+        self.state[slots, 3:] = 0
+        self.covariance[slots] = 0
+        for axis in range(3):
+            self.covariance[slots, axis, axis] = variances
+            self.covariance[slots, axis + 3, axis + 3] = self.initial_speed_sigma ** 2
+        self.updates[slots] = 1
+        self.rejected[slots] = 0
+
+    """
+    Function to update the tracks with new fixes
+    args:
+        keys: (n,) int64 array from track_keys(), fixes with NO_KEY are ignored
+        t_ns: (n,) int64 array of the times of the fixes (ns)
+        positions: (n, 3) ECEF positions of the fixes (m)
+        gdop: (n,) GDOP of the fixes, scales measurement_sigma
+    returns:
+        (n,) int64 array of the slot of each fix's track, -1 where not used
+    """
+    def update(self, keys, t_ns, positions, gdop):
+        slots = np.full(len(keys), -1, dtype=np.int64)
+        usable = np.flatnonzero((keys != NO_KEY) & np.isfinite(positions).all(axis=1) & np.isfinite(gdop))
+        if len(usable) == 0:
+            return slots
+        variances = (self.measurement_sigma * np.maximum(gdop, 1.0)) ** 2
+        t_ns = self.running_time(t_ns)
+
+        # fixes of the same aircraft are applied in time order, one round per fix of it:
+        order = usable[np.lexsort((t_ns[usable], keys[usable]))]
+        position = np.arange(len(order))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = keys[order][1:] != keys[order][:-1]
+        rank = position - np.maximum.accumulate(np.where(first, position, 0))
+
+        for r in range(int(rank.max()) + 1):
+            fix = order[rank == r]
+            slot = self.lookup(keys[fix])
+            new = slot < 0
+            for i in np.flatnonzero(new):
+                slot[i] = self.allocate(int(keys[fix[i]]), int(t_ns[fix[i]]))
+            if new.any():
+                self.start(slot[new], positions[fix[new]], variances[fix[new]])
+            old = ~new
+            if old.any():
+                self.filter(slot[old], t_ns[fix[old]], positions[fix[old]], variances[fix[old]])
+            slots[fix] = slot
+        newest = int(t_ns[usable].max())
+        self.newest_ns = newest if self.newest_ns is None else max(self.newest_ns, newest)
+        return slots
+
+    def filter(self, slots, t_ns, positions, variances):
+        n = len(slots)
+        dt = np.maximum((t_ns - self.time_ns[slots]) * 1e-9, 0.0)
+
+        # predict, F = [[I, dt I], [0, I]] and white acceleration noise:
+        transition = np.tile(np.eye(6), (n, 1, 1))
+        for axis in range(3):
+            transition[:, axis, axis + 3] = dt
+        q = self.acceleration_noise
+        noise = np.zeros((n, 6, 6))
+        for axis in range(3):
+            noise[:, axis, axis] = q * dt ** 3 / 3
+            noise[:, axis, axis + 3] = noise[:, axis + 3, axis] = q * dt ** 2 / 2
+            noise[:, axis + 3, axis + 3] = q * dt
+        state = np.einsum('nij,nj->ni', transition, self.state[slots])
+        covariance = transition @ self.covariance[slots] @ np.swapaxes(transition, 1, 2) + noise
+
+        # update with the fix, H = [I, 0]:
+        innovation = positions - state[:, :3]
+        innovation_cov = covariance[:, :3, :3] + np.eye(3) * variances[:, None, None]
+        inverse = np.linalg.inv(innovation_cov)
+        distance = np.einsum('ni,nij,nj->n', innovation, inverse, innovation)
+        gain = covariance[:, :, :3] @ inverse                                   # (n, 6, 3)
+
+        accepted = distance <= self.gate ** 2
+        state = state + np.einsum('nij,nj->ni', gain, innovation)
+        covariance = covariance - gain @ covariance[:, :3, :]
+        a = slots[accepted]
+        self.state[a] = state[accepted]
+        self.covariance[a] = covariance[accepted]
+        self.time_ns[a] = np.maximum(self.time_ns[a], t_ns[accepted])
+        self.updates[a] += 1
+        self.rejected[a] = 0
+
+        # rejected fixes leave the track as it was, until too many in a row restart it:
+        r = slots[~accepted]
+        self.rejected[r] += 1
+        restart = ~accepted & (self.rejected[slots] >= self.max_rejected)
+        if restart.any():
+            self.start(slots[restart], positions[restart], variances[restart])
+            self.time_ns[slots[restart]] = t_ns[restart]
+
+    """
+    Function to evict the tracks without a fix for 'ttl'
+    args:
+        now_ns: current time (ns since UTC midnight), by default the newest fix seen
+    returns:
+        number of tracks evicted
+    """
+    def evict(self, now_ns=None):
+        if now_ns is not None:
+            now_ns = int(self.running_time(now_ns))
+        elif self.newest_ns is None:
+            return 0
+        else:
+            now_ns = self.newest_ns
+        stale = np.flatnonzero((self.key != NO_KEY) & (self.time_ns < now_ns - self.ttl_ns))
+        for slot in stale.tolist():
+            self.release(slot)
+        self.evicted += len(stale)
+        return len(stale)
+
+    """
+    Function to get the current estimate of tracks
+    args:
+        slots: (n,) slots as returned by update()
+    returns:
+        (n, 3) ECEF positions, (n, 3) ECEF velocities (m/s), NaN rows for slots of -1 and
+        for slots released since (evicted, or taken over by another track). A track
+        (re)started from a single fix has no velocity yet, its velocity is NaN too
+    """
+    def estimate(self, slots):
+        live = (slots >= 0) & (self.key[slots] != NO_KEY)
+        state = np.where(live[:, None], self.state[slots], np.nan)
+        moving = live & (self.updates[slots] >= 2)
+        return state[:, :3], np.where(moving[:, None], state[:, 3:], np.nan)
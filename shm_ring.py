@@ -0,0 +1,174 @@
+"""Import required libraries"""
+import struct
+import time
+from multiprocessing import shared_memory
+
+
+"""Shared memory layout"""
+# The header keeps the producer-owned and the consumer-owned counters on separate cache lines:
+HEAD_OFFSET = 0         # uint64, records written (producer only)
+DROPPED_OFFSET = 8      # uint64, records dropped on a full ring (producer only)
+TAIL_OFFSET = 64        # uint64, records read (consumer only)
+HEADER_SIZE = 128
+
+SLOT_HEADER = struct.Struct('<H')   # record length, or BATCH_MARKER
+BATCH_HEADER = struct.Struct('<IQd')    # number of records following a BATCH_MARKER, batch sequence number, arrival time
+BATCH_MARKER = 0xFFFF
+COUNTER = struct.Struct('<Q')
+
+POLL_MIN = 0.00005      # consumer polling interval right after data was seen (s)
+POLL_MAX = 0.001        # consumer polling interval when idle (s), bounds the added latency
+
+
+"""Lock-free single-producer single-consumer ring of fixed-size records in shared memory"""
+class ShmRing:
+    '''
+    Drop-in replacement for one direction of a multiprocessing.Pipe(False) carrying
+    (sequence number, arrival time, list) batches: the producer process calls
+    send((seq, arrival, list)) and
+    the consumer process calls recv(), which returns the batch as sent. Each record occupies one fixed-size slot, so nothing is pickled
+    and nothing is allocated on the hot path.
+
+    Only the producer writes 'head' and 'dropped', only the consumer writes 'tail', and
+    a record becomes visible to the consumer when 'head' is advanced after its slot
+    has been written, so no lock is needed with one producer and one consumer.
+
+    args:
+        capacity: number of slots (records) in the ring
+        record_size: maximum size of one encoded record in bytes
+        encode: optional function turning an item into bytes, in the producer
+        decode: optional function turning bytes back into an item, in the consumer
+        block_timeout: time send() waits for space before dropping records (s)
+    '''
+
+    def __init__(self, capacity=65536, record_size=32, encode=None, decode=None, block_timeout=0.5):
+        self.capacity = capacity
+        self.record_size = record_size
+        self.slot_size = SLOT_HEADER.size + max(record_size, BATCH_HEADER.size)
+        self.encode = encode
+        self.decode = decode
+        self.block_timeout = block_timeout
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + capacity * self.slot_size)
+        self.shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        self.buf = self.shm.buf
+
+    # Child processes re-attach to the same block by name:
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shm'] = self.shm.name
+        del state['buf']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=state['shm'])
+        self.buf = self.shm.buf
+
+    def _get(self, offset):
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        COUNTER.pack_into(self.buf, offset, value)
+
+    @property
+    def depth(self):
+        """Number of records waiting to be read"""
+        return self._get(HEAD_OFFSET) - self._get(TAIL_OFFSET)
+
+    @property
+    def dropped(self):
+        """Number of records dropped because the ring was full or they were oversized"""
+        return self._get(DROPPED_OFFSET)
+
+    def poll(self):
+        """Whether a batch is ready to recv(), without blocking"""
+        return self._get(HEAD_OFFSET) != self._get(TAIL_OFFSET)
+
+    def send(self, batch):
+        '''
+        Writes one (seq, arrival, items) batch: a batch marker followed by one record per item.
+        Waits up to 'block_timeout' for the consumer to make space, then drops what does
+        not fit.
+        returns: number of items dropped
+        '''
+        seq, arrival, items = batch
+        head = self._get(HEAD_OFFSET)
+        needed = len(items) + 1
+        deadline = None
+        while True:
+            free = self.capacity - (head - self._get(TAIL_OFFSET))
+            if free >= needed:
+                break
+            if deadline is None:
+                deadline = time.monotonic() + self.block_timeout
+            elif time.monotonic() > deadline:
+                break
+            time.sleep(POLL_MIN)
+
+        dropped = 0
+        if free < 1:
+            # Not even room for the batch marker, the whole batch is lost:
+            dropped = len(items)
+            self._set(DROPPED_OFFSET, self.dropped + dropped)
+            return dropped
+
+        slots = self.buf
+        slot_size = self.slot_size
+        record_size = self.record_size
+        encode = self.encode
+        limit = min(len(items), free - 1)
+        count = 0
+        for item in items[:limit]:
+            record = encode(item) if encode else item
+            length = len(record)
+            if length > record_size:
+                dropped += 1
+                continue
+            count += 1
+            offset = HEADER_SIZE + ((head + count) % self.capacity) * slot_size
+            SLOT_HEADER.pack_into(slots, offset, length)
+            slots[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length] = record
+        dropped += len(items) - limit
+
+        # Batch marker last, then publish everything at once by advancing head:
+        offset = HEADER_SIZE + (head % self.capacity) * slot_size
+        SLOT_HEADER.pack_into(slots, offset, BATCH_MARKER)
+        BATCH_HEADER.pack_into(slots, offset + SLOT_HEADER.size, count, seq, arrival)
+        self._set(HEAD_OFFSET, head + count + 1)
+        if dropped:
+            self._set(DROPPED_OFFSET, self.dropped + dropped)
+        return dropped
+
+    def recv(self):
+        '''
+        Blocks until a batch is available.
+        returns: (seq, arrival, items) - items are bytes, or decoded items if 'decode' was given
+        '''
+        tail = self._get(TAIL_OFFSET)
+        interval = POLL_MIN
+        while self._get(HEAD_OFFSET) == tail:
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_MAX)
+
+        slots = self.buf
+        slot_size = self.slot_size
+        decode = self.decode
+        offset = HEADER_SIZE + (tail % self.capacity) * slot_size
+        count, seq, arrival = BATCH_HEADER.unpack_from(slots, offset + SLOT_HEADER.size)
+        items = []
+        for i in range(1, count + 1):
+            offset = HEADER_SIZE + ((tail + i) % self.capacity) * slot_size
+            length = SLOT_HEADER.unpack_from(slots, offset)[0]
+            record = bytes(slots[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length])
+            items.append(decode(record) if decode else record)
+        self._set(TAIL_OFFSET, tail + count + 1)
+        return seq, arrival, items
+
+    def close(self):
+        """Detaches this process from the shared memory block"""
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        """Frees the shared memory block, called once by the creating process"""
+        self.shm.unlink()
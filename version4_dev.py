@@ -1,8 +1,38 @@
 """Import required libraries"""
-import socket
 import time
 from datetime import datetime
 import multiprocessing
+from decoder_pool import Dispatcher, PoolStats, ReorderBuffer, wait_inputs
+from file_writer import SecondFileWriter
+from feed_receiver import Feed, feed_report, run_feeds
+from frame_filter import FrameFilter
+from metrics import ErrorLog, Metrics, MetricsServer
+from client_config import parse_args
+# NumPy, and the modules using it, are only imported by the processes that need them
+# (decoders, and the endpoint when it writes binary files), see PRELOAD_MODULES
+
+
+"""Modules the forkserver imports before forking the child processes, see main()"""
+PRELOAD_MODULES = ['__main__', 'batch_decoder', 'capture_format', 'shm_ring']
+
+
+"""Error messages by code"""
+ERROR_MESSAGES = {
+    '1a': "ERROR : Socket connection error. Reconnecting...",
+    '1b': "ERROR : Message length received is zero at socket",
+    '1c': "ERROR : Gap in the MLAT timestamps of a feed, messages were lost before they were received",
+    '1d': "ERROR : Parent send error",
+    '1e': "ERROR : Parent receive error",
+    '2a': "ERROR : Decode receive error",
+    '2b': "ERROR : Decode send error",
+    '3a': "ERROR : Endpoint receive error",
+    '3b': "ERROR : Endpoint write error",
+}
+
+# Each process logs through its own buffered, rate-limited log (see metrics.py) and
+# counts errors in its own block of the shared metrics, once set by the process:
+error_log = ErrorLog("0_Log_Errors.txt")
+process_metrics = None
 
 
 """Handles errors and print them to file"""
@@ -10,32 +40,9 @@ def errorHandler(code):
     """
     args: code in string format
     """
-    error_timestamp = str(datetime.utcnow())
-    
-    if (code == '1a'):
-        error_msg = "ERROR : Socket connection error. Reconnecting..."
-    elif (code == '1b'):
-        error_msg = "ERROR : Message length received is zero at socket"
-    elif (code == '1c'):
-        error_msg = "ERROR : There is no margin at 16384 buffer length"
-    elif (code == '1d'):
-        error_msg = "ERROR : Parent send error"
-    elif (code == '1e'):
-        error_msg = "ERROR : Parent receive error"
-    elif (code == '2a'):
-        error_msg = "ERROR : Decode receive error"
-    elif (code == '2b'):
-        error_msg = "ERROR : Decode send error"
-    elif (code == '3a'):
-        error_msg = "ERROR : Endpoint receive error"
-    elif (code == '3b'):
-        error_msg = "ERROR : Endpoint write error"
-        
-    error_msg_printed = ("%s : %s\n" %(error_timestamp, error_msg))
-        
-    with open("0_Log_Errors.txt", "a") as text_file:
-        text_file.write(error_msg_printed)
-        
+    if process_metrics is not None:
+        process_metrics.error(code)
+    error_log.log(code, ERROR_MESSAGES.get(code, "ERROR : Unknown error %s" % code))
     return
 
 
@@ -98,7 +105,7 @@ def num_timestamp(time_hex):
 
 
 """Process that extracts and decodes complete messages"""
-def decoder(decode_start, decode_end):
+def decoder(decode_start, decode_end, pool_stats=None, worker=0, metrics=None, storage_format='text', transport='pipe'):
     '''
     <esc> "1" : 6 byte MLAT timestamp, 1 byte signal level, 2 byte Mode-AC
     <esc> "2" : 6 byte MLAT timestamp, 1 byte signal level, 7 byte Mode-S short frame
@@ -107,317 +114,428 @@ def decoder(decode_start, decode_end):
     <esc><esc>: true 0x1a
     <esc> is 0x1a, and "1", "2" and "3" are 0x31, 0x32 and 0x33
     timestamp: wiki.modesbeast.com/Radarcape:Firmware_Versions#The_GPS_timestamp
+
+    One of a pool of decoder workers: batches arrive as (sequence number, arrival time,
+    messages) and leave as (sequence number, arrival time, decoded messages) so endpoint()
+    can restore order, and measure the latency from the socket read.
+    The decoded messages are in the form the files are written from (see storage_format
+    and batch_decoder.decode_batch()), so the endpoint does not decode them again.
     '''
+    global process_metrics
+    from batch_decoder import decode_batch
 
     # Initialize variables:
     run_decoder = True          # process control flag
     decoder_message_count = 0   # keep count number of decoded messages
+    if metrics is not None:
+        process_metrics = metrics.process('decoder', worker)
 
     while run_decoder:
         try:
 
             # Receive from parent process:
             try:
-                completed_msg_list = decode_start.recv()
+                seq, arrival, completed_msg_list = decode_start.recv()
             except Exception as e:
                 errorHandler('2a')
-                
-            messages_to_write = []  # List to contain messages (msg_to_write, in list form)
-            msg_to_write = []       # Individual messages in list form
-            
-            # Loop through list of messages (in list form):
-            for message in completed_msg_list:
-
-                # Decode message type and extract payload from message:
-                msgtype = message[0]
-                if msgtype == 0x32:
-                    # Mode-S Short Message, 7 byte, 14-len hexstr
-                    payload = ''.join('%02X' % i for i in message[8:15])
-                elif msgtype == 0x33:
-                    # Mode-S Long Message, 14 byte, 28-len hexstr
-                    payload = ''.join('%02X' % i for i in message[8:22])
-                    # Added to handle Mode-AC:
-                elif msgtype == 0x31:
-                    # Mode-AC, 9 byte, 18-len hexstr
-                    payload = ''.join('%02X' % i for i in message[8:10])
-                else:
-                    # Other message tupe
-                    continue
-
-                # incomplete message, control returned to top of for loop:
-                if len(payload) not in [4, 14, 28]:
-                    continue
-                # # more secured alternative (only for mode S):
-                # df = df(payload)
-                # # skip incomplete message
-                # if df in [0, 4, 5, 11] and len(payload) != 14:
-                    # continue
-                # if df in [16, 17, 18, 19, 20, 21, 24] and len(payload) != 28:
-                    # continue
-
-                # Extract hexadecimal string signifying the timestamp from full_message:
-                # Method is common for all three message types above
-                time_hex = ''.join('%02X' % i for i in message[1:7])
-                
-                # Call function to decode for timestamp in decimal/ float form:
-                ts = num_timestamp(time_hex)
-                
-                # Extract full message:
-                full_message = ''.join('%02X' % i for i in message[:])
-                
-                # Call function to decode for downlink format:
-                downlink = df(payload)  # Garbage for mode A-C
-                
-                # Get Internet timestamp:
-                utc_now = datetime.utcnow()
-                utc_midnight = utc_now
-                localtime = (utc_now - utc_midnight.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
-
-                # First, check if len = 4 (mode-AC):
-                if (len(payload)==4):
-                    # Format list to contain data:
-                    msg_to_write = [full_message, time_hex, ts, localtime, downlink, payload]   # squawk for mode AC taken to be just 'payload', a 2 byte message
-                    # Append to list of formatted messages for writing:
-                    messages_to_write.append(msg_to_write)
-
-                # Call function to decode for squawk if DF5, 17, 21. For more supported functions, see 'extra':
-                elif (downlink in [5, 17, 21]):
-                    squawk = idcode(payload)
-                    msg_to_write = [full_message, time_hex, ts, localtime, downlink, squawk]
-                    # Append to list of formatted messages for writing:
-                    messages_to_write.append(msg_to_write)
-
-                # Not interested - no squawk code:
-                else:
-                    pass
-
-                # Update counter:
-                decoder_message_count = decoder_message_count + 1
+                continue
+
+            # Decode the whole batch at once, only Mode-AC and DF5, 17, 21 messages are returned
+            # in list form: [full_message, time_hex, ts, localtime, downlink, squawk], and/ or
+            # as binary records:
+            start = time.perf_counter()
+            messages_to_write, decoded_count = decode_batch(completed_msg_list, storage_format)
+            written_count = len(messages_to_write[0]) if storage_format == 'both' else len(messages_to_write)
+            if storage_format == 'both' and transport == 'shm':
+                # one slot per message, holding both forms (see capture_format.pack_row_record()):
+                messages_to_write = list(zip(*messages_to_write))
+
+            # Update counters:
+            decoder_message_count = decoder_message_count + decoded_count
+            if pool_stats is not None:
+                pool_stats.add(worker, 'batches_done')
+                pool_stats.add(worker, 'frames_done', len(completed_msg_list))
+            if process_metrics is not None:
+                process_metrics.observe('decode', time.perf_counter() - start)
+                process_metrics.add('frames_decoded', len(completed_msg_list))
+                process_metrics.add('rows_decoded', written_count)
 
             # Messages decoded - Pipe list of decoded messages (in list form):
             try:
-                decode_end.send(messages_to_write)
+                decode_end.send((seq, arrival, messages_to_write))
             except Exception as e:
                 errorHandler('2b')
+            error_log.flush_expired()
 
         # process termination control:
         except KeyboardInterrupt:
             run_decoder = False
+            error_log.close()
             print("***************")
             time_now = str(datetime.utcnow())
-            print("%s | Decoder message count: %d" %(time_now, decoder_message_count))
+            print("%s | Decoder %d message count: %d" %(time_now, worker, decoder_message_count))
             print("%s | Decoder process terminated" %(time_now))
             continue    # Returns control to the top of the loop
 
 
+"""Functions to group a batch of decoded messages by second, for the per-second files"""
+def group_text(messages_to_write):
+    '''
+    args: list of decoded messages (in list form)
+    returns: dictionary of second -> list of encoded lines, and the number of messages grouped
+    '''
+    lines_by_second = {}
+    count = 0
+    for message in messages_to_write:
+        try:
+            # Routine to update filenames (using seconds):
+            # rounds the float timestamp down using int (floor):
+            second = int(message[2])
+            # Was a list, cast it into a string and remove '[' and ']' due to typecasting from list:
+            line_to_write = str(message)[1:-1]
+            lines_by_second.setdefault(second, []).append(("%s\n" %line_to_write).encode())
+            count = count + 1
+
+        # Error - try to extract data for debugging:
+        except Exception as e:
+            errorHandler('3b')
+    return lines_by_second, count
+def group_binary(records):
+    '''
+    args: structured array of decoded messages as records (see capture_format.py)
+    returns: dictionary of second -> list with the bytes of its records
+    '''
+    from capture_format import records_by_second
+    # Same second as the text filename, int(ts):
+    return {second: [records.tobytes()] for second, records in records_by_second(records).items()}
+
+
+"""Function that splits a decoded batch, from either transport, into its list form and its records"""
+def split_batch(batch, storage_format):
+    '''
+    args:
+        batch: decoded messages as sent by decoder()
+        storage_format: see endpoint()
+    returns: list of decoded messages (in list form) or None, records or None
+    '''
+    if storage_format == 'text':
+        return batch, None
+    import numpy as np
+    from capture_format import RECORD_DTYPE
+    if storage_format == 'binary':
+        messages_to_write, records = None, batch
+    elif isinstance(batch, tuple):
+        messages_to_write, records = batch
+    else:
+        # (list form, record bytes) pairs from the shared memory ring:
+        messages_to_write = [message for message, _ in batch]
+        records = [record for _, record in batch]
+    if not isinstance(records, np.ndarray):
+        # record bytes from the shared memory ring:
+        records = np.frombuffer(b''.join(records), dtype=RECORD_DTYPE)
+    return messages_to_write, records
+
+
 """Process that update filenames and write messages to file"""
-def endpoint(endpoint_start):
-    prev_fn = "dummy.txt"   # Dummy filename for initialisation
+def endpoint(endpoint_starts, storage_format='text', metrics=None):
+    '''
+    args:
+        endpoint_starts: one pipe 'start' per decoder worker
+        storage_format: 'text' for '<second>.txt', 'binary' for '<second>.bin' (see
+            capture_format.py) or 'both'
+    Batches from all workers go through a reorder buffer, so they are written in the
+    order the main process received them. Files are written through SecondFileWriter,
+    see file_writer.py.
+    '''
+    global process_metrics
+    if metrics is not None:
+        process_metrics = metrics.process('endpoint')
     run_endpoint = True
     endpoint_message_count = 0
+    reorder = ReorderBuffer()
+    text_writer = SecondFileWriter('.txt')
+    file_header = None
+    if storage_format in ('binary', 'both'):
+        from capture_format import file_header
+    binary_writer = SecondFileWriter('.bin', header=file_header)
 
     while run_endpoint:
         try:
 
-            messages_to_write = []
+            batches_to_write = []
 
             try:
-                messages_to_write = endpoint_start.recv()   # receiving list of messages in list form here
+                for endpoint_start in wait_inputs(endpoint_starts, 0.1):
+                    seq, arrival, messages_to_write = endpoint_start.recv()   # receiving list of messages in list form here
+                    if process_metrics is not None:
+                        # arrival: time.monotonic() of the socket read, the same clock in every process
+                        process_metrics.observe('socket_to_endpoint', time.monotonic() - arrival)
+                        process_metrics.add('batches_received')
+                    batches_to_write.extend(reorder.push(seq, messages_to_write))
+                # Also releases batches held back by a missing one once it has timed out:
+                batches_to_write.extend(reorder.release())
             except Exception as e:
                 errorHandler('3a')
 
-            for message in messages_to_write:
+            for batch in batches_to_write:
                 try:
+                    start = time.perf_counter()
+                    written = 0
+                    messages_to_write, records = split_batch(batch, storage_format)
+                    # Binary per-second files:
+                    if storage_format in ('binary', 'both'):
+                        chunks_by_second = group_binary(records)
+                        binary_writer.write_batch(chunks_by_second)
+                        written = written + sum(len(chunk) for chunks in chunks_by_second.values() for chunk in chunks)
+                        if storage_format == 'binary':
+                            endpoint_message_count = endpoint_message_count + len(records)
+                            count = len(records)
+
+                    # Text per-second files:
+                    if storage_format in ('text', 'both'):
+                        lines_by_second, count = group_text(messages_to_write)
+                        text_writer.write_batch(lines_by_second)
+                        written = written + sum(len(line) for lines in lines_by_second.values() for line in lines)
+                        # Update counter:
+                        endpoint_message_count = endpoint_message_count + count
 
-                    # Routine to update filenames (using seconds):
-                    # Extract timestamp and set it as temporary filename:
-                    time_for_fn = message[2]    # float
-                    # rounds it down using int (floor) and converts it to str:
-                    filename = str(int(time_for_fn))
-                    filename = filename+".txt"
-                    
-                    # if one second has passed, update filename:
-                    if (filename!=prev_fn):
-                        try:
-                            prev_fn.close() # close the previous file
-                        except:             # Expected error on first loop
-                            pass
-                        prev_fn = filename  # Update the old filename
-                        file = open(prev_fn,"a")
-                    
-                    # Was a list, cast it into a string:
-                    line = str(message)
-                    # Remove '[' and ']' due to typecasting from list:
-                    line_to_write = line[1::][:-1:]
-                    # write to file with updated filename:
-                    file.write("%s\n" %line_to_write)
-                    # Update counter:
-                    endpoint_message_count = endpoint_message_count + 1
+                    if process_metrics is not None:
+                        process_metrics.observe('write', time.perf_counter() - start)
+                        process_metrics.add('rows_written', count)
+                        process_metrics.add('bytes_written', written)
 
                 # Error - try to extract data for debugging:
                 except Exception as e:
                     errorHandler('3b')
 
+            # Flush and close files on the time thresholds, also when no messages arrive:
+            try:
+                text_writer.flush_expired()
+                binary_writer.flush_expired()
+            except Exception as e:
+                errorHandler('3b')
+            error_log.flush_expired()
+
         except KeyboardInterrupt:
             run_endpoint = False
+            text_writer.close()
+            binary_writer.close()
+            error_log.close()
             print("***************")
             time_now = str(datetime.utcnow())
             print("%s | Endpoint message count: %d" %(time_now, endpoint_message_count))
+            print("%s | Endpoint batches skipped by reorder: %d" %(time_now, reorder.skipped))
             print("%s | Endpoint process terminated" %(time_now))
             continue    # Returns control to the top of the loop
 
 
-"""Function to connect to hardcoded host, port"""
-def connect():
-    host = "aaa.bbb.ccc.ddd"    # target IP address (str)
-    port = xxxxx    # port number (int)
-    while True:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # 10 seconds to return object before timeout:
-            s.settimeout(10)
-            s.connect((host, port))
-            time_now = str(datetime.utcnow())
-            print("%s | Server connected - %s:%s" %(time_now, host, port))
-            print("%s | Collecting messages..." %(time_now))
-            return s
-        except socket.error as err:
-            time_now = str(datetime.utcnow())
-            print("%s | Socket connection error: %s. Reconnecting..." %(time_now, err))
-            errorHandler('1a')
-            time.sleep(3)
-
-
 """Main process that sets up architecture and collect data to pipe"""
-if __name__ == '__main__':
-
-    # Create pipes:
-    decode_start, parent_end = multiprocessing.Pipe(False)
-    endpoint_start, decode_end = multiprocessing.Pipe(False)
-
-    # Create new child processes and give them pipe 'starts' and 'ends':
-    decoding_process = multiprocessing.Process(target=decoder, args=(decode_start, decode_end))
-    endpoint_process = multiprocessing.Process(target=endpoint, args=(endpoint_start,))
-
-    # Start both child processes:
-    decoding_process.start()
+def main(config):
+    '''
+    args: dictionary of settings, see client_config.py
+    '''
+    global process_metrics
+
+    # Settings, see client_config.py:
+    transport = config['transport']
+    num_decoders = config['num_decoders']
+    stats_interval = config['stats_interval']
+    storage_format = config['storage_format']
+    feed_addresses = config['feed_addresses']
+    metrics_port = config['metrics_port']
+    if not feed_addresses:
+        print("No feeds to receive from - set feed_addresses in the config file, or use --feed host:port")
+        return
+
+    # With 'forkserver', the child processes are forked from a server process that has
+    # imported PRELOAD_MODULES once, while this process goes on to connect to the feeds:
+    context = multiprocessing.get_context(config['start_method'])
+    if config['start_method'] == 'forkserver':
+        context.set_forkserver_preload(PRELOAD_MODULES)
+    if transport == 'shm':
+        from shm_ring import ShmRing
+        from batch_decoder import pack_row, unpack_row
+        from capture_format import record_bytes, pack_row_record, unpack_row_record
+
+    # Create pipes, a pair per decoder worker:
+    parent_ends = []
+    decode_ends = []
+    decoding_processes = []
+    endpoint_starts = []
+    pool_stats = PoolStats(num_decoders)
+    metrics = Metrics(num_decoders, ERROR_MESSAGES)
+    process_metrics = metrics.process('receiver')
+    for worker in range(num_decoders):
+        if transport == 'shm':
+            # Raw messages (at most 22 bytes when decodable) and decoded messages in binary form:
+            decode_start = parent_end = ShmRing(capacity=65536, record_size=32)
+            # (decoded messages in the form decoder() sends them for storage_format):
+            if storage_format == 'text':
+                endpoint_start = decode_end = ShmRing(capacity=65536, record_size=64, encode=pack_row, decode=unpack_row)
+            elif storage_format == 'binary':
+                endpoint_start = decode_end = ShmRing(capacity=65536, record_size=64, encode=record_bytes)
+            else:
+                endpoint_start = decode_end = ShmRing(capacity=65536, record_size=128, encode=pack_row_record,
+                                                      decode=unpack_row_record)
+        else:
+            decode_start, parent_end = context.Pipe(False)
+            endpoint_start, decode_end = context.Pipe(False)
+        parent_ends.append(parent_end)
+        decode_ends.append(decode_end)
+        endpoint_starts.append(endpoint_start)
+
+        # Create new child process and give it pipe 'start' and 'end':
+        decoding_processes.append(context.Process(target=decoder, args=(decode_start, decode_end, pool_stats, worker, metrics,
+                                                                                  storage_format, transport)))
+    endpoint_process = context.Process(target=endpoint, args=(endpoint_starts, storage_format, metrics))
+
+    # Start all child processes:
+    for decoding_process in decoding_processes:
+        decoding_process.start()
     endpoint_process.start()
 
-    # Establish connection:
+    # Initialise 'slow-changing' variables:
+    feeds = [Feed(host, port, recv_size=config['recv_size'], max_recv_size=config['max_recv_size'],
+                  rcvbuf_size=config['rcvbuf_size'], coalesce_delay=config['coalesce_delay']) for host, port in feed_addresses]
+    frame_filter = FrameFilter(config['filter_downlink_formats'], config['filter_mode_ac'], config['filter_icao'],
+                               config['filter_min_signal'])
+    raw_archive = None
+    if config['raw_archive_path'] is not None:
+        # Compresses and writes on a thread of its own, see raw_archive.py:
+        from raw_archive import RawArchive
+        raw_archive = RawArchive(config['raw_archive_path'], config['raw_archive_codec'],
+                                 config['raw_archive_retention_bytes'])
+    next_stats = time.monotonic() + stats_interval
+
+    """Function that copies the messages of a batch out of the read, for pickling into a pipe"""
+    def copy_frames(completed_msg_list):
+        return [bytes(completed_msg) for completed_msg in completed_msg_list]
+
+    # Sends to the decoders on a thread of its own, so a full pipe or ring never blocks the
+    # event loop the feeds are received in (see decoder_pool.py). The shared memory ring
+    # copies straight from the memoryview slices:
+    dispatcher = Dispatcher(parent_ends, list if transport == 'shm' else copy_frames, pool_stats, process_metrics)
+
+    """Function that returns the metrics only the main process knows, read at every request"""
+    def main_gauges():
+        gauges = [
+            ('decoder_queue_depth', 'gauge', 'Batches sent to a decoder but not yet decoded',
+             [({'process': 'decoder_%d' % worker},
+               pool_stats.get(worker, 'batches_sent') - pool_stats.get(worker, 'batches_done')) for worker in range(num_decoders)]),
+            ('dispatch_queue_depth', 'gauge', 'Batches received but not yet sent to a decoder', [({'process': 'receiver'}, dispatcher.depth)]),
+            ('feed_bytes_received_total', 'counter', 'Bytes received from a feed',
+             [({'feed': feed.name}, feed.bytes_received) for feed in feeds]),
+            ('feed_messages_total', 'counter', 'Complete messages received from a feed',
+             [({'feed': feed.name}, feed.message_count) for feed in feeds]),
+            ('feed_reconnects_total', 'counter', 'Connections of a feed lost',
+             [({'feed': feed.name}, feed.reconnects) for feed in feeds]),
+            ('feed_min_margin_bytes', 'gauge', 'Minimum unused space of the receive buffer of a feed',
+             [({'feed': feed.name}, feed.min_margin) for feed in feeds]),
+            ('feed_reads_total', 'counter', 'Socket reads of a feed',
+             [({'feed': feed.name}, feed.reads) for feed in feeds]),
+            ('feed_full_reads_total', 'counter', 'Socket reads that filled the receive buffer of a feed',
+             [({'feed': feed.name}, feed.full_reads) for feed in feeds]),
+            ('feed_recv_size_bytes', 'gauge', 'Current size of the receive buffer of a feed',
+             [({'feed': feed.name}, len(feed.buffer)) for feed in feeds]),
+            ('feed_rcvbuf_bytes', 'gauge', 'Kernel receive buffer (SO_RCVBUF) of the connection of a feed',
+             [({'feed': feed.name}, feed.rcvbuf or 0) for feed in feeds]),
+            ('feed_overruns_total', 'counter', 'Gaps in the MLAT timestamps of a feed taken for lost messages',
+             [({'feed': feed.name}, feed.overruns) for feed in feeds]),
+            ('feed_lost_messages_total', 'counter', 'Messages of a feed estimated lost in the gaps',
+             [({'feed': feed.name}, feed.lost_messages) for feed in feeds]),
+        ]
+        if raw_archive is not None:
+            gauges.append(('raw_archive_blocks_total', 'counter', 'Blocks of the raw archive, written, dropped or not written on an error',
+                           [({'result': 'written'}, raw_archive.blocks_written), ({'result': 'dropped'}, raw_archive.blocks_dropped),
+                            ({'result': 'error'}, raw_archive.write_errors)]))
+            gauges.append(('raw_archive_bytes_total', 'counter', 'Bytes of the raw archive, before and after compression',
+                           [({'stage': 'in'}, raw_archive.bytes_in), ({'stage': 'out'}, raw_archive.bytes_out)]))
+        if transport == 'shm':
+            gauges.append(('shm_dropped_frames_total', 'counter', 'Messages dropped by a full shared memory ring',
+                           [({'process': 'decoder_%d' % worker, 'ring': ring}, ends[worker].dropped)
+                            for worker in range(num_decoders) for ring, ends in (('raw', parent_ends), ('decoded', decode_ends))]))
+        return gauges
+
+    """Function that records the time to deframe and dispatch every socket read"""
+    def observe_read(feed, seconds):
+        process_metrics.observe('receive', seconds)
+
+    """Function that queues the completed messages of any feed for the next decoder"""
+    def send_to_decoders(feed, completed_msg_list):
+        nonlocal next_stats
+
+        # Drop unwanted messages before they are copied to a decoder:
+        received_count = len(completed_msg_list)
+        completed_msg_list = frame_filter.select(completed_msg_list)
+        process_metrics.add('frames_filtered', received_count - len(completed_msg_list))
+
+        # Messages segmented - queue list of completed messages for the next decoder, dropped
+        # (and counted) if the decoders have fallen behind:
+        if len(completed_msg_list) > 0:
+            dispatcher.dispatch(completed_msg_list, time.monotonic())
+        # Send errors of the dispatcher thread, logged from this one:
+        for _ in range(dispatcher.new_errors()):
+            errorHandler('1d')
+        error_log.flush_expired()
+
+        # Print decoder pool statistics:
+        if time.monotonic() > next_stats:
+            time_now = str(datetime.utcnow())
+            for line in [feed_report(feed) for feed in feeds] + pool_stats.report() + metrics.report():
+                print("%s | %s" %(time_now, line))
+            print("%s | Dispatcher | queued: %d | dropped: %d batches (%d messages)"
+                  %(time_now, dispatcher.depth, dispatcher.batches_dropped, dispatcher.frames_dropped))
+            if raw_archive is not None:
+                print("%s | %s" %(time_now, raw_archive.report()))
+            next_stats = time.monotonic() + stats_interval
+
+    # Connect and receive from all feeds, each feed reconnects on its own (see feed_receiver.py):
     time_now = str(datetime.utcnow())
     print("***************")
     print("%s | Script initiated" %(time_now))
-    sock = connect()
-
-    # Initialise 'slow-changing' variables:
-    run_parent = True       # process control flag for key-board interrupt
-    min_margin = 16384      # variable for 'margin check', stores minimum margin
-    buffer = []             # buffer to store incoming data
-    main_message_count = 0  # keep count the number of complete messages
-
-    # Start receiving data:
-    while run_parent:
-
-        try:
-            # Receive from socket:
-            received = sock.recv(16384)
-
-            # Check that we are receiving:
-            if (len(received) == 0):
-                errorHandler('1b')
-
-            # Confirmed that we are receiving:
-            else:
+    if metrics_port is not None:
+        # A thread of the main process, started after the child processes:
+        metrics_server = MetricsServer(metrics, main_gauges, port=metrics_port).start()
+        print("%s | Metrics at http://127.0.0.1:%d/metrics" %(time_now, metrics_port))
+    try:
+        run_feeds(feeds, send_to_decoders, errorHandler, observe_read,
+                  raw_archive.write if raw_archive is not None else None)
+
+    except KeyboardInterrupt:
+        print("***************")
+        # Print minimum buffer margin upon exit, 0 if reads filled the buffer (it then grows, see feed_receiver.adapt())
+        time_now = str(datetime.utcnow())
+        for feed in feeds:
+            print("%s | %s minimum buffer margin at socket: %d" %(time_now, feed.name, feed.min_margin))
+            print("%s | %s message count: %d, reconnects: %d" %(time_now, feed.name, feed.message_count, feed.reconnects))
+            print("%s | %s" %(time_now, feed_report(feed)))
+        print("%s | Main message count: %d" %(time_now, sum(feed.message_count for feed in feeds)))
+        dispatcher.close()
+        print("%s | Dispatcher dropped: %d batches (%d messages)" %(time_now, dispatcher.batches_dropped, dispatcher.frames_dropped))
+        if raw_archive is not None:
+            raw_archive.close()
+            print("%s | %s" %(time_now, raw_archive.report()))
+        for line in pool_stats.report() + metrics.report():
+            print("%s | %s" %(time_now, line))
+        if transport == 'shm':
+            for worker in range(num_decoders):
+                print("%s | Decoder %d shared memory dropped messages: %d raw, %d decoded"
+                      %(time_now, worker, parent_ends[worker].dropped, decode_ends[worker].dropped))
+        print("%s | Main process terminated" %(time_now))
+        print("***************")
+    error_log.close()
+    if metrics_port is not None:
+        metrics_server.stop()
+
+    # Free shared memory once both child processes have terminated:
+    if transport == 'shm':
+        for decoding_process in decoding_processes:
+            decoding_process.join()
+        endpoint_process.join()
+        for ring in parent_ends + decode_ends:
+            ring.close()
+            ring.unlink()
 
-                # Check margin:
-                margin = 16384 - len(received)
-
-                # Check if margin is zero:
-                if (margin == 0):
-                    errorHandler('1c')
-                    min_margin = margin
-
-                # Even if not zero, update if there is a new minimum margin:
-                elif (margin < min_margin):
-                    min_margin = margin
-
-            # Extends list to add newly received elements:
-            buffer.extend(received)
-
-            # Initialise/ empty lists with each loop, after sending:
-            completed_msg_list = []
-            completed_msg = []
-            i = 0
-
-            # process the buffer until the last divider <esc> 0x1a and reset buffer with remainder:
-            while i < len(buffer):
-
-                # Check if we are at a flag byte:
-                if (buffer[i] != 0x1a):
-                    # if we are not, append
-                    completed_msg.append(buffer[i])
-                    # try:
-                        # completed_msg.append(buffer[i])
-                    # except AttributeError as error:
-                        # completed_msg = [completed_msg]
-                        # completed_msg.extend(buffer[i])
-
-                # we are at a flag byte:
-                else:
-                    # Check if we have reached the end of the buffer:
-                    if (i == len(buffer) - 1):
-                        # if so, append
-                        completed_msg.append(0x1a)
-                    # if we have not yet reached the end and the next byte is also a flag byte,
-                    # the byte we are at is a 'stuffed' byte:
-                    elif (buffer[i+1] == 0x1a):
-                        # append, but skip the next byte:
-                        completed_msg.append(0x1a)
-                        i += 1
-                    # if we have not yet reached the end and the next byte is not a flag byte,
-                    # we have one complete message:
-                    elif len(completed_msg) > 0:
-                        completed_msg_list.append(completed_msg)
-                        completed_msg = []
-                        # Update counter:
-                        main_message_count = main_message_count + 1
-
-                i += 1
-
-            # save the remainder for next reading cycle, if not empty:
-            if len(completed_msg) > 0:
-                remainder = []
-                for i, m in enumerate(completed_msg):
-                    if (m == 0x1a) and (i < len(completed_msg)-1):
-                        # rewind 0x1a, except when it is at the last bit
-                        remainder.extend([m, m])
-                    else:
-                        remainder.append(m)
-                buffer = [0x1a] + remainder
-            else:
-                # Else empty, reset buffer
-                buffer = []
-
-            # Messages segmented - Pipe list of completed messages (in list form):
-            try:
-                parent_end.send(completed_msg_list)
-            except Exception as e:
-                errorHandler('1d')
-
-        except KeyboardInterrupt:
-            run_parent = False
-            print("***************")
-            # Print minimum buffer margin upon exit i.e. ideally we always want some margin
-            time_now = str(datetime.utcnow())
-            print("%s | Minimum buffer margin at socket: %d" %(time_now, min_margin))
-            print("%s | Main message count: %d" %(time_now, main_message_count))
-            print("%s | Main process terminated" %(time_now))
-            print("***************")
-            # Returns control to the top of the loop:
-            continue
 
-        except Exception as e:
-            try:
-                sock = connect()
-            except Exception as e:
-                errorHandler('1e')
+if __name__ == '__main__':
+    main(parse_args())